@@ -0,0 +1,41 @@
+import os
+import stat
+import tempfile
+import unittest
+
+
+def get_umask() -> int:
+    # The umask can only be read by setting it, so it is read once at import before any threads start
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+DEFAULT_FILE_MODE = 0o666 & ~get_umask()
+
+
+def replace_atomically(temp_path: str, path: str):
+    # Temporary files are created 0600, so they get the mode open() would have given the file before taking its place
+    os.chmod(temp_path, DEFAULT_FILE_MODE)
+    os.replace(temp_path, path)
+
+
+def write_atomically(path: str, content: str):
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", encoding='utf-8', dir=directory, delete=False) as file:
+        file.write(content)
+    replace_atomically(file.name, path)
+
+
+class TestSuite(unittest.TestCase):
+    def test_write_atomically_uses_default_mode(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "report.csv")
+            with open(os.path.join(directory, "plain.csv"), 'w', encoding='utf-8') as file:
+                file.write("a\n")
+            write_atomically(path, "a\n")
+            self.assertEqual(stat.S_IMODE(os.stat(os.path.join(directory, "plain.csv")).st_mode),
+                             stat.S_IMODE(os.stat(path).st_mode))
+            with open(path, 'r', encoding='utf-8') as file:
+                self.assertEqual("a\n", file.read())
+            self.assertEqual(["plain.csv", "report.csv"], sorted(os.listdir(directory)))
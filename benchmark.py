@@ -0,0 +1,248 @@
+import argparse
+import contextlib
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest
+
+from discord_api import MockDiscordApi
+from main import Main
+from metrics import metrics
+from risk_api import RiskApi
+from stub_servers import DiscordStubServer, RiskStubServer
+
+IMPORT_TIME_PATTERN = re.compile(r"import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)")
+HEAVY_MODULES = ("requests", "numpy", "websockets")
+
+
+class SyntheticRiskApi(RiskApi):
+    def __init__(self, player_count):
+        super().__init__()
+        self.player_names = [f"Player_{i}" for i in range(player_count)]
+
+    def _call_api(self, endpoint, params=None):
+        if endpoint == "players":
+            return [{"team": self.team, "player": name, "turnsPlayed": 10, "mvps": 1,
+                     "lastTurn": {"season": 1, "day": 19, "stars": 3}} for name in self.player_names]
+        if endpoint == "mercs":
+            return []
+        if endpoint == "players/batch":
+            return [synthetic_player_info(name, self.team) for name in params["players"].split(",")]
+        raise ValueError(f"Unexpected endpoint {endpoint}")
+
+    def _get_turns_api_data(self):
+        return [{"id": 19, "season": 1, "day": 19, "complete": True},
+                {"id": 20, "season": 1, "day": 20, "complete": False}]
+
+
+def synthetic_player_info(name, team):
+    return {"name": name, "team": {"name": team},
+            "ratings": {"overall": 3, "totalTurns": 3, "gameTurns": 3, "mvps": 1, "streak": 2},
+            "stats": {"totalTurns": 10, "gameTurns": 10, "mvps": 1, "streak": 4},
+            "turns": [{"season": 1, "day": 19, "stars": 3, "mvp": False, "territory": "Ann Arbor", "team": team}]}
+
+
+def synthetic_discord_id(i):
+    return str(100000000000000000 + i)
+
+
+class SyntheticMain(Main):
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+        self.risk_api = SyntheticRiskApi(size)
+        self.discord_api = MockDiscordApi([
+            {"user": {"id": synthetic_discord_id(i), "username": f"member{i}", "discriminator": "0001"},
+             "nick": None, "roles": ["1"]} for i in range(size)])
+        for logger in (self.logger, self.risk_api.logger, self.discord_api.logger):
+            logger.log_path = os.devnull
+
+    def get_username_mapping(self):
+        return synthetic_username_mapping(self.size)
+
+
+def synthetic_username_mapping(size):
+    # Mapped Reddit names use a different case than the Risk API to exercise the case-insensitive lookup
+    return {"players": {synthetic_discord_id(i): {"reddit": f"player_{i}", "prefix": ""} for i in range(size)},
+            "exclude": {}, "diplomats": {}}
+
+
+class StubMain(Main):
+    def __init__(self, size, risk_url, discord_url, report_directory):
+        super().__init__()
+        self.size = size
+        self.report_directory = report_directory
+        self.risk_api.api_base_url = risk_url
+        self.discord_api.api_base_url = discord_url
+        self.discord_api.write_executor.api_base_url = discord_url
+        for logger in (self.logger, self.risk_api.logger, self.discord_api.logger):
+            logger.log_path = os.devnull
+
+    def get_username_mapping(self):
+        return synthetic_username_mapping(self.size)
+
+
+class StubEnvironment:
+    # Rate limits are compressed in time so the 429 handling is exercised without minute-long runs
+    def __init__(self, size, changed_every=20, bucket_limit=50, bucket_window=0.05, global_limit=2000):
+        self.size = size
+        self.risk_stub = RiskStubServer()
+        self.discord_stub = DiscordStubServer(bucket_limit=bucket_limit, bucket_window=bucket_window,
+                                              global_limit=global_limit)
+        self.global_limit = global_limit
+        self.changed_every = changed_every
+        self.report_directory = tempfile.TemporaryDirectory()
+        self.main = None
+
+    def __enter__(self):
+        risk_url = self.risk_stub.start()
+        discord_url = self.discord_stub.start()
+        self.main = StubMain(self.size, self.risk_stub.api_base_url(risk_url),
+                             self.discord_stub.api_base_url(discord_url), self.report_directory.name)
+        self.main.discord_api.write_executor.global_limit = self.global_limit
+        self.risk_stub.team = self.main.risk_api.team
+        self.risk_stub.set_players([synthetic_player_info(f"Player_{i}", self.risk_stub.team)
+                                    for i in range(self.size)], [])
+        self.discord_stub.roles = [{"id": "1", "name": self.main.secrets.get_verified_discord_role_name()}]
+        # Most members already carry their target nickname, as they do after the first run of a season
+        self.discord_stub.set_members([
+            {"user": {"id": synthetic_discord_id(i), "username": f"member{i}", "discriminator": "0001"},
+             "nick": None if i % self.changed_every == 0 else f"Player_{i} {self.main.star_char * 3}", "roles": ["1"]}
+            for i in range(self.size)])
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.risk_stub.stop()
+        self.discord_stub.stop()
+        self.report_directory.cleanup()
+
+    def request_count(self) -> int:
+        return self.risk_stub.request_count + self.discord_stub.request_count
+
+
+def measure_step(environment, func):
+    metrics.reset()
+    requests_before = environment.request_count()
+    rate_limited_before = environment.discord_stub.rate_limited_count
+    tracemalloc.start()
+    seconds = time_call(func)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": seconds, "requests": environment.request_count() - requests_before,
+            "rate_limited": environment.discord_stub.rate_limited_count - rate_limited_before,
+            "peak_bytes": peak, "metrics": metrics.to_dict()}
+
+
+def benchmark_stubs_size(size):
+    with StubEnvironment(size) as environment:
+        csv_result = measure_step(environment, environment.main.write_csv_file)
+        nick_result = measure_step(environment, environment.main.set_discord_nicknames)
+    metrics.reset()
+    return csv_result, nick_result
+
+
+def time_call(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def benchmark_size(size):
+    csv_main = SyntheticMain(size)
+    csv_main.cache_all_stars()
+    csv_main.discord_api.get_guild_members()
+    csv_seconds = time_call(csv_main.generate_csv)
+    nick_main = SyntheticMain(size)
+    nick_main.cache_all_stars()
+    nick_main.discord_api.get_guild_members()
+    nick_seconds = time_call(nick_main.set_discord_nicknames)
+    return csv_seconds, nick_seconds
+
+
+def run(sizes):
+    print(f"{'Size':>8} {'CSV (s)':>10} {'CSV us/row':>12} {'Nick (s)':>10} {'Nick us/member':>16}")
+    for size in sizes:
+        # The loggers print every nickname update to stdout, which would drown out the results
+        with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+            csv_seconds, nick_seconds = benchmark_size(size)
+        print(f"{size:>8} {csv_seconds:>10.3f} {csv_seconds / size * 1e6:>12.1f} "
+              f"{nick_seconds:>10.3f} {nick_seconds / size * 1e6:>16.1f}")
+
+
+def run_stubs(sizes):
+    print(f"{'Size':>8} {'Step':<10} {'Wall (s)':>10} {'Requests':>9} {'429s':>6} {'Peak (MiB)':>11}")
+    for size in sizes:
+        with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+            results = benchmark_stubs_size(size)
+        for step, result in zip(("csv", "nicknames"), results):
+            print(f"{size:>8} {step:<10} {result['seconds']:>10.3f} {result['requests']:>9} "
+                  f"{result['rate_limited']:>6} {result['peak_bytes'] / 1024 / 1024:>11.1f}")
+            for request in result["metrics"]["requests"]:
+                print(f"{'':>8} {'':<10} {request['method']} {request['endpoint']} {request['status']}: "
+                      f"{request['count']}")
+
+
+def measure_import_time(module="main") -> dict[str, tuple[int, int]]:
+    # Maps every module imported by the given module to its import depth and cumulative microseconds
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True,
+                            text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    matches = [IMPORT_TIME_PATTERN.match(line) for line in result.stderr.splitlines()]
+    entries = [(len(match.group(2)) // 2, int(match.group(1)), match.group(3)) for match in matches if match]
+    # -X importtime lists children before their parent, so the module's imports follow the previous top-level entry
+    end = next(i for i, (depth, _, name) in enumerate(entries) if depth == 0 and name == module)
+    start = max((i for i, (depth, _, _) in enumerate(entries[:end]) if depth == 0), default=-1) + 1
+    return {name: (depth, microseconds) for depth, microseconds, name in entries[start:end + 1]}
+
+
+def run_startup(repeats=5, module="main"):
+    runs = [measure_import_time(module) for _ in range(repeats)]
+    totals = [run[module][1] for run in runs]
+    print(f"import {module}: median {statistics.median(totals) / 1000:.1f} ms, min {min(totals) / 1000:.1f} ms "
+          f"over {repeats} runs")
+    direct_imports = sorted(((microseconds, name) for name, (depth, microseconds) in runs[-1].items() if depth == 1),
+                            reverse=True)
+    for microseconds, name in direct_imports[:10]:
+        print(f"{name:>24} {microseconds / 1000:>8.1f} ms")
+    print(f"Heavy modules imported: {', '.join(name for name in HEAVY_MODULES if name in runs[-1]) or 'none'}")
+
+
+class TestSuite(unittest.TestCase):
+    def test_main_import_defers_heavy_modules(self):
+        modules = measure_import_time()
+        self.assertIn("main", modules)
+        self.assertEqual([], [name for name in HEAVY_MODULES if name in modules])
+
+    def test_stub_run(self):
+        with StubEnvironment(100, changed_every=10, bucket_limit=3, bucket_window=0.02) as environment:
+            csv_result = measure_step(environment, environment.main.write_csv_file)
+            self.assertEqual(1, len(os.listdir(environment.report_directory.name)))
+            nick_result = measure_step(environment, environment.main.set_discord_nicknames)
+            # turns, players, mercs, one batch chunk, members and roles, then the bot id and one PATCH per change
+            self.assertEqual(6, csv_result["requests"])
+            self.assertEqual(11, nick_result["requests"] - nick_result["rate_limited"])
+            patched_nicks = [environment.discord_stub.members[synthetic_discord_id(i)]["nick"] for i in range(0, 100, 10)]
+            self.assertEqual([f"Player_{i} {environment.main.star_char * 3}" for i in range(0, 100, 10)], patched_nicks)
+        metrics.reset()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the CSV and nickname paths against synthetic rosters. "
+                                                 "Per-row times should stay flat as the size grows.")
+    parser.add_argument("sizes", nargs="*", type=int, help="Roster sizes to benchmark.")
+    parser.add_argument("-startup", "--startup", action="store_const", const=True, default=False,
+                        help="Measure how long importing main.py takes with -X importtime.")
+    parser.add_argument("-stubs", "--stubs", action="store_const", const=True, default=False,
+                        help="Run write_csv_file and set_discord_nicknames over HTTP against local stub servers "
+                             "and report wall time, request counts and peak memory.")
+    args = parser.parse_args()
+    if args.startup:
+        run_startup()
+    elif args.stubs:
+        run_stubs(args.sizes or [1000, 10000, 50000])
+    else:
+        run(args.sizes or [1000, 2000, 4000, 8000, 16000])
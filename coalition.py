@@ -0,0 +1,118 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from http_transport import DEFAULT_POOL_SIZE
+from logger import Logger
+from metrics import metrics
+from risk_api import RiskApi, RiskApiCache
+from settings_manager import SettingsManager
+
+
+def get_connection_pool_size(instance_settings: list) -> int:
+    # Every guild's write executor and roster paging share the default transport's one discord.com pool
+    return max(DEFAULT_POOL_SIZE, sum(settings.get_discord_max_concurrent_requests() + 1
+                                      for settings in instance_settings))
+
+
+class Coalition:
+    def __init__(self, mains: list):
+        self.mains = mains
+        self.logger = Logger()
+
+    def prefetch_risk_data(self):
+        # Every team shares one RiskApiCache, so fetching the union of the rosters once serves all of them
+        with metrics.phase("star caching"):
+            risk_api = self.mains[0].risk_api
+            risk_api.get_turns()
+            rosters = risk_api.map_concurrently(lambda main: main.risk_api.get_players_and_mercs(), self.mains)
+            if any(main.risk_api.player_snapshot is not None for main in self.mains):
+                return
+            names = list(dict.fromkeys(team_entry["player"] for players, mercs in rosters
+                                       for team_entry in players + mercs))
+            self.logger.log(f"Fetching {len(names)} distinct players for {len(self.mains)} teams.")
+            risk_api.get_batch_player_info(names)
+
+    def run(self, metrics_json=None, metrics_prometheus=None, **run_args):
+        self.prefetch_risk_data()
+        # Profiled phases must not overlap, so with -profile the guilds are updated one at a time
+        with ThreadPoolExecutor(max_workers=len(self.mains) if metrics.profiler is None else 1) as pool:
+            futures = [pool.submit(main.run_steps, **run_args) for main in self.mains]
+            for future in futures:
+                future.result()
+        self.mains[0].report_metrics(metrics_json, metrics_prometheus)
+
+
+class CountingRiskApi(RiskApi):
+    rosters = {"Aldi": ([{"team": "Aldi", "player": "EpicWolverine"}, {"team": "Aldi", "player": "user1"}],
+                        [{"team": "Aldi", "player": "Mautamu", "stars": 3}]),
+               "Texas A&M": ([{"team": "Texas A&M", "player": "Mautamu"}, {"team": "Texas A&M", "player": "Aggie"}], [])}
+
+    def __init__(self, settings, cache, requests):
+        super().__init__(settings, cache)
+        self.requests = requests
+
+    def _get_turns_api_data(self):
+        self.requests.append(("turns", None))
+        return [{"id": 1, "season": 1, "day": 1, "complete": True}, {"id": 2, "season": 1, "day": 2, "complete": False}]
+
+    def _request_api(self, endpoint, params=None):
+        self.requests.append((endpoint, params))
+        if endpoint in ("players", "mercs"):
+            return self.rosters[params["team"]][0 if endpoint == "players" else 1]
+        if endpoint == "players/batch":
+            return [{"name": name, "ratings": {"overall": 3}, "turns": []} for name in params["players"].split(",")]
+        raise ValueError(endpoint)
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        from discord_api import MockDiscordApi
+        from main import Main
+        settings = SettingsManager({"settings": {"team": "Aldi"},
+                                    "secrets": {"bot_token": "token", "guild_id": "1", "test_guild_id": "2"},
+                                    "instances": [{"team": "Aldi", "guild_id": "10"},
+                                                  {"team": "Texas A&M", "guild_id": "20"}]})
+        self.requests = []
+        cache = RiskApiCache()
+        self.mains = [Main(settings.for_instance(instance), cache) for instance in settings.get_instances()]
+        for i, main in enumerate(self.mains):
+            main.risk_api = CountingRiskApi(main.secrets, cache, self.requests)
+            main.discord_api = MockDiscordApi([{"user": {"id": str(100 + i), "username": "member", "discriminator": "0001"},
+                                               "nick": None, "roles": []}])
+            main.get_username_mapping = lambda: {"players": {"100": {"reddit": "user1"}, "101": {"reddit": "Aggie"}},
+                                                 "exclude": {}, "diplomats": {}}
+        self.cut = Coalition(self.mains)
+
+    def test_for_instance(self):
+        aldi, aggies = self.mains
+        self.assertEqual(("Aldi", "10"), (aldi.risk_api.team, aldi.secrets.get_secrets()["guild_id"]))
+        self.assertEqual(("Texas A&M", "20"), (aggies.risk_api.team, aggies.secrets.get_secrets()["guild_id"]))
+        self.assertEqual("Texas A&M", aggies.report_directory)
+        self.assertNotEqual(aldi.secrets.get_star_history_path(), aggies.secrets.get_star_history_path())
+
+    def test_connection_pool_size(self):
+        self.assertEqual(DEFAULT_POOL_SIZE, get_connection_pool_size([self.mains[0].secrets]))
+        self.assertEqual(18, get_connection_pool_size([main.secrets for main in self.mains]))
+        settings = SettingsManager({"settings": {"discord_max_concurrent_requests": 8},
+                                    "secrets": {"bot_token": "token", "guild_id": "1"},
+                                    "instances": [{"team": f"team{i}", "guild_id": str(i)} for i in range(4)]})
+        self.assertEqual(36, get_connection_pool_size([settings.for_instance(instance)
+                                                       for instance in settings.get_instances()]))
+
+    def test_shared_cache_fetches_each_player_once(self):
+        self.cut.prefetch_risk_data()
+        for main in self.mains:
+            main.cache_all_stars()
+        endpoints = [endpoint for endpoint, _ in self.requests]
+        self.assertEqual(1, endpoints.count("turns"))
+        self.assertEqual(2, endpoints.count("players"))
+        self.assertEqual(["EpicWolverine,user1,Mautamu,Aggie"],
+                         [params["players"] for endpoint, params in self.requests if endpoint == "players/batch"])
+        self.assertEqual({"EpicWolverine": 3, "user1": 3, "Mautamu": 3}, self.mains[0].stars)
+        self.assertEqual({"Mautamu": 3, "Aggie": 3}, self.mains[1].stars)
+
+    def test_run_processes_every_guild(self):
+        self.cut.run(write_csv=False, set_nicknames=True)
+        self.assertEqual([[{"nick": f"user1 {self.mains[0].star_char * 3}"}], [{"nick": f"Aggie {self.mains[1].star_char * 3}"}]],
+                         [[body for _, body in main.discord_api.patches] for main in self.mains])
+        self.assertEqual(1, len([endpoint for endpoint, _ in self.requests if endpoint == "players/batch"]))
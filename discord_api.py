@@ -1,34 +1,52 @@
-import requests
 import time
-import webbrowser
 import sys
+import unittest
+from urllib.parse import urlsplit
 
 from logger import Logger
+from metrics import metrics
 from settings_manager import SettingsManager
 
+DISCORD_API_BASE_URL = "https://discord.com/api/v9"
+
+
+def get_bot_auth_url(secrets: dict, api_base_url=DISCORD_API_BASE_URL) -> str:
+    return f"{api_base_url}/oauth2/authorize?client_id={secrets['client_id']}&scope=bot&permissions=134217728&guild_id={secrets['guild_id']}&disable_guild_select=true"
+
 
 class DiscordCache:
     def __init__(self):
         self.guild_members = None
+        self.guild_members_by_id = {}
         self.bot_id = None
         self.guild_roles = None
 
 
 class DiscordApi:
-    def __init__(self):
-        self.api_base_url = 'https://discord.com/api/v9'
-        self.secrets = SettingsManager().get_secrets()
+    def __init__(self, settings=None):
+        # requests is only imported once a client is actually needed, which keeps -auth and --help fast
+        from discord_executor import DiscordWriteExecutor
+        from http_transport import get_default_transport
+        self.api_base_url = DISCORD_API_BASE_URL
+        settings = settings or SettingsManager()
+        self.secrets = dict(settings.get_secrets())
         self.headers = {"Authorization": f"Bot {self.secrets['bot_token']}"}
         self.cache = DiscordCache()
         self.logger = Logger()
+        self.transport = get_default_transport()
+        self.gateway = None
+        self.write_executor = DiscordWriteExecutor(self.api_base_url, self.headers,
+                                                   settings.get_discord_max_concurrent_requests(),
+                                                   error_handler=self.check_error_response, transport=self.transport)
 
     def launch_bot_auth(self):
-        webbrowser.open(f"{self.api_base_url}/oauth2/authorize?client_id={self.secrets['client_id']}&scope=bot&permissions=134217728&guild_id={self.secrets['guild_id']}&disable_guild_select=true")
+        import webbrowser
+        webbrowser.open(get_bot_auth_url(self.secrets, self.api_base_url))
 
     def call_api_get(self, endpoint, params=None) -> dict:
         url = f"{self.api_base_url}/{endpoint}"
-        self.logger.log(f"Calling GET {url}")
-        r = requests.get(url, params=params, headers=self.headers)
+        self.logger.debug(f"Calling GET {url}")
+        r = self.transport.get(url, params=params, headers=self.headers)
         return self.check_response_and_retry(r, self.call_api_get, endpoint, params)
 
     def check_response_and_retry(self, r, func, *args):
@@ -36,53 +54,101 @@ class DiscordApi:
         try:
             r.raise_for_status()
         except Exception as e:
-            self.logger.log(response)
-            self.logger.log(e)
+            self.logger.error(response)
+            self.logger.error(e)
             if "retry_after" in response:
                 delay = response["retry_after"]
                 self.logger.log(f"Waiting {delay} seconds.")
                 time.sleep(delay)
+                metrics.record_rate_limit_sleep(urlsplit(self.api_base_url).netloc, delay)
                 response = func(*args)
-            if "message" in response:
-                if response["message"] in "Unknown Guild":  # code 10004
-                    self.logger.log(f"You have not authorized the bot with guild {self.secrets['guild_id']}. "
-                                    f"Run the script with -auth.")
-                    sys.exit(1)
-                if response["message"] in "Missing Permissions":  # code 50013
-                    self.logger.log(f"You revoked or denied the bot's \"Manage Nicknames\" permission. "
-                                    f"Restore this permission or kick and reauthorize the bot.")
-                    sys.exit(1)
-                if response["message"] in "Missing Access":  # code 50001
-                    self.logger.log("Enable the GUILD_MEMBERS Intent in your Bot settings on "
-                                    "the Discord Developer Portal.")
-                    sys.exit(1)
+            self.check_error_message(response)
         return response
 
+    def check_error_response(self, r, response):
+        self.logger.error(response)
+        self.logger.error(f"{r.status_code} Error for url: {r.url}")
+        self.check_error_message(response)
+
+    def check_error_message(self, response):
+        if "message" in response:
+            if response["message"] in "Unknown Guild":  # code 10004
+                self.logger.error(f"You have not authorized the bot with guild {self.secrets['guild_id']}. "
+                                f"Run the script with -auth.")
+                sys.exit(1)
+            if response["message"] in "Missing Permissions":  # code 50013
+                self.logger.error(f"You revoked or denied the bot's \"Manage Nicknames\" permission. "
+                                f"Restore this permission or kick and reauthorize the bot.")
+                sys.exit(1)
+            if response["message"] in "Missing Access":  # code 50001
+                self.logger.error("Enable the GUILD_MEMBERS Intent in your Bot settings on "
+                                "the Discord Developer Portal.")
+                sys.exit(1)
+
     def get_bot_id(self):
         if self.cache.bot_id is None:
             self.cache.bot_id = self.call_api_get(f"users/@me")['id']
         return self.cache.bot_id
 
     def get_guild_member(self, discord_id):
-        cached_member = next((item for item in self.cache.guild_members if item["user"]["id"] == discord_id), None)
+        cached_member = self.cache.guild_members_by_id.get(discord_id)
         if cached_member is None and discord_id:
             cached_member = self.call_api_get(f"guilds/{self.secrets['guild_id']}/members/{discord_id}")
             if "user" in cached_member:
-                self.cache.guild_members.append(cached_member)
+                self.add_guild_member(cached_member)
             else:
                 return
         return cached_member
 
+    def add_guild_member(self, member):
+        if self.cache.guild_members is None:
+            self.cache.guild_members = []
+        cached_member = self.cache.guild_members_by_id.get(member["user"]["id"])
+        if cached_member is None:
+            self.cache.guild_members.append(member)
+            self.cache.guild_members_by_id[member["user"]["id"]] = member
+        else:
+            cached_member.update(member)
+
+    def remove_guild_member(self, discord_id):
+        member = self.cache.guild_members_by_id.pop(discord_id, None)
+        if member is not None:
+            self.cache.guild_members = [cached_member for cached_member in self.cache.guild_members
+                                        if cached_member is not member]
+
+    def set_guild_members(self, members):
+        self.cache.guild_members = members
+        self.cache.guild_members_by_id = {member["user"]["id"]: member for member in members}
+
+    def use_gateway(self, gateway_url=None):
+        # websockets is only needed when the gateway member source is enabled
+        from gateway_members import GATEWAY_URL, GatewayMemberSync
+        self.gateway = GatewayMemberSync(self, gateway_url or GATEWAY_URL)
+
     def get_guild_members(self):
         if not self.cache.guild_members:
-            limit = 1000
-            self.cache.guild_members = self._call_api_get_guild_members(limit)
-            members_slice = self.cache.guild_members
-            while len(members_slice) == limit:
-                members_slice = self._call_api_get_guild_members(limit, members_slice[-1]["user"]["id"])
-                self.cache.guild_members += members_slice
+            with metrics.phase("member paging"):
+                if self.gateway is None or not self.gateway.load_members():
+                    self._page_guild_members()
         return self.cache.guild_members
 
+    def _page_guild_members(self):
+        limit = 1000
+        self.cache.guild_members = self._call_api_get_guild_members(limit)
+        members_slice = self.cache.guild_members
+        while len(members_slice) == limit:
+            members_slice = self._call_api_get_guild_members(limit, members_slice[-1]["user"]["id"])
+            self.cache.guild_members += members_slice
+        self.set_guild_members(self.cache.guild_members)
+
+    def invalidate_guild_members(self) -> bool:
+        if self.gateway is not None and self.gateway.is_listening():
+            # Gateway events already keep the cached members current
+            return False
+        self.cache.guild_members = None
+        self.cache.guild_members_by_id = {}
+        return True
+
     def _call_api_get_guild_members(self, limit=1, after="0"):
         params = {"limit": limit, "after": after}
         return self.call_api_get(f"guilds/{self.secrets['guild_id']}/members", params=params)
@@ -95,28 +161,120 @@ class DiscordApi:
             self.cache.guild_roles = self.call_api_get(f"guilds/{self.secrets['guild_id']}/roles")
         return self.cache.guild_roles
 
-    def call_api_patch(self, endpoint, body) -> dict:
-        url = f"{self.api_base_url}/{endpoint}"
-        self.logger.log(f"Calling PATCH {url}")
-        r = requests.patch(url, json=body, headers=self.headers)
-        # xratelimits = "\n".join([f"{key}: {r.headers[key]}" for key in r.headers.keys() if 'x-ratelimit' in key])
-        # self.logger.log(f"X-RateLimit Headers: {xratelimits}")
-        if int(r.headers["x-ratelimit-remaining"]) == 0:
-            delay = float(r.headers["x-ratelimit-reset-after"])
-            self.logger.log(f"X-RateLimit-Remaining is 0. Waiting {delay} seconds.")
-            time.sleep(delay)
-        return self.check_response_and_retry(r, self.call_api_patch, endpoint, body)
-
-    def set_nickname(self, discord_id, nickname):
+    def call_api_patch(self, endpoint, body, deadline=None):
+        return self.write_executor.request("PATCH", endpoint, body, deadline)
+
+    def set_nickname(self, discord_id, nickname, deadline=None):
         self.logger.log(f"Setting {discord_id} to \"{nickname}\"")
         url = f"guilds/{self.secrets['guild_id']}/members/{discord_id}"
         body = {"nick": nickname}
-        return self.call_api_patch(url, body)
+        response = self.call_api_patch(url, body, deadline)
+        if response is None:
+            self.logger.log(f"Skipped {discord_id}: the time budget ran out while waiting for the rate limit.")
+            return None
+        cached_member = self.cache.guild_members_by_id.get(discord_id)
+        if cached_member is not None and "user" in response:
+            cached_member["nick"] = response.get("nick")
+        return response
+
+    def set_nicknames(self, nicknames: dict[str, str], on_success=None, deadline=None) -> list[dict]:
+        # Updates are started in the order given. Any that cannot be sent by the time.monotonic() deadline, including
+        # ones still waiting on a rate limit, are skipped and return None.
+        def set_and_report(discord_id, nickname):
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            response = self.set_nickname(discord_id, nickname, deadline)
+            if on_success is not None and response is not None and "user" in response:
+                on_success(discord_id, nickname)
+            return response
+        return self.write_executor.map(set_and_report, list(nicknames.items()))
 
     def use_test_guild(self):
         self.secrets["guild_id"] = self.secrets["test_guild_id"]
 
 
+class MockDiscordApi(DiscordApi):
+    def __init__(self, members=None):
+        super().__init__()
+        self.members = members if members is not None else [
+            {"user": {"id": "1234567890", "username": "not me", "discriminator": "3742"}, "nick": None, "roles": ["1"]},
+            {"user": {"id": "098765321", "username": "not me", "discriminator": "7682"}, "nick": "other other name", "roles": []},
+            {"user": {"id": "140174746485653504", "username": "EpicWolverine", "discriminator": "3742"}, "nick": None, "roles": ["1"]},
+        ]
+        self.members_by_id = {}
+        self.call_api_get_access_count = 0
+        self.patches = []
+
+    def call_api_get(self, endpoint, params=None) -> dict:
+        self.call_api_get_access_count += 1
+        if endpoint == "users/@me":
+            return {"id": "999"}
+        if endpoint.endswith("/roles"):
+            return [{"id": "1", "name": "Wolverine"}]
+        if endpoint.endswith("/members"):
+            members = sorted(self.members, key=lambda member: int(member["user"]["id"]))
+            after = int(params["after"])
+            return [member for member in members if int(member["user"]["id"]) > after][:params["limit"]]
+        discord_id = endpoint.rsplit("/", 1)[-1]
+        member = self.find_member(discord_id)
+        return member if member is not None else {"message": "Unknown Member", "code": 10007}
+
+    def find_member(self, discord_id):
+        if len(self.members_by_id) != len(self.members):
+            self.members_by_id = {member["user"]["id"]: member for member in self.members}
+        return self.members_by_id.get(discord_id)
+
+    def call_api_patch(self, endpoint, body, deadline=None) -> dict:
+        self.patches.append((endpoint, body))
+        discord_id = endpoint.rsplit("/", 1)[-1]
+        member = self.find_member(discord_id)
+        if member is None:
+            return {"message": "Unknown Member", "code": 10007}
+        return member | body
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cut = MockDiscordApi()
+
+    def test_get_guild_members_paging(self):
+        self.cut.members = [{"user": {"id": str(i)}, "roles": []} for i in range(1, 2501)]
+        self.assertEqual(2500, len(self.cut.get_guild_members()))
+        self.assertEqual(3, self.cut.call_api_get_access_count)
+        self.assertEqual(2500, len(self.cut.cache.guild_members_by_id))
+
+    def test_get_guild_member_uses_index(self):
+        self.cut.get_guild_members()
+        access_count = self.cut.call_api_get_access_count
+        self.assertEqual("EpicWolverine", self.cut.get_guild_member("140174746485653504")["user"]["username"])
+        self.assertEqual(access_count, self.cut.call_api_get_access_count)
+
+    def test_get_guild_member_fetches_and_indexes(self):
+        self.cut.get_guild_members()
+        self.cut.members.append({"user": {"id": "555", "username": "late", "discriminator": "0001"}, "roles": []})
+        self.assertEqual("late", self.cut.get_guild_member("555")["user"]["username"])
+        self.assertEqual("late", self.cut.get_guild_member("555")["user"]["username"])
+        self.assertEqual(2, self.cut.call_api_get_access_count)
+        self.assertIn("555", self.cut.get_guild_member_ids())
+
+    def test_invalidate_guild_members(self):
+        self.cut.get_guild_members()
+        self.cut.members = [member | {} for member in self.cut.members[1:]]
+        self.cut.members[1]["nick"] = "Epic"
+        self.cut.members.append({"user": {"id": "555", "username": "late", "discriminator": "0001"}, "roles": []})
+        self.assertTrue(self.cut.invalidate_guild_members())
+        self.assertEqual(1, self.cut.call_api_get_access_count)
+        self.assertEqual(3, len(self.cut.get_guild_member_ids()))
+        self.assertEqual(2, self.cut.call_api_get_access_count)
+        self.assertEqual("Epic", self.cut.get_guild_member("140174746485653504")["nick"])
+        self.assertIsNone(self.cut.cache.guild_members_by_id.get("1234567890"))
+
+    def test_get_guild_member_unknown(self):
+        self.cut.get_guild_members()
+        self.assertIsNone(self.cut.get_guild_member("404"))
+        self.assertIsNone(self.cut.get_guild_member(""))
+
+
 if __name__ == "__main__":
     logger = Logger()
     api = DiscordApi()
@@ -0,0 +1,246 @@
+import collections
+import threading
+import time
+import unittest
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+
+import requests
+
+from http_transport import HttpTransport, get_default_transport
+from logger import Logger
+from metrics import metrics
+
+MAJOR_PARAMETERS = ("channels", "guilds", "webhooks")
+
+
+def get_route(method: str, endpoint: str) -> str:
+    parts = endpoint.split("/")
+    for i, part in enumerate(parts):
+        if part.isdigit() and (i == 0 or parts[i - 1] not in MAJOR_PARAMETERS):
+            parts[i] = ":id"
+    return f"{method} {'/'.join(parts)}"
+
+
+class RateLimitBucket:
+    def __init__(self):
+        # Until the first response reports the real limits, only one request may probe the bucket
+        self.limit = 1
+        self.remaining = 1
+        self.reset_at = None
+        self.known = False
+
+
+class DiscordWriteExecutor:
+    def __init__(self, api_base_url, headers, max_workers=8, global_limit=50, error_handler=None, transport=None):
+        self.api_base_url = api_base_url
+        self.headers = headers
+        self.max_workers = max_workers
+        self.global_limit = global_limit
+        self.error_handler = error_handler
+        self.condition = threading.Condition()
+        self.route_buckets = {}
+        self.buckets = {}
+        self.global_reset_at = 0.0
+        self.global_window = collections.deque()
+        self.transport = transport if transport is not None else get_default_transport()
+        self.pool = None
+        self.logger = Logger()
+        self.rate_limited_count = 0
+        self.rate_limit_waiters = 0
+        self.rate_limit_wait_started = None
+
+    def get_bucket(self, route: str) -> RateLimitBucket:
+        bucket_id = self.route_buckets.get(route, route)
+        if bucket_id not in self.buckets:
+            self.buckets[bucket_id] = RateLimitBucket()
+        return self.buckets[bucket_id]
+
+    def acquire(self, route: str, deadline=None) -> bool:
+        # Gives up and returns False rather than wait for a slot past the time.monotonic() deadline
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                bucket = self.get_bucket(route)
+                if bucket.reset_at is not None and now >= bucket.reset_at:
+                    bucket.remaining = bucket.limit
+                    bucket.reset_at = None
+                while self.global_window and now - self.global_window[0] >= 1:
+                    self.global_window.popleft()
+                if now < self.global_reset_at:
+                    wait_until = self.global_reset_at
+                elif len(self.global_window) >= self.global_limit:
+                    wait_until = self.global_window[0] + 1
+                elif bucket.remaining <= 0:
+                    wait_until = bucket.reset_at
+                else:
+                    bucket.remaining -= 1
+                    self.global_window.append(now)
+                    return True
+                if deadline is not None and (now >= deadline or (wait_until is not None and wait_until >= deadline)):
+                    return False
+                # Without a known reset time, wait for an in-flight response to report one
+                timeout = None if wait_until is None else max(wait_until - now, 0)
+                if deadline is not None:
+                    timeout = deadline - now if timeout is None else min(timeout, deadline - now)
+                if wait_until is None:
+                    self.condition.wait(timeout)
+                    continue
+                self.begin_rate_limit_wait(now)
+                self.condition.wait(timeout)
+                self.end_rate_limit_wait(time.monotonic())
+
+    def begin_rate_limit_wait(self, now: float):
+        # Workers blocked at the same time are one stretch of wall-clock time, so it is only recorded once all of
+        # them are released. Waits on a bucket's first response are not rate limits and are left out.
+        if self.rate_limit_waiters == 0:
+            self.rate_limit_wait_started = now
+        self.rate_limit_waiters += 1
+
+    def end_rate_limit_wait(self, now: float):
+        self.rate_limit_waiters -= 1
+        if self.rate_limit_waiters == 0:
+            metrics.record_rate_limit_sleep(urlsplit(self.api_base_url).netloc, now - self.rate_limit_wait_started)
+
+    def release(self, route: str):
+        with self.condition:
+            self.get_bucket(route).remaining += 1
+            self.condition.notify_all()
+
+    def update(self, route: str, r: requests.Response):
+        with self.condition:
+            now = time.monotonic()
+            bucket_id = r.headers.get("X-RateLimit-Bucket")
+            if bucket_id and self.route_buckets.get(route) != bucket_id:
+                self.buckets.pop(self.route_buckets.get(route, route), None)
+                self.route_buckets[route] = bucket_id
+            bucket = self.get_bucket(route)
+            if "X-RateLimit-Remaining" in r.headers:
+                remaining = int(r.headers["X-RateLimit-Remaining"])
+                bucket.limit = int(r.headers["X-RateLimit-Limit"])
+                bucket.remaining = min(bucket.remaining, remaining) if bucket.known else remaining
+                bucket.reset_at = now + float(r.headers["X-RateLimit-Reset-After"])
+                bucket.known = True
+            elif r.status_code != 429:
+                bucket.remaining += 1
+            if r.status_code == 429:
+                response = r.json()
+                retry_after = float(response.get("retry_after", r.headers.get("Retry-After", 1)))
+                self.rate_limited_count += 1
+                self.logger.warning(f"Rate limited on {route}. Retrying after {retry_after} seconds.")
+                if response.get("global") or r.headers.get("X-RateLimit-Global"):
+                    self.global_reset_at = max(self.global_reset_at, now + retry_after)
+                else:
+                    bucket.remaining = 0
+                    bucket.reset_at = now + retry_after
+            self.condition.notify_all()
+
+    def request(self, method: str, endpoint: str, body=None, deadline=None):
+        url = f"{self.api_base_url}/{endpoint}"
+        route = get_route(method, endpoint)
+        while True:
+            if not self.acquire(route, deadline):
+                return None
+            self.logger.debug(f"Calling {method} {url}")
+            try:
+                r = self.transport.request(method, url, json=body, headers=self.headers)
+            except requests.RequestException:
+                self.release(route)
+                raise
+            self.update(route, r)
+            if r.status_code != 429:
+                break
+        response = r.json() if r.content else {}
+        if not r.ok and self.error_handler is not None:
+            self.error_handler(r, response)
+        return response
+
+    def map(self, func, items: list) -> list:
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="discord-write")
+        futures = [self.pool.submit(func, *item) for item in items]
+        wait(futures, return_when=FIRST_EXCEPTION)
+        failed = next((future for future in futures if future.done() and future.exception() is not None), None)
+        if failed is not None:
+            # A fatal error such as Missing Permissions would fail every queued request the same way, so those are
+            # cancelled before they are sent. Requests already in flight finish first.
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+            failed.result()
+        return [future.result() for future in futures]
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        from stub_servers import DiscordStubServer
+        self.stub = DiscordStubServer(bucket_limit=5, bucket_window=0.5, latency=0.02)
+        self.base_url = self.stub.api_base_url(self.stub.start())
+        self.cut = DiscordWriteExecutor(self.base_url, {}, max_workers=8, transport=HttpTransport(timeout=5))
+
+    def tearDown(self) -> None:
+        self.stub.stop()
+
+    def patch_nicknames(self, count: int) -> list[dict]:
+        items = [("PATCH", f"guilds/1/members/{i}", {"nick": f"user{i}"}) for i in range(count)]
+        return self.cut.map(self.cut.request, items)
+
+    def test_fatal_error_cancels_queued_requests(self):
+        self.cut.max_workers = 2
+        started = []
+
+        def patch(i):
+            started.append(i)
+            if i == 1:
+                raise SystemExit(1)
+            time.sleep(0.05)
+            return i
+
+        with self.assertRaises(SystemExit):
+            self.cut.map(patch, [(i,) for i in range(20)])
+        self.assertLess(len(started), 5)
+        self.assertEqual([0, 1, 2], self.cut.map(lambda i: i, [(i,) for i in range(3)]))
+
+    def test_deadline_stops_waiting_for_rate_limits(self):
+        start = time.monotonic()
+        items = [("PATCH", f"guilds/1/members/{i}", {"nick": f"user{i}"}, start + 0.2) for i in range(20)]
+        responses = self.cut.map(self.cut.request, items)
+        self.assertLess(time.monotonic() - start, 0.45)
+        self.assertEqual(self.stub.request_count, len([response for response in responses if response is not None]))
+        self.assertLessEqual(self.stub.request_count, 5)
+        self.assertEqual(0, self.stub.rate_limited_count)
+
+    def test_get_route(self):
+        self.assertEqual("PATCH guilds/123/members/:id", get_route("PATCH", "guilds/123/members/456"))
+        self.assertEqual("GET users/@me", get_route("GET", "users/@me"))
+
+    def test_respects_bucket_limits(self):
+        metrics.reset()
+        start = time.monotonic()
+        responses = self.patch_nicknames(20)
+        elapsed = time.monotonic() - start
+        self.assertEqual([f"user{i}" for i in range(20)], [response["nick"] for response in responses])
+        self.assertEqual(0, self.stub.rate_limited_count)
+        self.assertEqual(20, self.stub.request_count)
+        self.assertGreater(self.stub.max_in_flight, 1)
+        self.assertGreaterEqual(elapsed, 1.5)
+        # Eight workers waiting on the same bucket count its wait once
+        slept = metrics.rate_limit_sleep_seconds[urlsplit(self.base_url).netloc]
+        self.assertGreater(slept, 0)
+        self.assertLessEqual(slept, elapsed)
+
+    def test_retries_429_without_headers(self):
+        self.stub.send_rate_limit_headers = False
+        self.cut.max_workers = 4
+        responses = self.patch_nicknames(12)
+        self.assertEqual([f"user{i}" for i in range(12)], [response["nick"] for response in responses])
+        self.assertGreater(self.stub.rate_limited_count, 0)
+        self.assertEqual(self.stub.rate_limited_count, self.cut.rate_limited_count)
+
+    def test_global_limit(self):
+        self.stub.bucket_limit = 100
+        self.stub.global_limit = 6
+        self.cut.global_limit = 6
+        start = time.monotonic()
+        responses = self.patch_nicknames(12)
+        self.assertEqual([f"user{i}" for i in range(12)], [response["nick"] for response in responses])
+        self.assertGreaterEqual(time.monotonic() - start, 1)
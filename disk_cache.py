@@ -0,0 +1,113 @@
+import json
+import sqlite3
+import threading
+import time
+import unittest
+
+DEFAULT_CACHE_PATH = "risk_cache.sqlite3"
+
+
+class DiskCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entries "
+                                    "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                                    "last_access REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+
+    @staticmethod
+    def make_key(endpoint: str, params=None) -> str:
+        return json.dumps([endpoint, params], sort_keys=True)
+
+    def get(self, key: str):
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value):
+        data = json.dumps(value)
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO entries (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                                    (key, data, len(data), time.time()))
+            self._evict()
+
+    def _evict(self):
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self.connection.execute("SELECT key, size FROM entries ORDER BY last_access"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self.connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+
+    def get_metadata(self, key: str):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set_metadata(self, key: str, value):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
+                                    (key, json.dumps(value)))
+
+    def set_turn_id(self, turn_id: int) -> bool:
+        if self.get_metadata("turn_id") == turn_id:
+            return False
+        self.clear()
+        self.set_metadata("turn_id", turn_id)
+        return True
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM entries")
+
+    def get_size(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cut = DiskCache(":memory:", max_bytes=100)
+
+    def tearDown(self) -> None:
+        self.cut.close()
+
+    def test_get_set(self):
+        key = DiskCache.make_key("players", {"team": "Aldi"})
+        self.assertIsNone(self.cut.get(key))
+        self.cut.set(key, [{"player": "EpicWolverine"}])
+        self.assertEqual([{"player": "EpicWolverine"}], self.cut.get(key))
+        self.assertEqual(key, DiskCache.make_key("players", {"team": "Aldi"}))
+
+    def test_lru_eviction(self):
+        self.cut.set("a", "x" * 40)
+        self.cut.set("b", "x" * 40)
+        self.cut.get("a")
+        self.cut.set("c", "x" * 40)
+        self.assertIsNotNone(self.cut.get("a"))
+        self.assertIsNone(self.cut.get("b"))
+        self.assertIsNotNone(self.cut.get("c"))
+        self.assertLessEqual(self.cut.get_size(), 100)
+
+    def test_turn_invalidation(self):
+        self.assertTrue(self.cut.set_turn_id(19))
+        self.cut.set("a", 1)
+        self.assertFalse(self.cut.set_turn_id(19))
+        self.assertEqual(1, self.cut.get("a"))
+        self.assertTrue(self.cut.set_turn_id(20))
+        self.assertIsNone(self.cut.get("a"))
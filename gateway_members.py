@@ -0,0 +1,204 @@
+import json
+import random
+import sys
+import threading
+import time
+import unittest
+import uuid
+
+from websockets.exceptions import WebSocketException
+from websockets.sync.client import connect
+
+from logger import Logger
+
+GATEWAY_URL = "wss://gateway.discord.gg/?v=10&encoding=json"
+GUILDS_INTENT = 1 << 0
+GUILD_MEMBERS_INTENT = 1 << 1
+DISPATCH = 0
+HEARTBEAT = 1
+IDENTIFY = 2
+RECONNECT = 7
+REQUEST_GUILD_MEMBERS = 8
+INVALID_SESSION = 9
+HELLO = 10
+HEARTBEAT_ACK = 11
+MEMBER_EVENTS = ("GUILD_MEMBER_ADD", "GUILD_MEMBER_UPDATE", "GUILD_MEMBER_REMOVE")
+
+
+class GatewayMemberSync:
+    def __init__(self, discord_api, gateway_url=GATEWAY_URL, timeout=30):
+        self.discord_api = discord_api
+        self.gateway_url = gateway_url
+        self.timeout = timeout
+        self.connection = None
+        self.sequence = None
+        self.listener = None
+        self.loaded = threading.Event()
+        self.closed = threading.Event()
+        self.error = None
+        self.logger = Logger()
+
+    def is_listening(self) -> bool:
+        return self.listener is not None and self.listener.is_alive() and self.loaded.is_set() and self.error is None
+
+    def load_members(self) -> bool:
+        # One thread owns the connection: it loads the roster, then keeps applying member events to it
+        self.loaded.clear()
+        self.closed.clear()
+        self.error = None
+        self.listener = threading.Thread(target=self.run_session, name="gateway-listener", daemon=True)
+        self.listener.start()
+        if not self.loaded.wait(self.timeout) or self.error is not None:
+            self.logger.warning(f"Gateway member sync failed. Falling back to REST paging: {self.error or 'timed out'}")
+            self.close()
+            return False
+        self.logger.log(f"Loaded {len(self.discord_api.cache.guild_members)} guild members over the gateway.")
+        return True
+
+    def run_session(self):
+        try:
+            with connect(self.gateway_url, open_timeout=self.timeout, max_size=None) as connection:
+                self.connection = connection
+                self.identify()
+                members, pending_events = self.request_members()
+                if self.closed.is_set():
+                    return
+                self.discord_api.set_guild_members(members)
+                for event, data in pending_events:
+                    self.apply_event(event, data)
+                self.loaded.set()
+                self.listen()
+        except (OSError, TimeoutError, WebSocketException, ValueError, KeyError) as e:
+            if not self.loaded.is_set():
+                self.error = e
+                self.loaded.set()
+            elif not self.closed.is_set():
+                self.logger.warning(f"Gateway connection lost. Guild members will be refreshed over REST: {e}")
+        finally:
+            self.closed.set()
+
+    def identify(self):
+        hello = self.receive()
+        if hello["op"] != HELLO:
+            raise ValueError(f"Expected Hello from the gateway, got op {hello['op']}")
+        threading.Thread(target=self.send_heartbeats, args=(hello["d"]["heartbeat_interval"] / 1000,),
+                         name="gateway-heartbeat", daemon=True).start()
+        self.send(IDENTIFY, {"token": self.discord_api.secrets["bot_token"],
+                             "intents": GUILDS_INTENT | GUILD_MEMBERS_INTENT,
+                             "properties": {"os": sys.platform, "browser": "CFBRiskMoveTracker",
+                                            "device": "CFBRiskMoveTracker"}})
+
+    def request_members(self) -> tuple[list[dict], list[tuple[str, dict]]]:
+        guild_id = self.discord_api.secrets["guild_id"]
+        nonce = uuid.uuid4().hex
+        members = []
+        pending_events = []
+        while True:
+            payload = self.receive()
+            if payload["op"] in (RECONNECT, INVALID_SESSION):
+                raise ValueError(f"Gateway closed the session with op {payload['op']}")
+            if payload["op"] != DISPATCH:
+                continue
+            event, data = payload["t"], payload["d"]
+            if event == "READY":
+                # limit 0 with an empty query asks for every member in chunks of up to 1000
+                self.send(REQUEST_GUILD_MEMBERS, {"guild_id": guild_id, "query": "", "limit": 0, "nonce": nonce})
+            elif event == "GUILD_MEMBERS_CHUNK" and data.get("nonce") == nonce:
+                members += data["members"]
+                if data["chunk_index"] + 1 >= data["chunk_count"]:
+                    return members, pending_events
+            elif event in MEMBER_EVENTS and data.get("guild_id") == guild_id:
+                pending_events.append((event, data))
+
+    def listen(self):
+        guild_id = self.discord_api.secrets["guild_id"]
+        while not self.closed.is_set():
+            payload = self.receive(timeout=None)
+            if payload["op"] in (RECONNECT, INVALID_SESSION):
+                raise ValueError(f"Gateway closed the session with op {payload['op']}")
+            if payload["op"] == DISPATCH and payload["t"] in MEMBER_EVENTS and payload["d"].get("guild_id") == guild_id:
+                self.apply_event(payload["t"], payload["d"])
+
+    def apply_event(self, event: str, data: dict):
+        if event == "GUILD_MEMBER_REMOVE":
+            self.discord_api.remove_guild_member(data["user"]["id"])
+        else:
+            self.discord_api.add_guild_member({key: value for key, value in data.items() if key != "guild_id"})
+
+    def receive(self, timeout=-1) -> dict:
+        payload = json.loads(self.connection.recv(self.timeout if timeout == -1 else timeout))
+        if payload.get("s") is not None:
+            self.sequence = payload["s"]
+        return payload
+
+    def send(self, op: int, data):
+        self.connection.send(json.dumps({"op": op, "d": data}))
+
+    def send_heartbeats(self, interval: float):
+        # The first heartbeat is jittered as the gateway asks
+        delay = interval * random.random()
+        while not self.closed.wait(delay):
+            try:
+                self.send(HEARTBEAT, self.sequence)
+            except (OSError, WebSocketException):
+                return
+            delay = interval
+
+    def close(self):
+        self.closed.set()
+        if self.connection is not None:
+            self.connection.close()
+
+
+def wait_for(condition, timeout=5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        from discord_api import MockDiscordApi
+        from stub_servers import GatewayStubServer
+        self.discord_api = MockDiscordApi([])
+        self.guild_id = self.discord_api.secrets["guild_id"]
+        self.stub = GatewayStubServer(self.guild_id, [{"user": {"id": str(i), "username": f"member{i}"}, "nick": None,
+                                                       "roles": []} for i in range(1, 2501)])
+        self.discord_api.use_gateway(self.stub.start())
+        self.discord_api.gateway.timeout = 5
+
+    def tearDown(self) -> None:
+        self.discord_api.gateway.close()
+        self.stub.stop()
+
+    def test_loads_members_over_one_connection(self):
+        self.assertEqual(2500, len(self.discord_api.get_guild_members()))
+        self.assertEqual("member2500", self.discord_api.get_guild_member("2500")["user"]["username"])
+        self.assertEqual(0, self.discord_api.call_api_get_access_count)
+        self.assertEqual(1, self.stub.connection_count)
+        self.assertEqual(GUILD_MEMBERS_INTENT, self.stub.identify["intents"] & GUILD_MEMBERS_INTENT)
+
+    def test_applies_member_events(self):
+        self.discord_api.get_guild_members()
+        self.stub.broadcast("GUILD_MEMBER_ADD", {"user": {"id": "5000", "username": "late"}, "nick": None, "roles": []})
+        self.stub.broadcast("GUILD_MEMBER_UPDATE", {"user": {"id": "1", "username": "member1"}, "nick": "Epic",
+                                                    "roles": ["1"]})
+        self.stub.broadcast("GUILD_MEMBER_REMOVE", {"user": {"id": "2", "username": "member2"}})
+        self.assertTrue(wait_for(lambda: "2" not in self.discord_api.cache.guild_members_by_id))
+        self.assertEqual("late", self.discord_api.get_guild_member("5000")["user"]["username"])
+        self.assertEqual("Epic", self.discord_api.get_guild_member("1")["nick"])
+        self.assertNotIn("guild_id", self.discord_api.get_guild_member("1"))
+        self.assertEqual(2500, len(self.discord_api.get_guild_members()))
+        self.assertFalse(self.discord_api.invalidate_guild_members())
+        self.assertEqual(2500, len(self.discord_api.get_guild_members()))
+        self.assertEqual(0, self.discord_api.call_api_get_access_count)
+
+    def test_falls_back_to_rest(self):
+        self.discord_api.members = [{"user": {"id": "1", "username": "rest"}, "roles": []}]
+        self.discord_api.gateway.gateway_url = "ws://127.0.0.1:9"
+        self.assertEqual(["1"], self.discord_api.get_guild_member_ids())
+        self.assertEqual(1, self.discord_api.call_api_get_access_count)
+        self.assertFalse(self.discord_api.gateway.is_listening())
@@ -0,0 +1,119 @@
+import threading
+import time
+import unittest
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import Metrics, metrics as default_metrics
+
+RETRY_STATUSES = (500, 502, 503, 504)
+DEFAULT_POOL_SIZE = 16
+
+
+class HttpTransport:
+    def __init__(self, timeout=30, retries=3, backoff_factor=0.5, pool_size=DEFAULT_POOL_SIZE, metrics=None):
+        self.timeout = timeout
+        self.metrics = metrics if metrics is not None else default_metrics
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, url: str) -> requests.Session:
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                self.sessions[host] = self._create_session()
+            return self.sessions[host]
+
+    def _create_session(self) -> requests.Session:
+        # 429s are left to the callers since Discord reports its own retry_after
+        retry = Retry(total=self.retries, backoff_factor=self.backoff_factor, status_forcelist=RETRY_STATUSES,
+                      allowed_methods=frozenset({"GET", "PATCH"}), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["Accept-Encoding"] = "gzip, deflate"
+        return session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        try:
+            r = self.get_session(url).request(method, url, **kwargs)
+        except requests.RequestException:
+            self.metrics.record_request(method, url, "error", time.perf_counter() - start, 0)
+            raise
+        # Reading a streamed body here would buffer all of it, so its size comes from the headers
+        size = int(r.headers.get("Content-Length", 0)) if kwargs.get("stream") else len(r.content)
+        self.metrics.record_request(method, url, r.status_code, time.perf_counter() - start, size)
+        return r
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def patch(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PATCH", url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+default_transport = None
+
+
+def get_default_transport() -> HttpTransport:
+    global default_transport
+    if default_transport is None:
+        default_transport = HttpTransport()
+    return default_transport
+
+
+def set_default_transport(transport: HttpTransport):
+    global default_transport
+    default_transport = transport
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        from stub_servers import FlakyStubServer
+        self.stub = FlakyStubServer(failures=2)
+        self.base_url = self.stub.start()
+        self.cut = HttpTransport(timeout=5, retries=3, backoff_factor=0.01, metrics=Metrics())
+
+    def tearDown(self) -> None:
+        self.cut.close()
+        self.stub.stop()
+
+    def test_retries_server_errors(self):
+        r = self.cut.get(f"{self.base_url}/api/players")
+        self.assertEqual(200, r.status_code)
+        self.assertEqual({"ok": True}, r.json())
+        self.assertEqual(3, self.stub.request_count)
+        requests_report = self.cut.metrics.to_dict()["requests"]
+        self.assertEqual([("/api/players", "200", 1)],
+                         [(request["endpoint"], request["status"], request["count"]) for request in requests_report])
+
+    def test_keep_alive(self):
+        self.stub.failures = 0
+        for _ in range(5):
+            self.cut.get(f"{self.base_url}/api/players")
+        self.assertEqual(5, self.stub.request_count)
+        self.assertEqual(1, len(self.stub.client_ports))
+
+    def test_gives_up_after_retries(self):
+        self.stub.failures = 10
+        self.assertEqual(503, self.cut.get(f"{self.base_url}/api/players").status_code)
+        self.assertEqual(4, self.stub.request_count)
+
+    def test_one_session_per_host(self):
+        self.assertIs(self.cut.get_session(f"{self.base_url}/a"), self.cut.get_session(f"{self.base_url}/b"))
+        self.assertIsNot(self.cut.get_session(f"{self.base_url}/a"), self.cut.get_session("https://discord.com/api"))
@@ -1,15 +1,186 @@
+import atexit
+import json
+import os
 import sys
+import tempfile
+import threading
+import time
+import unittest
 from datetime import datetime
 
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+FLUSH_INTERVAL_SECONDS = 1.0
+
+
+def configure_streams():
+    for stream in (sys.stdin, sys.stdout):
+        # Test runners replace the standard streams with objects that cannot be reconfigured
+        if hasattr(stream, "reconfigure"):
+            stream.reconfigure(encoding='utf-8')
+
+
+class LogSink:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding='utf-8', buffering=64 * 1024)
+        self.dirty = False
+
+    def write(self, line: str, flush=False):
+        with self.lock:
+            self.file.write(line + '\n')
+            self.dirty = True
+            if flush:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.dirty and not self.file.closed:
+            self.file.flush()
+            self.dirty = False
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.file.close()
+
 
 class Logger:
+    level = INFO
+    json_format = False
+    sinks = {}
+    sinks_lock = threading.Lock()
+    flush_thread = None
+
     def __init__(self, log_path="script.log"):
         self.log_path = log_path
 
-    def log(self, message):
-        sys.stdin.reconfigure(encoding='utf-8')
-        sys.stdout.reconfigure(encoding='utf-8')
-        log_line = f"{datetime.utcnow().isoformat()} {message}"
+    @classmethod
+    def configure(cls, level=None, json_format=None):
+        if level is not None:
+            cls.level = LEVELS[level.upper()] if isinstance(level, str) else level
+        if json_format is not None:
+            cls.json_format = json_format
+
+    @classmethod
+    def get_sink(cls, path: str) -> LogSink:
+        sink = cls.sinks.get(path)
+        if sink is None:
+            with cls.sinks_lock:
+                sink = cls.sinks.get(path)
+                if sink is None:
+                    sink = cls.sinks[path] = LogSink(path)
+                    cls.start_flush_thread()
+        return sink
+
+    @classmethod
+    def start_flush_thread(cls):
+        if cls.flush_thread is None:
+            cls.flush_thread = threading.Thread(target=cls.flush_periodically, name="logger-flush", daemon=True)
+            cls.flush_thread.start()
+            atexit.register(cls.flush_all)
+
+    @classmethod
+    def flush_periodically(cls):
+        while True:
+            time.sleep(FLUSH_INTERVAL_SECONDS)
+            cls.flush_all()
+
+    @classmethod
+    def flush_all(cls):
+        for sink in list(cls.sinks.values()):
+            sink.flush()
+
+    @classmethod
+    def close_all(cls):
+        with cls.sinks_lock:
+            for sink in cls.sinks.values():
+                sink.close()
+            cls.sinks = {}
+
+    def format(self, message, level: int, fields: dict) -> str:
+        timestamp = datetime.utcnow().isoformat()
+        if self.json_format:
+            return json.dumps({"time": timestamp, "level": LEVEL_NAMES[level], "message": message, **fields},
+                              ensure_ascii=False, default=str)
+        extra = "".join(f" {key}={value}" for key, value in fields.items())
+        if level == INFO:
+            return f"{timestamp} {message}{extra}"
+        return f"{timestamp} {LEVEL_NAMES[level]} {message}{extra}"
+
+    def log(self, message, level=INFO, **fields):
+        if level < self.level:
+            return
+        log_line = self.format(message, level, fields)
         print(log_line)
-        with open(self.log_path, "a", encoding='utf-8') as file:
-            file.write(log_line + '\n')
+        self.get_sink(self.log_path).write(log_line, flush=level >= ERROR)
+
+    def debug(self, message, **fields):
+        self.log(message, DEBUG, **fields)
+
+    def info(self, message, **fields):
+        self.log(message, INFO, **fields)
+
+    def warning(self, message, **fields):
+        self.log(message, WARNING, **fields)
+
+    def error(self, message, **fields):
+        self.log(message, ERROR, **fields)
+
+
+configure_streams()
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "script.log")
+        self.cut = Logger(self.path)
+        self.level, self.json_format = Logger.level, Logger.json_format
+
+    def tearDown(self) -> None:
+        Logger.configure(self.level, self.json_format)
+        self.cut.get_sink(self.path).close()
+        del Logger.sinks[self.path]
+        self.directory.cleanup()
+
+    def read_lines(self) -> list[str]:
+        Logger.flush_all()
+        with open(self.path, 'r', encoding='utf-8') as file:
+            return file.read().splitlines()
+
+    def test_shares_one_handle(self):
+        self.cut.log("first")
+        Logger(self.path).log("second")
+        self.assertEqual(1, len([path for path in Logger.sinks if path == self.path]))
+        self.assertEqual(["first", "second"], [line.split(" ", 1)[1] for line in self.read_lines()])
+
+    def test_levels(self):
+        self.cut.debug("Calling GET https://collegefootballrisk.com/api/turns")
+        self.cut.warning("Nickname is too long", discord_id="1234")
+        self.assertEqual(["WARNING Nickname is too long discord_id=1234"],
+                         [line.split(" ", 1)[1] for line in self.read_lines()])
+        Logger.configure(level="DEBUG")
+        self.cut.debug("Calling GET https://collegefootballrisk.com/api/turns")
+        self.assertEqual(2, len(self.read_lines()))
+
+    def test_json_format(self):
+        Logger.configure(json_format=True)
+        self.cut.error({"message": "Missing Permissions"}, status=403)
+        record = json.loads(self.read_lines()[0])
+        self.assertEqual({"message": "Missing Permissions"}, record["message"])
+        self.assertEqual("ERROR", record["level"])
+        self.assertEqual(403, record["status"])
+
+    def test_errors_flush_immediately(self):
+        self.cut.error("Unknown Guild")
+        with open(self.path, 'r', encoding='utf-8') as file:
+            self.assertIn("ERROR Unknown Guild", file.read())
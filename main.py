@@ -1,62 +1,181 @@
 import argparse
-import json
+import csv
+import io
+import os
+import sys
+import tempfile
+import time
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
-from discord_api import DiscordApi
 from logger import Logger
-from risk_api import RiskApi
+from metrics import metrics
+from nickname_journal import NicknameJournal
+from report_writer import REPORT_WRITERS
 from settings_manager import SettingsManager
+from username_map import load_username_map
 
 NICKNAME_CHAR_LIMIT = 32
+REPORT_HEADER = ["Reddit Name", "Original Team", "Overall Stars", "Last Turn Played", "Last Turn Territory",
+                 "Total Turns", "Total Turns Stars", "Game Turns", "Game Turns Stars", "MVPs", "MVP Stars", "Streak",
+                 "Streak Stars", "Discord ID", "Discord Name", "Has Verified Role"]
+STAR_CHANGE, TEXT_CHANGE, OTHER_CHANGE = range(3)
+PRIORITY_NAMES = ["star changes", "prefix or diplomat changes", "other changes"]
+
+
+class StarsDict(dict):
+    # Counts every change so the lower-cased name index knows when it is stale
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = 0
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.version += 1
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.version += 1
+
+    def setdefault(self, key, default=None):
+        self.version += 1
+        return super().setdefault(key, default)
+
+    def pop(self, *args):
+        self.version += 1
+        return super().pop(*args)
+
+    def popitem(self):
+        self.version += 1
+        return super().popitem()
+
+    def clear(self):
+        super().clear()
+        self.version += 1
 
 
 class Main:
-    def __init__(self):
-        self.risk_api = RiskApi()
-        self.csv_suffix = "Stars.csv"
-        self.discord_api = DiscordApi()
-        self.username_map_file = "username_map.json"
+    def __init__(self, settings=None, risk_cache=None):
+        # API clients are created on first use so paths that never touch an API skip importing requests
+        self.secrets = settings or SettingsManager()
+        self.risk_cache = risk_cache
+        self._risk_api = None
+        self._discord_api = None
+        self.report_directory = self.secrets.get_report_directory()
+        self.report_suffix = "Stars"
+        self.username_map_file = self.secrets.get_username_map_file()
+        self.player_names = {}
         self.stars = {}
         self.star_char = "⭐"  # ⭐ ✯ * 🌟 ☆
         self.logger = Logger()
-        self.secrets = SettingsManager()
+        self.star_history = None
+        self.nickname_journal = None
+        self.now = datetime.utcnow
+
+    @property
+    def risk_api(self):
+        if self._risk_api is None:
+            from risk_api import RiskApi
+            self._risk_api = RiskApi(self.secrets, self.risk_cache)
+        return self._risk_api
+
+    @risk_api.setter
+    def risk_api(self, risk_api):
+        self._risk_api = risk_api
+
+    @property
+    def stars(self):
+        return self._stars
+
+    @stars.setter
+    def stars(self, stars):
+        self._stars = stars if isinstance(stars, StarsDict) else StarsDict(stars)
+        self.indexed_stars_version = None
+
+    @property
+    def discord_api(self):
+        if self._discord_api is None:
+            from discord_api import DiscordApi
+            self._discord_api = DiscordApi(self.secrets)
+        return self._discord_api
+
+    @discord_api.setter
+    def discord_api(self, discord_api):
+        self._discord_api = discord_api
+
+    def launch_bot_auth(self):
+        import webbrowser
+        from discord_api import get_bot_auth_url
+        webbrowser.open(get_bot_auth_url(self.secrets.get_secrets()))
 
     def cache_all_stars(self):
         if self.stars == {}:
-            player_names = [p["player"] for p in self.risk_api.get_players()]
-            merc_names = [p["player"] for p in self.risk_api.get_mercs()]
-            self.risk_api.get_batch_player_info(player_names)
-            self.risk_api.get_batch_player_info(merc_names)
+            with metrics.phase("star caching"):
+                self._cache_all_stars()
+
+    def _cache_all_stars(self):
+        if self.stars == {}:
+            players, mercs = self.risk_api.get_players_and_mercs()
+            player_names = [p["player"] for p in players]
+            merc_names = [p["player"] for p in mercs]
+            if self.risk_api.player_snapshot is not None:
+                self.risk_api.get_incremental_batch_player_info(players + mercs)
+                self.risk_api.save_player_snapshot()
+            else:
+                self.risk_api.get_batch_player_info(player_names + merc_names)
             self.stars.update(self.risk_api.get_player_stars(player_names))
-            self.stars.update(self.risk_api.get_merc_stars(self.risk_api.get_mercs()))
+            self.stars.update(self.risk_api.get_merc_stars(mercs))
+            self.index_stars()
 
-    def generate_csv(self):
+    def index_stars(self):
+        self.player_names = {}
+        for player in self.stars:
+            self.player_names.setdefault(player.lower(), player)
+        self.indexed_stars_version = (id(self.stars), self.stars.version)
+
+    def generate_rows(self):
         self.cache_all_stars()
         self.discord_api.get_guild_members()
         verified_role_id = self.get_verified_role_id()
         mapping = self.get_reddit_to_discord_mapping(self.get_username_mapping())
-        csv = "Reddit Name,Original Team,Overall Stars,Last Turn Played,Last Turn Territory," \
-              "Total Turns,Total Turns Stars,Game Turns,Game Turns Stars,MVPs,MVP Stars,Streak,Streak Stars," \
-              "Discord ID,Discord Name,Has Verified Role\n"
         for player in self.stars:
             player_info = self.risk_api.get_player_info(player)
-            player_turns = player_info["turns"]
-            last_turn = player_turns[0] if len(player_turns) > 0 else {"season": "", "day": "", "territory": ""}
+            if player_info is None:
+                self.logger.warning(f"Leaving \"{player}\" out of the report: the Risk API does not know them.")
+                continue
+            last_turn = f"{player_info.last_season}/{player_info.last_day}" if player_info.last_day is not None else "/"
             player_lower = player.lower()
             discord_id = mapping[player_lower] if player_lower in mapping else ""
             discord_user = self.discord_api.get_guild_member(discord_id)
             discord_username = self.get_discord_full_username(discord_user) if discord_id and discord_user else ""
             has_verified_role = verified_role_id in discord_user["roles"] if discord_id and discord_user else False
-            csv += f"{player},{player_info['team']['name']},{self.stars[player]}," \
-                   f"{last_turn['season']}/{last_turn['day']},{last_turn['territory']}," \
-                   f"{player_info['stats']['totalTurns']},{player_info['ratings']['totalTurns']}," \
-                   f"{player_info['stats']['gameTurns']},{player_info['ratings']['gameTurns']}," \
-                   f"{player_info['stats']['mvps']},{player_info['ratings']['mvps']}," \
-                   f"{player_info['stats']['streak']},{player_info['ratings']['streak']}," \
-                   f"{discord_id},{discord_username},{has_verified_role}\n"
-        return csv
+            yield [player, player_info.team, self.stars[player], last_turn, player_info.last_territory or "",
+                   player_info.total_turns, player_info.total_turns_rating,
+                   player_info.game_turns, player_info.game_turns_rating,
+                   player_info.mvps, player_info.mvps_rating,
+                   player_info.streak, player_info.streak_rating,
+                   discord_id, discord_username, has_verified_role]
+
+    def generate_csv(self):
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator="\n")
+        writer.writerow(REPORT_HEADER)
+        writer.writerows(self.generate_rows())
+        return output.getvalue()
 
     def get_reddit_to_discord_mapping(self, discord_to_reddit_mapping):
+        if "reddit_to_discord" in discord_to_reddit_mapping:
+            return discord_to_reddit_mapping["reddit_to_discord"]
         combined_users = (discord_to_reddit_mapping["players"] | discord_to_reddit_mapping["exclude"])
         mapping = {}
         for discord_id in combined_users:
@@ -72,29 +191,46 @@ class Main:
             if role["name"] == self.secrets.get_verified_discord_role_name():
                 return role["id"]
 
-    def write_csv_file(self):
+    def get_report_name(self, output_format="csv", report_suffix=None):
         previous_turn = self.risk_api.get_previous_turn()
-        csv_name = f"Season {previous_turn['season']} Day {previous_turn['day']} {self.csv_suffix}"
-        self.logger.log(f"Writing CSV file \"{csv_name}\"")
-        with open(csv_name, "w", encoding='utf-8') as file:
-            file.write(self.generate_csv())
-        self.logger.log("Done writing CSV file.")
+        return os.path.join(self.report_directory, f"Season {previous_turn['season']} Day {previous_turn['day']} "
+                                                   f"{report_suffix or self.report_suffix}"
+                                                   f"{REPORT_WRITERS[output_format].extension}")
+
+    def write_csv_file(self, output_format="csv"):
+        report_name = self.get_report_name(output_format)
+        self.logger.log(f"Writing {output_format} file \"{report_name}\"")
+        rows = self.generate_rows()
+        if self.star_history is not None:
+            previous_turn = self.risk_api.get_previous_turn()
+            rows = self.star_history.record_rows(previous_turn["season"], previous_turn["day"], rows)
+        with metrics.phase("csv generation"), REPORT_WRITERS[output_format](report_name, REPORT_HEADER) as writer:
+            writer.write_rows(rows)
+        self.logger.log(f"Done writing {output_format} file with {writer.row_count} rows.")
+
+    def write_moves_file(self, output_format="csv"):
+        from move_analytics import MOVES_HEADER, MoveAnalytics
+        self.cache_all_stars()
+        report_name = self.get_report_name(output_format, "Moves")
+        self.logger.log(f"Writing {output_format} file \"{report_name}\"")
+        with metrics.phase("move analytics"), REPORT_WRITERS[output_format](report_name, MOVES_HEADER) as writer:
+            writer.write_rows(MoveAnalytics(self.risk_api).generate_rows())
+        self.logger.log(f"Done writing {output_format} file with {writer.row_count} territories.")
 
     def get_username_mapping(self):
-        with open(self.username_map_file, 'r') as file:
-            return json.load(file)
+        return load_username_map(self.username_map_file)
 
     def get_username_in_stars_dict(self, reddit_username: str):
-        for player in self.stars.keys():
-            if reddit_username.lower() == player.lower():
-                return player
+        if self.indexed_stars_version != (id(self.stars), self.stars.version):
+            self.index_stars()
+        return self.player_names.get(reddit_username.lower())
 
     def build_discord_nickname_with_stars(self, mapping):
         self.cache_all_stars()
         mapping_reddit_username = mapping['reddit'].strip()
         reddit_username = self.get_username_in_stars_dict(mapping_reddit_username)
         if not reddit_username:
-            self.logger.log(f"Error: Reddit username \"{mapping_reddit_username}\" is not in the star list.")
+            self.logger.error(f"Reddit username \"{mapping_reddit_username}\" is not in the star list.")
             return None
         # "[prefix|]username ✯✯✯✯✯"
         nickname = f"{reddit_username} {self.star_char * self.stars[reddit_username]}"
@@ -103,36 +239,163 @@ class Main:
             if len(prefixed_nickname) <= NICKNAME_CHAR_LIMIT:
                 nickname = prefixed_nickname
             else:
-                self.logger.log(f"Warning: Prefixed nickname \"{prefixed_nickname}\" is >{NICKNAME_CHAR_LIMIT} characters. Ignoring prefix.")
+                self.logger.warning(f"Prefixed nickname \"{prefixed_nickname}\" is >{NICKNAME_CHAR_LIMIT} characters. Ignoring prefix.")
         return nickname
 
-    def set_discord_nickname(self, discord_id: str, nickname: str) -> None:
-        if len(nickname) > NICKNAME_CHAR_LIMIT:
-            self.logger.log(f"Warning: Nickname \"{nickname}\" is >{NICKNAME_CHAR_LIMIT} characters. Skipping.")
-            return
-        self.discord_api.set_nickname(discord_id, nickname)
+    def get_target_discord_nickname(self, discord_id: str, mapping):
+        if discord_id in mapping["exclude"] or discord_id == self.discord_api.get_bot_id():
+            return None
+        elif discord_id in mapping["players"]:
+            return self.build_discord_nickname_with_stars(mapping["players"][discord_id])
+        elif discord_id in mapping["diplomats"]:
+            diplomat = mapping["diplomats"][discord_id]
+            return f"{diplomat['nickname']} | {diplomat['team']}"
+        else:
+            user = self.discord_api.get_guild_member(discord_id)
+            username = self.get_discord_full_username(user)
+            self.logger.warning(f"Discord ID {discord_id} (\"{username}\") is not in the map file.")
+            return None
 
-    def set_discord_nicknames(self):
-        self.logger.log("Setting Discord nicknames...")
-        discord_ids = self.discord_api.get_guild_member_ids()
+    def plan_discord_nicknames(self) -> list[tuple[str, str, str]]:
         mapping = self.get_username_mapping()
-        for discord_id in discord_ids:
-            if discord_id in mapping["exclude"] or discord_id == self.discord_api.get_bot_id():
+        plan = []
+        for member in self.discord_api.get_guild_members():
+            discord_id = member["user"]["id"]
+            nickname = self.get_target_discord_nickname(discord_id, mapping)
+            if nickname is None or nickname == member.get("nick"):
                 continue
-            elif discord_id in mapping["players"]:
-                nickname = self.build_discord_nickname_with_stars(mapping["players"][discord_id])
-                if nickname is None:
-                    continue
-                self.set_discord_nickname(discord_id, nickname)
-            elif discord_id in mapping["diplomats"]:
-                diplomat = mapping["diplomats"][discord_id]
-                self.set_discord_nickname(discord_id, f"{diplomat['nickname']} | {diplomat['team']}")
-            else:
-                user = self.discord_api.get_guild_member(discord_id)
-                username = self.get_discord_full_username(user)
-                self.logger.log(f"Warning: Discord ID {discord_id} (\"{username}\") is not in the map file.")
-                pass
+            if len(nickname) > NICKNAME_CHAR_LIMIT:
+                self.logger.warning(f"Nickname \"{nickname}\" is >{NICKNAME_CHAR_LIMIT} characters. Skipping.")
+                continue
+            plan.append((discord_id, member.get("nick"), nickname))
+        return plan
+
+    def get_update_priority(self, current_nickname, nickname) -> int:
+        # Setting stars on a member who has none yet counts as a star change too
+        if (current_nickname or "").count(self.star_char) != nickname.count(self.star_char):
+            return STAR_CHANGE
+        if " | " in nickname or " | " in (current_nickname or ""):
+            return TEXT_CHANGE
+        return OTHER_CHANGE
+
+    def prioritize(self, plan: list[tuple[str, str, str]]) -> list[tuple[str, str, str]]:
+        # Under throttling the updates that matter most reach the server first
+        priorities = [self.get_update_priority(current_nickname, nickname) for _, current_nickname, nickname in plan]
+        counts = ", ".join(f"{priorities.count(priority)} {name}" for priority, name in enumerate(PRIORITY_NAMES))
+        self.logger.log(f"Nickname updates by priority: {counts}.")
+        return [update for _, update in sorted(zip(priorities, plan), key=lambda pair: pair[0])]
+
+    def get_nickname_deadline(self, time_budget_minutes, from_roll=True):
+        # The budget counts from the roll when the Risk API reports it, otherwise from now. Resumed updates are
+        # given a fresh budget from now, since the roll's own budget has usually run out by then.
+        if time_budget_minutes is None:
+            return None
+        turn = self.risk_api.get_latest_complete_turn() if from_roll else None
+        start = datetime.fromisoformat(turn["rollTime"]) if turn and turn.get("rollTime") else self.now()
+        seconds_left = (start + timedelta(minutes=time_budget_minutes) - self.now()).total_seconds()
+        return time.monotonic() + seconds_left
+
+    def set_discord_nicknames(self, plan_only=False, resume=False, time_budget_minutes=None):
+        with metrics.phase("nickname updates"):
+            return self._set_discord_nicknames(plan_only, resume, time_budget_minutes)
+
+    def _set_discord_nicknames(self, plan_only=False, resume=False, time_budget_minutes=None):
+        journal = self.nickname_journal if not plan_only else None
+        if journal is not None:
+            journal_key = NicknameJournal.make_key(self.discord_api.secrets["guild_id"],
+                                                   self.risk_api.get_latest_complete_turn())
+        remaining = journal.load(journal_key) if journal is not None and resume else None
+        if remaining is not None:
+            # The journaled plan is reused as is, so resuming needs neither the stars nor the member list
+            self.logger.log(f"Resuming nickname updates for this turn: {len(remaining)} left.")
+            plan = remaining
+        else:
+            self.logger.log("Planning Discord nicknames...")
+            plan = self.plan_discord_nicknames()
+            self.logger.log(f"{len(plan)} of {len(self.discord_api.get_guild_members())} nicknames need to change.")
+        plan = self.prioritize(plan)
+        if plan_only:
+            for discord_id, current_nickname, nickname in plan:
+                self.logger.log(f"Plan: {discord_id} \"{current_nickname or ''}\" -> \"{nickname}\"")
+            self.logger.log(f"Plan: {len(plan)} Discord API calls.")
+            return plan
+        if time_budget_minutes is None:
+            time_budget_minutes = self.secrets.get_nickname_time_budget_minutes()
+        deadline = self.get_nickname_deadline(time_budget_minutes, from_roll=remaining is None)
+        if journal is not None:
+            journal.begin(journal_key, plan)
+        self.logger.log("Setting Discord nicknames...")
+        responses = self.discord_api.set_nicknames({discord_id: nickname for discord_id, _, nickname in plan},
+                                                   on_success=journal.record_done if journal is not None else None,
+                                                   deadline=deadline)
+        skipped = responses.count(None)
+        if skipped:
+            # The journal is left open so the next -resume run picks these up first
+            self.logger.warning(f"{skipped} nickname updates did not fit in the {time_budget_minutes} minute time "
+                                f"budget and are carried over to the next run.")
+            if journal is not None:
+                journal.close()
+        elif journal is not None:
+            journal.finish()
         self.logger.log("Done setting Discord nicknames.")
+        return plan
+
+    def reset_risk_data(self):
+        self.risk_api.reset_cache()
+        self.stars = {}
+        self.index_stars()
+
+    def run(self, write_csv=True, set_nicknames=True, output_format="csv", plan_only=False, metrics_json=None,
+            metrics_prometheus=None, write_moves=False, resume=False, time_budget_minutes=None):
+        self.run_steps(write_csv, set_nicknames, output_format, plan_only, write_moves, resume, time_budget_minutes)
+        self.report_metrics(metrics_json, metrics_prometheus)
+
+    def prefetch_risk_data(self):
+        self.risk_api.get_turns()
+        self.cache_all_stars()
+
+    def prefetch_discord_data(self):
+        self.discord_api.get_guild_members()
+        self.discord_api.get_guild_roles()
+        self.discord_api.get_bot_id()
+        self.get_username_mapping()
+
+    def prefetch(self):
+        # The Risk API and Discord are independent, so the run waits on the slower of the two instead of both.
+        # Rows still start once both are loaded since a player's member can be on any page of the roster.
+        with metrics.phase("prefetch"):
+            if metrics.profiler is not None:
+                # cProfile and the tracemalloc peak are process-wide, so profiled phases must not overlap
+                self.prefetch_risk_data()
+                self.prefetch_discord_data()
+                return
+            with ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch") as pool:
+                futures = [pool.submit(self.prefetch_risk_data), pool.submit(self.prefetch_discord_data)]
+                for future in futures:
+                    future.result()
+
+    def run_steps(self, write_csv=True, set_nicknames=True, output_format="csv", plan_only=False, write_moves=False,
+                  resume=False, time_budget_minutes=None):
+        if write_csv or (set_nicknames and not resume):
+            self.prefetch()
+        if write_csv:
+            self.write_csv_file(output_format)
+        if write_moves:
+            self.write_moves_file(output_format)
+        if set_nicknames:
+            self.set_discord_nicknames(plan_only=plan_only, resume=resume, time_budget_minutes=time_budget_minutes)
+
+    def report_metrics(self, json_path=None, prometheus_path=None):
+        self.logger.log(f"Run metrics:\n{metrics.summary_table()}")
+        if json_path:
+            metrics.write_json(json_path)
+        if prometheus_path:
+            metrics.write_prometheus(prometheus_path)
+        if metrics.profiler is not None:
+            metrics.profiler.write_report()
+            self.logger.log(f"Wrote the phase profile to {metrics.profiler.report_path}.")
+            metrics.profiler.reset()
+        metrics.reset()
 
     def get_discord_full_username(self, user):
         return f"{user['user']['username']}#{user['user']['discriminator']}"
@@ -151,11 +414,193 @@ class TestSuite(unittest.TestCase):
         self.cut.stars = {"PM_me_your_moves": 1, "EpicWolverine1": 2}
         self.assertEqual("PM_me_your_moves", self.cut.get_username_in_stars_dict("PM_Me_Your_Moves"))
         self.assertEqual("EpicWolverine1", self.cut.get_username_in_stars_dict("epicwolverine1"))
+        self.assertIsNone(self.cut.get_username_in_stars_dict("not_a_player"))
+        self.cut.stars["Late_Player"] = 3
+        self.assertEqual("Late_Player", self.cut.get_username_in_stars_dict("late_player"))
+        self.cut.stars = {"Next_Roll": 1, "Other_Player": 2, "Third_Player": 3}
+        self.assertEqual("Next_Roll", self.cut.get_username_in_stars_dict("next_roll"))
+        self.assertIsNone(self.cut.get_username_in_stars_dict("late_player"))
+        del self.cut.stars["Next_Roll"]
+        self.cut.stars["Swapped_In"] = 1
+        self.assertEqual("Swapped_In", self.cut.get_username_in_stars_dict("swapped_in"))
+        self.assertIsNone(self.cut.get_username_in_stars_dict("next_roll"))
+
+    def use_mock_apis(self):
+        from discord_api import MockDiscordApi
+        from risk_api import MockRiskApi
+        self.cut.risk_api = MockRiskApi()
+        self.cut.discord_api = MockDiscordApi()
+        self.cut.get_username_mapping = lambda: {
+            "players": {"1234567890": {"reddit": "epicwolverine", "prefix": ""},
+                        "098765321": {"reddit": "user1", "prefix": "Moves"}},
+            "exclude": {"140174746485653504": {"reddit": "EpicWolverine"}},
+            "diplomats": {},
+        }
+
+    def test_generate_csv(self):
+        self.use_mock_apis()
+        self.cut.stars = {"EpicWolverine": 4, "Mautamu": 3}
+        self.cut.risk_api.get_batch_player_info(["EpicWolverine", "Mautamu"])
+        self.cut.risk_api.cache.player_info["Mautamu"].team = "Texas A&M, College Station"
+        lines = self.cut.generate_csv().splitlines()
+        self.assertEqual(",".join(REPORT_HEADER), lines[0])
+        self.assertEqual(3, len(lines))
+        self.assertIn("EpicWolverine,Aldi,4,1/18,Alaska,113,5,18,3,10,4,18,4,1234567890,not me#3742,True", lines)
+        self.assertIn('Mautamu,"Texas A&M, College Station",3,2/50,Stillwater,42,3,0,1,0,1,0,1,,,False', lines)
+
+    def test_write_csv_file_records_history(self):
+        self.use_mock_apis()
+        self.cut.stars = {"EpicWolverine": 4, "Mautamu": 3}
+        self.cut.risk_api.get_batch_player_info(["EpicWolverine", "Mautamu"])
+        from star_history import StarHistory
+        self.cut.star_history = StarHistory(":memory:")
+        with tempfile.TemporaryDirectory() as directory:
+            self.cut.report_directory = directory
+            self.cut.write_csv_file()
+            self.assertEqual(["Season 1 Day 19 Stars.csv"], os.listdir(directory))
+        self.assertEqual([(1, 19, 4)], self.cut.star_history.get_trend("EpicWolverine"))
+        self.assertEqual([(1, 19, 3)], self.cut.star_history.get_trend("Mautamu"))
+
+    def test_write_moves_file(self):
+        from move_analytics import MOVES_HEADER
+        self.use_mock_apis()
+        self.cut.stars = {"EpicWolverine": 4, "Mautamu": 3}
+        self.cut.risk_api.get_batch_player_info(["EpicWolverine", "Mautamu"])
+        self.cut.risk_api.get_turns()[-2] = {"id": 18, "season": 1, "day": 18, "complete": True}
+        with tempfile.TemporaryDirectory() as directory:
+            self.cut.report_directory = directory
+            self.cut.write_moves_file()
+            with open(os.path.join(directory, "Season 1 Day 18 Moves.csv"), 'r', encoding='utf-8') as file:
+                lines = file.read().splitlines()
+        self.assertEqual(",".join(MOVES_HEADER), lines[0])
+        self.assertEqual(["Alaska,1,4.0,4.0,2,8.0,10.5,0.3333,0.2759,Ohio State,7.5,Aldi"], lines[1:])
+
+    def test_plan_discord_nicknames(self):
+        self.use_mock_apis()
+        self.cut.discord_api.members[0]["nick"] = f"EpicWolverine {self.cut.star_char * 4}"
+        expected = [("098765321", "other other name", f"Moves | user1 {self.cut.star_char * 4}")]
+        self.assertEqual(expected, self.cut.plan_discord_nicknames())
+
+    def test_set_discord_nicknames_skips_unchanged(self):
+        self.use_mock_apis()
+        self.cut.set_discord_nicknames()
+        self.assertEqual(2, len(self.cut.discord_api.patches))
+        self.cut.set_discord_nicknames()
+        self.assertEqual(2, len(self.cut.discord_api.patches))
+
+    def test_resume_after_failure(self):
+        self.use_mock_apis()
+        with tempfile.TemporaryDirectory() as directory:
+            self.cut.nickname_journal = NicknameJournal(os.path.join(directory, "nickname_journal.jsonl"))
+            set_nickname = self.cut.discord_api.set_nickname
+
+            def fail_on_second(discord_id, nickname, deadline=None):
+                if discord_id == "1234567890":
+                    raise SystemExit(1)
+                return set_nickname(discord_id, nickname, deadline)
+
+            self.cut.discord_api.set_nickname = fail_on_second
+            self.cut.discord_api.write_executor.max_workers = 1
+            with self.assertRaises(SystemExit):
+                self.cut.set_discord_nicknames()
+            self.cut.nickname_journal.close()
+            self.cut.discord_api.set_nickname = set_nickname
+            patched = list(self.cut.discord_api.patches)
+            members_calls = self.cut.discord_api.call_api_get_access_count
+            self.cut.set_discord_nicknames(resume=True)
+            self.assertEqual(patched + [("guilds/" + self.cut.discord_api.secrets["guild_id"] + "/members/1234567890",
+                                         {"nick": f"EpicWolverine {self.cut.star_char * 4}"})],
+                             self.cut.discord_api.patches)
+            self.assertEqual(members_calls, self.cut.discord_api.call_api_get_access_count)
+            self.cut.set_discord_nicknames(resume=True)
+            self.assertEqual(len(patched) + 1, len(self.cut.discord_api.patches))
+            self.cut.nickname_journal.close()
+
+    def test_unknown_roster_players_are_left_out(self):
+        self.use_mock_apis()
+        get_team_api_data = self.cut.risk_api._get_team_api_data
+        ghosts = {"players": [{"team": "Aldi", "player": "ghost", "turnsPlayed": 1, "mvps": 0, "lastTurn": {}}],
+                  "mercs": [{"team": "Aldi", "player": "ghost_merc", "turnsPlayed": 1, "mvps": 0, "stars": 2}]}
+        self.cut.risk_api._get_team_api_data = lambda endpoint: get_team_api_data(endpoint) + ghosts[endpoint]
+        rows = list(self.cut.generate_rows())
+        self.assertNotIn("ghost", self.cut.stars)
+        self.assertEqual(["user1", "EpicWolverine", "user2", "merc1", "Mautamu"], [row[0] for row in rows])
+        self.assertTrue(self.cut.risk_api.is_missing_player("ghost"))
+
+    def test_prioritize(self):
+        star = self.cut.star_char
+        plan = [("1", None, f"user1 {star * 3}"), ("2", f"Moves | user2 {star * 3}", f"Scouts | user2 {star * 3}"),
+                ("3", f"user3 {star * 3}", f"user3 {star * 4}"), ("4", "Ambassador | Texas", "Ambassador | Texas A&M"),
+                ("5", f"Moves | user5 {star * 2}", f"Moves | user5 {star}"), ("6", f"user6 {star}", f"User6 {star}")]
+        self.assertEqual(["1", "3", "5", "2", "4", "6"], [discord_id for discord_id, _, _ in self.cut.prioritize(plan)])
+
+    def test_time_budget_carries_over(self):
+        self.use_mock_apis()
+        self.cut.discord_api.members[0]["nick"] = f"EpicWolverine {self.cut.star_char * 3}"
+        self.cut.discord_api.members[1]["nick"] = f"user1 {self.cut.star_char * 4}"
+        self.cut.risk_api.get_latest_complete_turn()["rollTime"] = "2022-02-06T03:30:01"
+        with tempfile.TemporaryDirectory() as directory:
+            self.cut.nickname_journal = NicknameJournal(os.path.join(directory, "nickname_journal.jsonl"))
+            self.cut.discord_api.write_executor.max_workers = 1
+            self.cut.now = lambda: datetime.fromisoformat("2022-02-06T03:41:00")
+            self.cut.set_discord_nicknames(time_budget_minutes=10)
+            self.assertEqual([], self.cut.discord_api.patches)
+            # Resumed on the same turn, still past the roll's budget, with a fresh budget of its own
+            self.cut.now = lambda: datetime.fromisoformat("2022-02-06T03:42:00")
+            self.cut.set_discord_nicknames(resume=True, time_budget_minutes=10)
+            self.assertEqual(["1234567890", "098765321"],
+                             [endpoint.rsplit("/", 1)[-1] for endpoint, _ in self.cut.discord_api.patches])
+            self.cut.nickname_journal.close()
+
+    def test_report_metrics_writes_profile(self):
+        import tracemalloc
+        from phase_profiler import PhaseProfiler
+        self.use_mock_apis()
+        with tempfile.TemporaryDirectory() as directory:
+            metrics.profiler = PhaseProfiler(os.path.join(directory, "profile_report.txt"))
+            threads = set()
+            get_guild_members = self.cut.discord_api.get_guild_members
+            self.cut.discord_api.get_guild_members = lambda: threads.add(threading.current_thread()) or get_guild_members()
+            try:
+                self.cut.run(write_csv=False, plan_only=True)
+            finally:
+                profiler, metrics.profiler = metrics.profiler, None
+                tracemalloc.stop()
+            with open(profiler.report_path, 'r', encoding='utf-8') as file:
+                report = file.read()
+        self.assertIn("=== Phase star caching: 1 call(s)", report)
+        self.assertIn("=== Phase nickname updates: 1 call(s)", report)
+        self.assertIn("=== Phase member paging: 1 call(s)", report)
+        self.assertNotIn("not CPU profiled", report)
+        self.assertEqual({threading.current_thread()}, threads)
+        self.assertEqual({}, profiler.phases)
+
+    def test_prefetch_overlaps_risk_and_discord(self):
+        self.use_mock_apis()
+        # Each side waits for the other, so this only finishes if both are fetched at the same time
+        both_started = threading.Barrier(2, timeout=5)
+        get_players_and_mercs = self.cut.risk_api.get_players_and_mercs
+        get_guild_members = self.cut.discord_api.get_guild_members
+        self.cut.risk_api.get_players_and_mercs = lambda: (both_started.wait(), get_players_and_mercs())[1]
+        self.cut.discord_api.get_guild_members = lambda: (both_started.wait(), get_guild_members())[1]
+        self.cut.prefetch()
+        self.cut.discord_api.get_guild_members = get_guild_members
+        calls = self.cut.discord_api.call_api_get_access_count
+        lines = self.cut.generate_csv().splitlines()
+        self.cut.set_discord_nicknames(plan_only=True)
+        self.assertEqual(6, len(lines))
+        self.assertEqual(calls, self.cut.discord_api.call_api_get_access_count)
+
+    def test_set_discord_nicknames_plan_only(self):
+        self.use_mock_apis()
+        self.assertEqual(2, len(self.cut.set_discord_nicknames(plan_only=True)))
+        self.assertEqual([], self.cut.discord_api.patches)
 
 
 if __name__ == "__main__":
+    settings = SettingsManager()
+    Logger.configure(level=settings.get_log_level(), json_format=settings.get_log_format() == "json")
     Logger().log("Script start.")
-    main = Main()
     parser = argparse.ArgumentParser(description="Automate logging and setting Risk Stars. Default: Generate stars CSV and update Discord nicknames.")
     parser.add_argument("-auth", "--authenticate", action="store_const",
                         const=True, default=False,
@@ -166,19 +611,112 @@ if __name__ == "__main__":
                         help="Only update Discord nicknames.")
     parser.add_argument("-test_nick", "--test_nickname_only", action="store_const", const=True, default=False,
                         help="Only test Discord nickname updating.")
+    parser.add_argument("-plan", "--plan", action="store_const", const=True, default=False,
+                        help="Only print the Discord nickname changes and API call count without updating anything. "
+                             "No reports or star history are written.")
+    parser.add_argument("-no_cache", "--no_cache", action="store_const", const=True, default=False,
+                        help="Do not read or write the on-disk Risk API cache.")
+    parser.add_argument("-incremental", "--incremental", action="store_const", const=True, default=False,
+                        help="Only fetch details for players who played or joined since the last incremental run.")
+    parser.add_argument("-format", "--output_format", choices=sorted(REPORT_WRITERS), default="csv",
+                        help="Stars report format. Default: csv.")
+    parser.add_argument("-no_history", "--no_history", action="store_const", const=True, default=False,
+                        help="Do not append the stars report to the star history database.")
+    parser.add_argument("-no_moves", "--no_moves", action="store_const", const=True, default=False,
+                        help="Do not write the territory moves report next to the stars report.")
+    parser.add_argument("-resume", "--resume", action="store_const", const=True, default=False,
+                        help="Continue the nickname updates an interrupted run left unfinished for the latest turn.")
+    parser.add_argument("-budget", "--time_budget", type=float, metavar="MINUTES",
+                        help="Stop starting nickname updates this many minutes after the roll (or after the start of a "
+                             "-resume run) and carry the rest over to the next run. Star changes are updated first.")
+    parser.add_argument("-daemon", "--daemon", action="store_const", const=True, default=False,
+                        help="Keep running and generate the CSV and update nicknames as soon as each roll completes.")
+    parser.add_argument("-instances", "--instances", action="store_const", const=True, default=False,
+                        help="Run every team and guild listed under \"instances\" in settings.json in one process.")
+    parser.add_argument("-metrics_json", "--metrics_json", metavar="PATH",
+                        help="Also write the request and phase metrics to a JSON file.")
+    parser.add_argument("-metrics_prom", "--metrics_prometheus", metavar="PATH",
+                        help="Also write the request and phase metrics to a Prometheus textfile.")
+    parser.add_argument("-profile", "--profile", metavar="PATH", nargs="?", const="profile_report.txt",
+                        help="Profile CPU time and memory of each phase and write the top functions and allocation "
+                             "sites to a report. Default: profile_report.txt.")
+    parser.add_argument("-pstats", "--profile_pstats", metavar="DIRECTORY",
+                        help="With -profile, also dump each phase's pstats file for snakeviz to this directory.")
     parser.add_argument("-prod", "--use_prod_guild", action="store_const", const=True, default=False,
                         help="Use production guild.")
     args = parser.parse_args()
-    if not args.use_prod_guild:
-        main.discord_api.use_test_guild()
-        main.username_map_file = "test_username_map.json"
+    if args.instances and args.daemon:
+        parser.error("-instances cannot be combined with -daemon.")
+    if args.instances and not settings.get_instances():
+        parser.error("-instances needs an \"instances\" list in settings.json.")
+    if args.profile_pstats and not args.profile:
+        parser.error("-pstats needs -profile.")
+    if args.plan and args.csv_only:
+        parser.error("-plan cannot be combined with -csv.")
+    main = Main(settings)
     if args.authenticate:
-        main.discord_api.launch_bot_auth()
-    elif args.test_nickname_only:
+        if not args.use_prod_guild:
+            settings.use_test_guild()
+        main.launch_bot_auth()
+        Logger().log("Script end.")
+        sys.exit()
+    if args.profile:
+        from phase_profiler import PhaseProfiler
+        metrics.profiler = PhaseProfiler(args.profile, args.profile_pstats)
+    from http_transport import HttpTransport, set_default_transport
+    if args.instances:
+        from coalition import get_connection_pool_size
+        from risk_api import RiskApiCache
+        instance_settings = [settings.for_instance(instance) for instance in settings.get_instances()]
+        set_default_transport(HttpTransport(settings.get_http_timeout_seconds(), settings.get_http_retries(),
+                                            pool_size=get_connection_pool_size(instance_settings)))
+        risk_cache = RiskApiCache()
+        mains = [Main(secrets, risk_cache) for secrets in instance_settings]
+    else:
+        set_default_transport(HttpTransport(settings.get_http_timeout_seconds(), settings.get_http_retries()))
+        mains = [main]
+    # Every instance shares one Risk API cache, so the turn index is loaded once for all of them
+    mains[0].risk_api.use_turn_index(settings.get_turn_index_path())
+    disk_cache = None
+    if not args.no_cache:
+        from disk_cache import DiskCache
+        disk_cache = DiskCache(main.secrets.get_risk_cache_path(),
+                               main.secrets.get_risk_cache_max_megabytes() * 1024 * 1024)
+    for instance_main in mains:
+        if not args.use_prod_guild:
+            instance_main.secrets.use_test_guild()
+            instance_main.username_map_file = instance_main.secrets.get_test_username_map_file()
+        if instance_main.secrets.get_discord_member_source() == "gateway":
+            instance_main.discord_api.use_gateway(instance_main.secrets.get_discord_gateway_url())
+        if instance_main.report_directory:
+            os.makedirs(instance_main.report_directory, exist_ok=True)
+        if disk_cache is not None:
+            instance_main.risk_api.use_disk_cache(disk_cache)
+        if not args.no_history:
+            from star_history import StarHistory
+            instance_main.star_history = StarHistory(instance_main.secrets.get_star_history_path())
+        instance_main.nickname_journal = NicknameJournal(instance_main.secrets.get_nickname_journal_path())
+        if args.incremental:
+            instance_main.risk_api.use_player_snapshot(instance_main.secrets.get_player_snapshot_path())
+        if len(mains) > 1:
+            # Buckets are per guild, but the global limit applies to the bot token across every guild
+            instance_main.discord_api.write_executor.global_limit = max(
+                instance_main.discord_api.write_executor.global_limit // len(mains), 1)
+    if args.test_nickname_only:
         main.test_set_discord_nickname()
     else:
-        if not args.nickname_only or args.csv_only:
-            main.write_csv_file()
-        if not args.csv_only or args.nickname_only:
-            main.set_discord_nicknames()
+        write_csv = (not args.nickname_only or args.csv_only) and not args.plan
+        run_args = {"write_csv": write_csv, "write_moves": write_csv and not args.no_moves,
+                    "set_nicknames": not args.csv_only or args.nickname_only,
+                    "output_format": args.output_format, "plan_only": args.plan, "resume": args.resume,
+                    "time_budget_minutes": args.time_budget,
+                    "metrics_json": args.metrics_json, "metrics_prometheus": args.metrics_prometheus}
+        if args.daemon:
+            from roll_daemon import RollDaemon
+            RollDaemon(main, run_args).run()
+        elif args.instances:
+            from coalition import Coalition
+            Coalition(mains).run(**run_args)
+        else:
+            main.run(**run_args)
     Logger().log("Script end.")
@@ -0,0 +1,191 @@
+import json
+import os
+import re
+import stat
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from atomic_file import DEFAULT_FILE_MODE, write_atomically
+
+ID_PATTERN = re.compile(r"/\d+(?=/|$)")
+
+
+def get_endpoint_template(url: str) -> str:
+    return ID_PATTERN.sub("/{id}", urlsplit(url).path)
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class RequestStats:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes = 0
+
+    def add(self, seconds: float, size: int):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.bytes += size
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.rate_limit_sleep_seconds = {}
+        self.phases = {}
+        self.counters = {}
+        self.profiler = None
+
+    def record_request(self, method: str, url: str, status, seconds: float, size: int):
+        key = (urlsplit(url).netloc, method, get_endpoint_template(url), str(status))
+        with self.lock:
+            self.requests.setdefault(key, RequestStats()).add(seconds, size)
+
+    def record_rate_limit_sleep(self, host: str, seconds: float):
+        with self.lock:
+            self.rate_limit_sleep_seconds[host] = self.rate_limit_sleep_seconds.get(host, 0.0) + seconds
+
+    def increment(self, name: str, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            if self.profiler is None:
+                yield
+            else:
+                with self.profiler.profile(name):
+                    yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.rate_limit_sleep_seconds = {}
+            self.phases = {}
+            self.counters = {}
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "requests": [{"host": host, "method": method, "endpoint": endpoint, "status": status,
+                              "count": stats.count, "seconds": round(stats.seconds, 6),
+                              "max_seconds": round(stats.max_seconds, 6), "bytes": stats.bytes}
+                             for (host, method, endpoint, status), stats in sorted(self.requests.items())],
+                "rate_limit_sleep_seconds": {host: round(seconds, 6)
+                                             for host, seconds in self.rate_limit_sleep_seconds.items()},
+                "phases": {name: round(seconds, 6) for name, seconds in self.phases.items()},
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def summary_table(self) -> str:
+        report = self.to_dict()
+        lines = [f"{'Method':<6} {'Endpoint':<45} {'Status':>6} {'Count':>6} {'Total (s)':>10} {'Avg (ms)':>9} "
+                 f"{'Max (ms)':>9} {'KiB':>9}"]
+        for request in sorted(report["requests"], key=lambda request: -request["seconds"]):
+            lines.append(f"{request['method']:<6} {request['endpoint']:<45} {request['status']:>6} "
+                         f"{request['count']:>6} {request['seconds']:>10.2f} "
+                         f"{request['seconds'] / request['count'] * 1000:>9.1f} {request['max_seconds'] * 1000:>9.1f} "
+                         f"{request['bytes'] / 1024:>9.1f}")
+        for host, seconds in report["rate_limit_sleep_seconds"].items():
+            lines.append(f"Rate limit sleep on {host}: {seconds:.2f} s")
+        for name, seconds in report["phases"].items():
+            lines.append(f"Phase {name}: {seconds:.2f} s")
+        for name, count in report["counters"].items():
+            lines.append(f"{name}: {count}")
+        return "\n".join(lines)
+
+    def to_prometheus(self) -> str:
+        report = self.to_dict()
+        lines = ["# HELP cfbrisk_requests_total Outbound HTTP requests.", "# TYPE cfbrisk_requests_total counter"]
+        request_labels = [(request, f'host="{escape_label(request["host"])}",method="{request["method"]}",'
+                                    f'endpoint="{escape_label(request["endpoint"])}",status="{request["status"]}"')
+                          for request in report["requests"]]
+        lines += [f"cfbrisk_requests_total{{{labels}}} {request['count']}" for request, labels in request_labels]
+        lines += ["# HELP cfbrisk_request_seconds_total Time spent waiting on outbound HTTP requests.",
+                  "# TYPE cfbrisk_request_seconds_total counter"]
+        lines += [f"cfbrisk_request_seconds_total{{{labels}}} {request['seconds']}" for request, labels in request_labels]
+        lines += ["# HELP cfbrisk_request_bytes_total Response body bytes received.",
+                  "# TYPE cfbrisk_request_bytes_total counter"]
+        lines += [f"cfbrisk_request_bytes_total{{{labels}}} {request['bytes']}" for request, labels in request_labels]
+        lines += ["# HELP cfbrisk_rate_limit_sleep_seconds_total Time spent waiting on rate limits.",
+                  "# TYPE cfbrisk_rate_limit_sleep_seconds_total counter"]
+        lines += [f'cfbrisk_rate_limit_sleep_seconds_total{{host="{escape_label(host)}"}} {seconds}'
+                  for host, seconds in report["rate_limit_sleep_seconds"].items()]
+        lines += ["# HELP cfbrisk_phase_seconds Wall time of each run phase.", "# TYPE cfbrisk_phase_seconds gauge"]
+        lines += [f'cfbrisk_phase_seconds{{phase="{escape_label(name)}"}} {seconds}'
+                  for name, seconds in report["phases"].items()]
+        lines += ["# HELP cfbrisk_events_total Counted events such as single player fallbacks.",
+                  "# TYPE cfbrisk_events_total counter"]
+        lines += [f'cfbrisk_events_total{{event="{escape_label(name)}"}} {count}'
+                  for name, count in report["counters"].items()]
+        return "\n".join(lines) + "\n"
+
+    # The node exporter textfile collector must never see a partially written file
+    def write_json(self, path: str):
+        write_atomically(path, json.dumps(self.to_dict(), indent=4))
+
+    def write_prometheus(self, path: str):
+        write_atomically(path, self.to_prometheus())
+
+
+metrics = Metrics()
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cut = Metrics()
+        self.cut.record_request("PATCH", "https://discord.com/api/v9/guilds/123/members/456", 200, 0.25, 100)
+        self.cut.record_request("PATCH", "https://discord.com/api/v9/guilds/123/members/789", 200, 0.75, 100)
+        self.cut.record_request("GET", "https://collegefootballrisk.com/api/players?team=Aldi", 200, 1.5, 2048)
+        self.cut.record_rate_limit_sleep("discord.com", 2.0)
+        with self.cut.phase("nickname updates"):
+            pass
+        self.cut.increment("risk_single_player_fallbacks", 3)
+
+    def test_get_endpoint_template(self):
+        self.assertEqual("/api/v9/guilds/{id}/members/{id}",
+                         get_endpoint_template("https://discord.com/api/v9/guilds/123/members/456"))
+        self.assertEqual("/api/players/batch", get_endpoint_template("https://collegefootballrisk.com/api/players/batch?players=a"))
+
+    def test_to_dict(self):
+        report = self.cut.to_dict()
+        patches = [request for request in report["requests"] if request["method"] == "PATCH"]
+        self.assertEqual([{"host": "discord.com", "method": "PATCH", "endpoint": "/api/v9/guilds/{id}/members/{id}",
+                           "status": "200", "count": 2, "seconds": 1.0, "max_seconds": 0.75, "bytes": 200}], patches)
+        self.assertEqual({"discord.com": 2.0}, report["rate_limit_sleep_seconds"])
+        self.assertEqual(["nickname updates"], list(report["phases"]))
+        self.assertEqual({"risk_single_player_fallbacks": 3}, report["counters"])
+
+    def test_summary_table(self):
+        lines = self.cut.summary_table().splitlines()
+        self.assertTrue(lines[1].startswith("GET    /api/players"))
+        self.assertIn("Rate limit sleep on discord.com: 2.00 s", lines)
+
+    def test_to_prometheus(self):
+        text = self.cut.to_prometheus()
+        self.assertIn('cfbrisk_requests_total{host="discord.com",method="PATCH",'
+                      'endpoint="/api/v9/guilds/{id}/members/{id}",status="200"} 2', text)
+        self.assertIn('cfbrisk_rate_limit_sleep_seconds_total{host="discord.com"} 2.0', text)
+        self.assertIn('cfbrisk_events_total{event="risk_single_player_fallbacks"} 3', text)
+
+    def test_write_prometheus(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cfbrisk.prom")
+            self.cut.write_prometheus(path)
+            self.assertEqual(DEFAULT_FILE_MODE, stat.S_IMODE(os.stat(path).st_mode))
+            with open(path, 'r', encoding='utf-8') as file:
+                self.assertEqual(self.cut.to_prometheus(), file.read())
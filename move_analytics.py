@@ -0,0 +1,126 @@
+import unittest
+
+import numpy as np
+
+from risk_api import RiskApi
+
+MOVES_HEADER = ["Territory", "Team Players", "Team Stars", "Team Power", "Opponent Players", "Opponent Stars",
+                "Opponent Power", "Star Share", "Power Share", "Top Opponent", "Top Opponent Power", "Winner"]
+
+
+class TerritoryTurnTable:
+    def __init__(self, territory_turns: dict[str, dict]):
+        # One entry per player per territory so every aggregate is a single bincount
+        self.territories = list(territory_turns)
+        self.winners = [territory_turn.get("winner") or "" for territory_turn in territory_turns.values()]
+        self.team_ids = {}
+        territory_index, team_index, stars, power = [], [], [], []
+        for i, territory_turn in enumerate(territory_turns.values()):
+            for player in territory_turn.get("players") or []:
+                territory_index.append(i)
+                team_index.append(self.team_ids.setdefault(player["team"], len(self.team_ids)))
+                stars.append(player.get("stars") or 0)
+                power.append(player.get("power") or 0)
+        self.teams = list(self.team_ids)
+        self.territory_index = np.array(territory_index, dtype=np.intp)
+        self.team_index = np.array(team_index, dtype=np.intp)
+        self.stars = np.array(stars, dtype=np.float64)
+        self.power = np.array(power, dtype=np.float64)
+
+    def sum_by_territory_and_team(self, weights=None) -> np.ndarray:
+        shape = (len(self.territories), max(len(self.teams), 1))
+        cells = self.territory_index * shape[1] + self.team_index
+        return np.bincount(cells, weights=weights, minlength=shape[0] * shape[1]).reshape(shape)
+
+    def aggregate(self, team: str) -> dict[str, np.ndarray]:
+        players = self.sum_by_territory_and_team()
+        stars = self.sum_by_territory_and_team(self.stars)
+        power = self.sum_by_territory_and_team(self.power)
+        team_column = self.team_ids.get(team)
+        is_team = np.zeros(players.shape[1], dtype=bool)
+        if team_column is not None:
+            is_team[team_column] = True
+        opponent_power = np.where(is_team, -1.0, power)
+        top_opponent = opponent_power.argmax(axis=1)
+        team_stars, total_stars = stars[:, is_team].sum(axis=1), stars.sum(axis=1)
+        team_power, total_power = power[:, is_team].sum(axis=1), power.sum(axis=1)
+        return {
+            "team_players": players[:, is_team].sum(axis=1).astype(np.int64),
+            "team_stars": team_stars,
+            "team_power": team_power,
+            "opponent_players": players[:, ~is_team].sum(axis=1).astype(np.int64),
+            "opponent_stars": total_stars - team_stars,
+            "opponent_power": total_power - team_power,
+            "star_share": np.divide(team_stars, total_stars, out=np.zeros_like(team_stars), where=total_stars > 0),
+            "power_share": np.divide(team_power, total_power, out=np.zeros_like(team_power), where=total_power > 0),
+            "top_opponent": top_opponent,
+            "top_opponent_power": np.maximum(np.take_along_axis(opponent_power, top_opponent[:, None], axis=1)[:, 0], 0),
+        }
+
+
+class MoveAnalytics:
+    def __init__(self, risk_api: RiskApi):
+        self.risk_api = risk_api
+
+    def get_team_territories(self, season: int, day: int) -> list[str]:
+        # Player records only keep each player's latest move, which is the previous turn for anyone who played it
+        territories = set()
+        for player_info in self.risk_api.cache.player_info.values():
+            if player_info and (player_info.last_season, player_info.last_day) == (season, day) \
+                    and player_info.last_team == self.risk_api.team:
+                territories.add(player_info.last_territory)
+        return sorted(territories)
+
+    def get_table(self, turn=None) -> TerritoryTurnTable:
+        turn = turn or self.risk_api.get_previous_turn()
+        territories = self.get_team_territories(turn["season"], turn["day"])
+        return TerritoryTurnTable(self.risk_api.prefetch_territory_turns(turn["season"], turn["day"], territories))
+
+    def generate_rows(self, turn=None):
+        table = self.get_table(turn)
+        if not table.territories:
+            return
+        totals = table.aggregate(self.risk_api.team)
+        columns = [totals["team_players"].tolist(), np.round(totals["team_stars"], 2).tolist(),
+                   np.round(totals["team_power"], 2).tolist(), totals["opponent_players"].tolist(),
+                   np.round(totals["opponent_stars"], 2).tolist(), np.round(totals["opponent_power"], 2).tolist(),
+                   np.round(totals["star_share"], 4).tolist(), np.round(totals["power_share"], 4).tolist()]
+        for i, territory in enumerate(table.territories):
+            has_opponent = totals["top_opponent_power"][i] > 0
+            yield [territory, *[column[i] for column in columns],
+                   table.teams[totals["top_opponent"][i]] if has_opponent else "",
+                   round(float(totals["top_opponent_power"][i]), 2) if has_opponent else 0, table.winners[i]]
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        from risk_api import MockRiskApi
+        self.risk_api = MockRiskApi()
+        self.risk_api.team = "Aldi"
+        self.risk_api.get_batch_player_info(["EpicWolverine", "Mautamu"])
+        self.risk_api.get_player_info("user1")
+        self.cut = MoveAnalytics(self.risk_api)
+        self.turn = {"season": 1, "day": 18}
+
+    def test_get_team_territories(self):
+        self.assertEqual(["Alaska"], self.cut.get_team_territories(1, 18))
+        self.assertEqual([], self.cut.get_team_territories(1, 17))
+        self.assertEqual([], self.cut.get_team_territories(2, 50))
+
+    def test_generate_rows(self):
+        self.risk_api.get_player_info("EpicWolverine").last_day = 19
+        self.risk_api.get_player_info("EpicWolverine").last_territory = "Minnesota"
+        self.risk_api.cache.player_info["user1"].last_day = 19
+        rows = list(self.cut.generate_rows({"season": 1, "day": 19}))
+        self.assertEqual([["Alaska", 1, 4.0, 4.0, 2, 8.0, 10.5, 0.3333, 0.2759, "Ohio State", 7.5, "Aldi"],
+                          ["Minnesota", 1, 3.0, 3.0, 2, 6.0, 6.0, 0.3333, 0.3333, "Texas A&M", 4.0, "Ohio State"]],
+                         rows)
+        self.assertEqual(["Alaska", "Minnesota"], sorted(self.risk_api._get_territory_turn_api_data_territories))
+
+    def test_no_opponents(self):
+        table = TerritoryTurnTable({"Alaska": {"winner": "Aldi", "players": [
+            {"team": "Aldi", "player": "EpicWolverine", "stars": 4, "power": 4}]}, "Ohio": {"players": []}})
+        totals = table.aggregate("Aldi")
+        self.assertEqual([1, 0], totals["team_players"].tolist())
+        self.assertEqual([0.0, 0.0], totals["top_opponent_power"].tolist())
+        self.assertEqual([1.0, 0.0], totals["power_share"].tolist())
@@ -0,0 +1,106 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+DEFAULT_JOURNAL_PATH = "nickname_journal.jsonl"
+
+
+class NicknameJournal:
+    # Append-only JSON lines: the run key and its plan are written before any PATCH, then one line per completed update
+    def __init__(self, path=DEFAULT_JOURNAL_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    @staticmethod
+    def make_key(guild_id: str, turn: dict) -> str:
+        return f"{guild_id}/{turn['id'] if turn else None}"
+
+    def load(self, key: str):
+        # Returns the planned updates still left to make, or None if there is nothing to resume for this key
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return None
+        planned = None
+        completed = set()
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line cut off by a crash mid-write is the only one that can be torn
+                break
+            if "run" in entry:
+                if entry["run"] != key:
+                    return None
+                planned = [tuple(update) for update in entry["plan"]]
+            elif "done" in entry:
+                completed.add(entry["done"])
+            elif entry.get("complete"):
+                return []
+        if planned is None:
+            return None
+        return [update for update in planned if update[0] not in completed]
+
+    def begin(self, key: str, plan: list[tuple[str, str, str]]):
+        self.close()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile("w", encoding='utf-8', dir=directory, delete=False) as file:
+            file.write(json.dumps({"run": key, "plan": plan}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(file.name, self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def record_done(self, discord_id: str, nickname: str):
+        self.append({"done": discord_id, "nick": nickname})
+
+    def finish(self):
+        self.append({"complete": True})
+        self.close()
+
+    def append(self, entry: dict):
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.cut = NicknameJournal(os.path.join(self.directory.name, "nickname_journal.jsonl"))
+        self.key = NicknameJournal.make_key("123", {"id": 19})
+
+    def tearDown(self) -> None:
+        self.cut.close()
+        self.directory.cleanup()
+
+    def test_nothing_to_resume(self):
+        self.assertIsNone(self.cut.load(self.key))
+
+    def test_resume_skips_completed(self):
+        self.cut.begin(self.key, [("1", None, "a ⭐"), ("2", "b ⭐", "b ⭐⭐"), ("3", "c", "c ⭐⭐⭐")])
+        self.cut.record_done("2", "b ⭐⭐")
+        self.cut.close()
+        self.assertEqual([("1", None, "a ⭐"), ("3", "c", "c ⭐⭐⭐")], NicknameJournal(self.cut.path).load(self.key))
+        self.assertIsNone(self.cut.load(NicknameJournal.make_key("123", {"id": 20})))
+
+    def test_torn_line_and_finish(self):
+        self.cut.begin(self.key, [("1", None, "a ⭐"), ("2", None, "b ⭐⭐")])
+        self.cut.record_done("1", "a ⭐")
+        self.cut.file.write('{"done": "2", "ni')
+        self.cut.close()
+        self.assertEqual([("2", None, "b ⭐⭐")], self.cut.load(self.key))
+        self.cut.begin(self.key, [("2", None, "b ⭐⭐")])
+        self.cut.finish()
+        self.assertEqual([], self.cut.load(self.key))
@@ -0,0 +1,215 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+from contextlib import contextmanager
+
+from logger import Logger
+
+DEFAULT_REPORT_PATH = "profile_report.txt"
+UNSAFE_FILE_CHARACTERS = re.compile(r"[^\w.-]+")
+
+
+class PhaseStats:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_bytes = 0
+        self.allocations = {}
+        self.stats = None
+        self.unprofiled_calls = 0
+
+
+class PhaseFrame:
+    def __init__(self, name: str):
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.peak_bytes = 0
+        self.profiled = True
+        self.start_snapshot = tracemalloc.take_snapshot()
+
+
+class PhaseProfiler:
+    # Only used behind -profile: Metrics.phase skips all of this when no profiler is set
+    def __init__(self, report_path=DEFAULT_REPORT_PATH, pstats_directory=None, top=20, frames=1):
+        self.report_path = report_path
+        self.pstats_directory = pstats_directory
+        self.top = top
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.phases = {}
+        self.logger = Logger()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def get_stack(self) -> list[PhaseFrame]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def profile(self, name: str):
+        # Nested phases are profiled on their own, so each phase's CPU time and allocations exclude its sub-phases
+        stack = self.get_stack()
+        if stack:
+            self.pause(stack[-1])
+        frame = PhaseFrame(name)
+        stack.append(frame)
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        self.resume(frame)
+        try:
+            yield
+        finally:
+            self.pause(frame)
+            seconds = time.perf_counter() - start
+            cpu_seconds = time.thread_time() - cpu_start
+            stack.pop()
+            self.record(frame, seconds, cpu_seconds, tracemalloc.take_snapshot())
+            if stack:
+                stack[-1].peak_bytes = max(stack[-1].peak_bytes, frame.peak_bytes)
+                tracemalloc.reset_peak()
+                self.resume(stack[-1])
+
+    @staticmethod
+    def pause(frame: PhaseFrame):
+        frame.profile.disable()
+        frame.peak_bytes = max(frame.peak_bytes, tracemalloc.get_traced_memory()[1])
+
+    def resume(self, frame: PhaseFrame):
+        try:
+            frame.profile.enable()
+        except ValueError as e:
+            # Another thread's phase holds the profiler on interpreters that allow only one
+            if frame.profiled:
+                self.logger.warning(f"Phase {frame.name} is not CPU profiled: {e}")
+            frame.profiled = False
+
+    def record(self, frame: PhaseFrame, seconds: float, cpu_seconds: float, end_snapshot):
+        allocations = end_snapshot.compare_to(frame.start_snapshot, "lineno")
+        with self.lock:
+            phase = self.phases.setdefault(frame.name, PhaseStats())
+            phase.calls += 1
+            phase.seconds += seconds
+            phase.cpu_seconds += cpu_seconds
+            phase.peak_bytes = max(phase.peak_bytes, frame.peak_bytes)
+            if not frame.profiled:
+                phase.unprofiled_calls += 1
+            for statistic in allocations:
+                if statistic.size_diff > 0:
+                    site = str(statistic.traceback)
+                    phase.allocations[site] = phase.allocations.get(site, 0) + statistic.size_diff
+            try:
+                stats = pstats.Stats(frame.profile)
+            except TypeError:
+                # Nothing was profiled
+                return
+            if phase.stats is None:
+                phase.stats = stats
+            else:
+                phase.stats.add(stats)
+
+    def format_report(self) -> str:
+        sections = []
+        with self.lock:
+            for name, phase in self.phases.items():
+                lines = [f"=== Phase {name}: {phase.calls} call(s), {phase.seconds:.3f} s wall, "
+                         f"{phase.cpu_seconds:.3f} s CPU ({phase.seconds - phase.cpu_seconds:.3f} s waiting), "
+                         f"peak traced memory {phase.peak_bytes / 1024 / 1024:.1f} MiB"]
+                if phase.unprofiled_calls:
+                    lines.append(f"{phase.unprofiled_calls} call(s) were not CPU profiled because another thread's "
+                                 f"phase held the profiler, so the functions below are incomplete.")
+                lines.append(f"Top {self.top} allocation sites still held at the end of the phase:")
+                for site, size in sorted(phase.allocations.items(), key=lambda item: -item[1])[:self.top]:
+                    lines.append(f"{size / 1024:>12.1f} KiB  {site}")
+                if phase.stats is not None:
+                    output = io.StringIO()
+                    phase.stats.stream = output
+                    phase.stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+                    lines.append(output.getvalue().strip())
+                sections.append("\n".join(lines))
+        return "\n\n".join(sections) + "\n"
+
+    def write_report(self):
+        directory = os.path.dirname(os.path.abspath(self.report_path))
+        with tempfile.NamedTemporaryFile("w", encoding='utf-8', dir=directory, delete=False) as file:
+            file.write(self.format_report())
+        os.replace(file.name, self.report_path)
+        if self.pstats_directory:
+            os.makedirs(self.pstats_directory, exist_ok=True)
+            with self.lock:
+                for name, phase in self.phases.items():
+                    if phase.stats is not None:
+                        phase.stats.dump_stats(os.path.join(self.pstats_directory,
+                                                            f"{UNSAFE_FILE_CHARACTERS.sub('_', name)}.pstats"))
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}
+
+
+def build_strings(count: int) -> list[str]:
+    return [f"member{i} ⭐⭐⭐" for i in range(count)]
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.was_tracing = tracemalloc.is_tracing()
+        self.cut = PhaseProfiler(os.path.join(self.directory.name, "profile_report.txt"),
+                                 os.path.join(self.directory.name, "pstats"), top=5)
+
+    def tearDown(self) -> None:
+        if not self.was_tracing:
+            tracemalloc.stop()
+        self.directory.cleanup()
+
+    def test_nested_phases(self):
+        with self.cut.profile("csv generation"):
+            with self.cut.profile("star caching"):
+                kept = build_strings(20000)
+            time.sleep(0.05)
+        self.assertEqual(["star caching", "csv generation"], list(self.cut.phases))
+        csv_phase = self.cut.phases["csv generation"]
+        self.assertGreaterEqual(csv_phase.seconds - csv_phase.cpu_seconds, 0.04)
+        self.assertGreater(self.cut.phases["star caching"].peak_bytes, 1024 * 1024)
+        star_functions = {function for _, _, function in self.cut.phases["star caching"].stats.stats}
+        csv_functions = {function for _, _, function in csv_phase.stats.stats}
+        self.assertIn("build_strings", star_functions)
+        self.assertNotIn("build_strings", csv_functions)
+        self.assertTrue(any("phase_profiler.py" in site for site in self.cut.phases["star caching"].allocations))
+        self.assertEqual(20000, len(kept))
+
+    def test_reports_unprofiled_phases(self):
+        class BusyProfile(cProfile.Profile):
+            def enable(self, *args, **kwargs):
+                raise ValueError("Another profiling tool is already active")
+
+        frame = PhaseFrame("member paging")
+        frame.profile = BusyProfile()
+        self.cut.resume(frame)
+        self.cut.pause(frame)
+        self.cut.record(frame, 0.1, 0.1, tracemalloc.take_snapshot())
+        self.assertEqual(1, self.cut.phases["member paging"].unprofiled_calls)
+        self.assertIn("=== Phase member paging: 1 call(s)", self.cut.format_report())
+        self.assertIn("1 call(s) were not CPU profiled", self.cut.format_report())
+
+    def test_write_report(self):
+        for _ in range(2):
+            with self.cut.profile("nickname updates"):
+                build_strings(100)
+        self.cut.write_report()
+        with open(self.cut.report_path, 'r', encoding='utf-8') as file:
+            report = file.read()
+        self.assertIn("=== Phase nickname updates: 2 call(s)", report)
+        self.assertIn("build_strings", report)
+        self.assertEqual(["nickname_updates.pstats"], os.listdir(self.cut.pstats_directory))
+        pstats.Stats(os.path.join(self.cut.pstats_directory, "nickname_updates.pstats"))
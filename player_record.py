@@ -0,0 +1,199 @@
+import codecs
+import json
+import sys
+import tracemalloc
+import unittest
+
+JSON_WHITESPACE = " \t\r\n"
+
+
+class PlayerRecord:
+    # Only what the reports read. The full turn history is dropped as soon as a player is parsed.
+    __slots__ = ("name", "team", "overall", "last_season", "last_day", "last_territory", "last_team",
+                 "total_turns", "total_turns_rating", "game_turns", "game_turns_rating", "mvps", "mvps_rating",
+                 "streak", "streak_rating")
+
+    def __init__(self, name, team=None, overall=None, last_season=None, last_day=None, last_territory=None,
+                 last_team=None, total_turns=None, total_turns_rating=None, game_turns=None, game_turns_rating=None,
+                 mvps=None, mvps_rating=None, streak=None, streak_rating=None):
+        self.name = name
+        self.team = team
+        self.overall = overall
+        self.last_season = last_season
+        self.last_day = last_day
+        self.last_territory = last_territory
+        self.last_team = last_team
+        self.total_turns = total_turns
+        self.total_turns_rating = total_turns_rating
+        self.game_turns = game_turns
+        self.game_turns_rating = game_turns_rating
+        self.mvps = mvps
+        self.mvps_rating = mvps_rating
+        self.streak = streak
+        self.streak_rating = streak_rating
+
+    @classmethod
+    def from_json(cls, player: dict):
+        stats = player.get("stats") or {}
+        ratings = player.get("ratings") or {}
+        turns = player.get("turns") or []
+        last_turn = turns[0] if turns else {}
+        # Team and territory names repeat across thousands of players, so they are interned and shared
+        return cls(player["name"], intern((player.get("team") or {}).get("name")), ratings.get("overall"),
+                   last_turn.get("season"), last_turn.get("day"), intern(last_turn.get("territory")),
+                   intern(last_turn.get("team")), stats.get("totalTurns"), ratings.get("totalTurns"),
+                   stats.get("gameTurns"), ratings.get("gameTurns"), stats.get("mvps"), ratings.get("mvps"),
+                   stats.get("streak"), ratings.get("streak"))
+
+    @classmethod
+    def from_dict(cls, record: dict):
+        # Snapshots written before records were compacted hold the raw players/batch JSON
+        if "ratings" in record:
+            return cls.from_json(record)
+        return cls(**record)
+
+    def to_dict(self) -> dict:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __eq__(self, other):
+        return isinstance(other, PlayerRecord) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"PlayerRecord({', '.join(f'{slot}={getattr(self, slot)!r}' for slot in self.__slots__)})"
+
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def decode_chunks(chunks, encoding="utf-8"):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+def iter_json_array(chunks):
+    # Yields the elements of a JSON array as they arrive, holding at most one undecoded element in memory
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ""
+    position = 0
+    opened = False
+    expect_value = True
+    empty = True
+    exhausted = False
+
+    def read(wanted: int):
+        nonlocal buffer, position, exhausted
+        pending = [buffer[position:]]
+        size = len(pending[0])
+        while size < wanted and not exhausted:
+            chunk = next(chunks, None)
+            if chunk is None:
+                exhausted = True
+            else:
+                pending.append(chunk)
+                size += len(chunk)
+        buffer = "".join(pending)
+        position = 0
+
+    while True:
+        while position < len(buffer) and buffer[position] in JSON_WHITESPACE:
+            position += 1
+        if position == len(buffer):
+            if exhausted:
+                raise ValueError("Truncated JSON array")
+            read(1)
+            continue
+        char = buffer[position]
+        if not opened:
+            if char != "[":
+                raise ValueError(f"Expected a JSON array, got {char!r}")
+            opened = True
+            position += 1
+        elif char == "]" and (not expect_value or empty):
+            return
+        elif char == "," and not expect_value:
+            expect_value = True
+            position += 1
+        elif not expect_value:
+            raise ValueError(f"Expected ',' or ']' in JSON array, got {char!r}")
+        else:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+                # Doubling what is buffered keeps re-decoding a large element linear overall
+                read(2 * (len(buffer) - position))
+                continue
+            if end == len(buffer) and not exhausted:
+                # A number at the end of the buffer may continue in the next chunk
+                read(2 * (len(buffer) - position))
+                continue
+            yield value
+            expect_value = False
+            empty = False
+            position = end
+            if position > 65536:
+                buffer = buffer[position:]
+                position = 0
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.player = {"name": "EpicWolverine", "platform": "reddit", "team": {"name": "Aldi"},
+                       "ratings": {"awards": 5, "gameTurns": 3, "mvps": 4, "overall": 4, "streak": 4, "totalTurns": 5},
+                       "stats": {"awards": 5, "gameTurns": 18, "mvps": 10, "streak": 18, "totalTurns": 113},
+                       "turns": [{"day": 18, "mvp": True, "season": 1, "stars": 4, "team": "Aldi",
+                                  "territory": "Alaska"},
+                                 {"day": 17, "mvp": False, "season": 1, "stars": 4, "team": "Aldi",
+                                  "territory": "Minnesota"}]}
+
+    def test_from_json(self):
+        record = PlayerRecord.from_json(self.player)
+        self.assertEqual(("EpicWolverine", "Aldi", 4), (record.name, record.team, record.overall))
+        self.assertEqual((1, 18, "Alaska", "Aldi"),
+                         (record.last_season, record.last_day, record.last_territory, record.last_team))
+        self.assertEqual((113, 5, 18, 3, 10, 4, 18, 4),
+                         (record.total_turns, record.total_turns_rating, record.game_turns, record.game_turns_rating,
+                          record.mvps, record.mvps_rating, record.streak, record.streak_rating))
+        self.assertFalse(hasattr(record, "__dict__"))
+
+    def test_round_trip(self):
+        record = PlayerRecord.from_json(self.player | {"team": None, "turns": []})
+        self.assertIsNone(record.last_day)
+        self.assertEqual(record, PlayerRecord.from_dict(json.loads(json.dumps(record.to_dict()))))
+        self.assertEqual(PlayerRecord.from_json(self.player), PlayerRecord.from_dict(self.player))
+
+    def test_iter_json_array(self):
+        players = [self.player | {"name": f"Player_{i}", "stats": {"totalTurns": 10 ** i}} for i in range(5)]
+        text = json.dumps(players, indent=1)
+        for chunk_size in (1, 7, 4096):
+            chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+            self.assertEqual(players, list(iter_json_array(chunks)))
+        self.assertEqual([], list(iter_json_array([" [ ", "]"])))
+        self.assertEqual([12, 345], list(iter_json_array(["[1", "2,3", "4", "5]"])))
+        self.assertEqual(["é"], list(iter_json_array(decode_chunks([b'["\xc3', b'\xa9"]']))))
+
+    def test_iter_json_array_rejects_malformed(self):
+        for text in ('{"name": "a"}', '[{"name": "a"}', '[{"name": "a"} {"name": "b"}]', '[{"name": '):
+            with self.assertRaises(ValueError):
+                list(iter_json_array([text]))
+
+    def test_streaming_lowers_peak_memory(self):
+        history = [{"season": 1, "day": day, "stars": 3, "mvp": False, "territory": "Ann Arbor", "team": "Aldi"}
+                   for day in range(2000, 0, -1)]
+        body = json.dumps([self.player | {"name": f"Player_{i}", "turns": history} for i in range(20)]).encode()
+        del history
+        chunks = [body[i:i + 64 * 1024] for i in range(0, len(body), 64 * 1024)]
+        peaks = []
+        for parse in (lambda: [PlayerRecord.from_json(player) for player in json.loads(b"".join(chunks))],
+                      lambda: [PlayerRecord.from_json(player) for player in iter_json_array(decode_chunks(chunks))]):
+            tracemalloc.start()
+            records = parse()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            self.assertEqual(20, len(records))
+        self.assertLess(peaks[1] * 5, peaks[0])
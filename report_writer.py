@@ -0,0 +1,147 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from atomic_file import DEFAULT_FILE_MODE, replace_atomically
+
+
+class ReportWriter:
+    extension = ""
+
+    def __init__(self, path: str, header: list[str]):
+        self.path = path
+        self.header = header
+        self.file = None
+        self.row_count = 0
+
+    def __enter__(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        self.file = tempfile.NamedTemporaryFile("w", encoding='utf-8', newline='', dir=directory,
+                                                prefix=".", suffix=".tmp", delete=False)
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.finish()
+            self.file.close()
+            if exc_type is None:
+                replace_atomically(self.file.name, self.path)
+        finally:
+            if os.path.exists(self.file.name):
+                os.remove(self.file.name)
+        return False
+
+    def open(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def write_row(self, row: list):
+        self.row_count += 1
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+
+class CsvReportWriter(ReportWriter):
+    extension = ".csv"
+
+    def open(self):
+        self.writer = csv.writer(self.file, lineterminator="\n")
+        self.writer.writerow(self.header)
+
+    def write_row(self, row: list):
+        super().write_row(row)
+        self.writer.writerow(row)
+
+
+class JsonLinesReportWriter(ReportWriter):
+    extension = ".jsonl"
+
+    def write_row(self, row: list):
+        super().write_row(row)
+        self.file.write(json.dumps(dict(zip(self.header, row)), ensure_ascii=False))
+        self.file.write("\n")
+
+
+class ColumnarReportWriter(ReportWriter):
+    extension = ".columns.json"
+
+    def open(self):
+        # Each column is spooled to its own temporary file so memory stays flat until they are stitched together
+        self.column_files = [tempfile.TemporaryFile("w+", encoding='utf-8') for _ in self.header]
+
+    def write_row(self, row: list):
+        separator = "," if self.row_count else ""
+        super().write_row(row)
+        for column_file, value in zip(self.column_files, row):
+            column_file.write(separator + json.dumps(value, ensure_ascii=False))
+
+    def finish(self):
+        self.file.write('{"rows": %d, "columns": {' % self.row_count)
+        for i, (name, column_file) in enumerate(zip(self.header, self.column_files)):
+            self.file.write(("," if i else "") + json.dumps(name, ensure_ascii=False) + ": [")
+            column_file.seek(0)
+            shutil.copyfileobj(column_file, self.file)
+            self.file.write("]")
+        self.file.write("}}\n")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return super().__exit__(exc_type, exc_value, traceback)
+        finally:
+            for column_file in self.column_files:
+                column_file.close()
+
+
+REPORT_WRITERS = {"csv": CsvReportWriter, "jsonl": JsonLinesReportWriter, "columns": ColumnarReportWriter}
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.header = ["Reddit Name", "Last Turn Territory", "Overall Stars", "Has Verified Role"]
+        self.rows = [["EpicWolverine", "Ann Arbor, MI", 4, True], ["PM_me_your_moves", "", 1, False]]
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def write(self, writer_class):
+        path = os.path.join(self.directory.name, "report" + writer_class.extension)
+        with writer_class(path, self.header) as writer:
+            writer.write_rows(iter(self.rows))
+        self.assertEqual([os.path.basename(path)], os.listdir(self.directory.name))
+        self.assertEqual(DEFAULT_FILE_MODE, os.stat(path).st_mode & 0o777)
+        with open(path, 'r', encoding='utf-8', newline='') as file:
+            return file.read()
+
+    def test_csv(self):
+        expected = "Reddit Name,Last Turn Territory,Overall Stars,Has Verified Role\n" \
+                   "EpicWolverine,\"Ann Arbor, MI\",4,True\n" \
+                   "PM_me_your_moves,,1,False\n"
+        self.assertEqual(expected, self.write(CsvReportWriter))
+
+    def test_json_lines(self):
+        lines = self.write(JsonLinesReportWriter).splitlines()
+        self.assertEqual([dict(zip(self.header, row)) for row in self.rows], [json.loads(line) for line in lines])
+
+    def test_columnar(self):
+        expected = {"rows": 2, "columns": {"Reddit Name": ["EpicWolverine", "PM_me_your_moves"],
+                                           "Last Turn Territory": ["Ann Arbor, MI", ""],
+                                           "Overall Stars": [4, 1], "Has Verified Role": [True, False]}}
+        self.assertEqual(expected, json.loads(self.write(ColumnarReportWriter)))
+
+    def test_failed_write_leaves_no_file(self):
+        path = os.path.join(self.directory.name, "report.csv")
+        with self.assertRaises(KeyError):
+            with CsvReportWriter(path, self.header) as writer:
+                writer.write_row(self.rows[0])
+                raise KeyError("turns")
+        self.assertEqual([], os.listdir(self.directory.name))
@@ -1,52 +1,128 @@
 import json
-import requests
+import os
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
+from requests import HTTPError, RequestException
+
+from disk_cache import DiskCache
+from http_transport import get_default_transport
 from logger import Logger
+from metrics import metrics
+from player_record import PlayerRecord, decode_chunks, iter_json_array
 from settings_manager import SettingsManager
+from turn_index import TurnIndex
 
 MAX_BATCH_SIZE = 400
+MAX_CHUNK_ATTEMPTS = 3
+STREAM_CHUNK_SIZE = 64 * 1024
 
 
 class RiskApiCache:
+    # Rosters are keyed by team so one cache can be shared by several RiskApi instances
     def __init__(self):
-        self.players = None
-        self.mercs = None
+        self.players = {}
+        self.mercs = {}
+        self.player_info = {}
+        self.turn_index = TurnIndex()
+        self.turns_synced = False
+        self.territory_turn = {}
+        self.turns_lock = threading.Lock()
+        # Lowercased names of players the API does not know, mapped to when to ask again. Kept across resets.
+        self.missing_players = {}
+
+    def reset(self):
+        self.players = {}
+        self.mercs = {}
         self.player_info = {}
-        self.turns = None
         self.territory_turn = {}
 
 
 class RiskApi:
-    def __init__(self):
+    def __init__(self, settings=None, cache=None):
         self.api_base_url = "https://collegefootballrisk.com/api"
-        self.cache = RiskApiCache()
-        self.team = SettingsManager().get_team_name()
+        self.cache = cache if cache is not None else RiskApiCache()
+        settings = settings or SettingsManager()
+        self.team = settings.get_team_name()
+        self.max_concurrent_requests = settings.get_risk_max_concurrent_requests()
+        self.max_batch_size = MAX_BATCH_SIZE
+        self.stream_batch = settings.get_risk_stream_batch()
+        self.missing_player_ttl_seconds = settings.get_risk_missing_player_ttl_hours() * 3600
         self.logger = Logger()
+        self.transport = get_default_transport()
+        self.disk_cache = None
+        self.player_snapshot = None
+        self.player_snapshot_path = None
+
+    def use_disk_cache(self, disk_cache: DiskCache):
+        self.disk_cache = disk_cache
+        self.cache.missing_players.update(disk_cache.get_metadata("missing_players") or {})
 
     def _call_api(self, endpoint, params=None):
+        if self.disk_cache is None:
+            return self._request_api(endpoint, params)
+        # Turns are always synced first so a newly completed turn invalidates everything else in the disk cache
+        self.get_turns()
+        key = DiskCache.make_key(endpoint, params)
+        response = self.disk_cache.get(key)
+        if response is None:
+            response = self._request_api(endpoint, params)
+            self.disk_cache.set(key, response)
+        else:
+            self.logger.debug(f"Using cached GET {self.api_base_url}/{endpoint} {params=}")
+        return response
+
+    def _request_api(self, endpoint, params=None):
         api_url = f"{self.api_base_url}/{endpoint}"
-        self.logger.log(f"Calling GET {api_url} {params=}")
+        self.logger.debug(f"Calling GET {api_url} {params=}")
         headers = {"Content-Type": "application/json"}
-        return requests.get(api_url, headers=headers, params=params).json()
+        r = self.transport.get(api_url, headers=headers, params=params)
+        # Error bodies are JSON too, and one must never be cached as if it were the data
+        r.raise_for_status()
+        return r.json()
+
+    def _stream_api(self, endpoint, params=None):
+        api_url = f"{self.api_base_url}/{endpoint}"
+        self.logger.debug(f"Streaming GET {api_url} {params=}")
+        headers = {"Content-Type": "application/json"}
+        with self.transport.get(api_url, headers=headers, params=params, stream=True) as r:
+            r.raise_for_status()
+            yield from iter_json_array(decode_chunks(r.iter_content(STREAM_CHUNK_SIZE)))
 
     def _get_team_api_data(self, endpoint):
         return self._call_api(endpoint, {"team": self.team})
 
     def get_players(self):
-        if self.cache.players is None:
-            self.cache.players = self._get_team_api_data("players")
-        return self.cache.players
+        if self.team not in self.cache.players:
+            self.cache.players[self.team] = self._get_team_api_data("players")
+        return self.cache.players[self.team]
 
     def get_mercs(self):
-        if self.cache.mercs is None:
-            self.cache.mercs = self._get_team_api_data("mercs")
-        return self.cache.mercs
+        if self.team not in self.cache.mercs:
+            self.cache.mercs[self.team] = self._get_team_api_data("mercs")
+        return self.cache.mercs[self.team]
+
+    def get_players_and_mercs(self) -> tuple[list[dict], list[dict]]:
+        players, mercs = self.map_concurrently(lambda get: get(), [self.get_players, self.get_mercs])
+        return players, mercs
+
+    def map_concurrently(self, func, items: list) -> list:
+        if len(items) <= 1 or self.max_concurrent_requests <= 1:
+            return [func(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrent_requests, len(items))) as pool:
+            return list(pool.map(func, items))
 
     def get_player_stars(self, player_names: list):
         player_stars = {}
         for player_name in player_names:
-            player_stars[player_name] = self.get_player_info(player_name)["ratings"]["overall"]
+            player_info = self.get_player_info(player_name)
+            if player_info is None:
+                self.logger.warning(f"Leaving \"{player_name}\" out of the stars: the Risk API does not know them.")
+            else:
+                player_stars[player_name] = player_info.overall
         return player_stars
 
     def get_merc_stars(self, mercs: list[dict]):
@@ -58,33 +134,207 @@ class RiskApi:
     def _get_player_api_data(self, player_name):
         return self._call_api("player", {"player": player_name})
 
+    def is_missing_player(self, player_name: str) -> bool:
+        return self.cache.missing_players.get(player_name.lower(), 0) > time.time()
+
+    def mark_missing_players(self, player_names: list):
+        if not player_names:
+            return
+        self.logger.warning(f"{len(player_names)} players are not known to the Risk API and will not be requested "
+                            f"again for {self.missing_player_ttl_seconds / 3600:g} hours: {', '.join(player_names)}")
+        expires = time.time() + self.missing_player_ttl_seconds
+        for player_name in player_names:
+            self.cache.missing_players[player_name.lower()] = expires
+        metrics.increment("risk_missing_players", len(player_names))
+        if self.disk_cache is not None:
+            now = time.time()
+            self.disk_cache.set_metadata("missing_players", {name: expiry for name, expiry
+                                                             in self.cache.missing_players.items() if expiry > now})
+
     def get_player_info(self, player_name):
-        if player_name not in self.cache.player_info or self.cache.player_info[player_name] is None:
-            self.cache.player_info[player_name] = self._get_player_api_data(player_name)
+        if not self.cache.player_info.get(player_name) and not self.is_missing_player(player_name):
+            if self._get_single_player_info(player_name) is None:
+                self.mark_missing_players([player_name])
+        return self.cache.player_info.get(player_name)
+
+    def _get_single_player_info(self, player_name):
+        # Every roster name should already have come back from players/batch, so each of these is counted
+        metrics.increment("risk_single_player_fallbacks")
+        try:
+            player = self._get_player_api_data(player_name)
+        except HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            player = None
+        self.cache.player_info[player_name] = PlayerRecord.from_json(player) if player is not None else None
         return self.cache.player_info[player_name]
 
     def _get_batch_player_api_data(self, player_names):
         if player_names:
-            players_data = []
-            for i in range(0, len(player_names), MAX_BATCH_SIZE):
-                players_data += self._call_api("players/batch", {"players": ','.join(player_names[i:i + MAX_BATCH_SIZE])})
-            return players_data
+            chunks = [player_names[i:i + self.max_batch_size] for i in range(0, len(player_names), self.max_batch_size)]
+            return [player for chunk_data in self.map_concurrently(self._get_batch_chunk_api_data, chunks)
+                    for player in chunk_data]
         return []
 
-    def get_batch_player_info(self, player_names: list) -> list[dict]:
-        players_info = self._get_batch_player_api_data(player_names)
-        for player in players_info:
-            self.cache.player_info[player["name"]] = player
-        return players_info
+    def _get_batch_chunk_api_data(self, player_names) -> list[PlayerRecord]:
+        params = {"players": ','.join(player_names)}
+        for attempt in range(1, MAX_CHUNK_ATTEMPTS + 1):
+            try:
+                if self.stream_batch:
+                    return self._stream_batch_records(params)
+                # Compacting each chunk as it arrives frees its turn histories before the next chunk is decoded
+                return [PlayerRecord.from_json(player) for player in self._call_api("players/batch", params)]
+            except (RequestException, ValueError) as e:
+                if attempt == MAX_CHUNK_ATTEMPTS:
+                    raise
+                self.logger.warning(f"Batch of {len(player_names)} players starting with \"{player_names[0]}\" failed: {e}. "
+                                f"Retrying.")
+                time.sleep(attempt)
+
+    def _stream_batch_records(self, params) -> list[PlayerRecord]:
+        # Each player is compacted as soon as it is decoded, so neither the response body nor the decoded list is held
+        if self.disk_cache is None:
+            return [PlayerRecord.from_json(player) for player in self._stream_api("players/batch", params)]
+        self.get_turns()
+        key = DiskCache.make_key("players/batch records", params)
+        cached = self.disk_cache.get(key)
+        if cached is not None:
+            self.logger.debug(f"Using cached GET {self.api_base_url}/players/batch {params=}")
+            return [PlayerRecord.from_dict(record) for record in cached]
+        records = [PlayerRecord.from_json(player) for player in self._stream_api("players/batch", params)]
+        self.disk_cache.set(key, [record.to_dict() for record in records])
+        return records
+
+    def get_batch_player_info(self, player_names: list) -> list[PlayerRecord]:
+        player_names = list(dict.fromkeys(player_names))
+        # Players already fetched through a shared cache, such as mercs on another team's roster, are not fetched again
+        names = [name for name in player_names if not self.cache.player_info.get(name) and not self.is_missing_player(name)]
+        if names:
+            # The API may answer with different casing, so results are matched to the requested names case-insensitively
+            records = {player.name.lower(): player for player in self._get_batch_player_api_data(names)}
+            misses = [name for name in names if name.lower() not in records]
+            if misses:
+                # All the names a batch left out go into one more batch instead of one request each
+                metrics.increment("risk_batch_backfills")
+                self.logger.log(f"{len(misses)} players were missing from the batch results. Requesting them again.")
+                records |= {player.name.lower(): player for player in self._get_batch_player_api_data(misses)}
+                # Only a name the single player endpoint does not know either is treated as missing
+                misses = [name for name in misses if name.lower() not in records]
+                found = self.map_concurrently(self._get_single_player_info, misses)
+                self.mark_missing_players([name for name, record in zip(misses, found) if record is None])
+            for name in names:
+                record = records.get(name.lower())
+                if record is not None:
+                    self.cache.player_info[name] = record
+                    self.cache.player_info[record.name] = record
+        return [self.cache.player_info[name] for name in player_names if self.cache.player_info.get(name)]
+
+    def use_player_snapshot(self, path: str):
+        self.player_snapshot_path = path
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                self.player_snapshot = json.load(file)
+        except FileNotFoundError:
+            self.player_snapshot = {}
+
+    def save_player_snapshot(self):
+        directory = os.path.dirname(os.path.abspath(self.player_snapshot_path))
+        with tempfile.NamedTemporaryFile("w", encoding='utf-8', dir=directory, delete=False) as file:
+            json.dump(self.player_snapshot, file)
+        os.replace(file.name, self.player_snapshot_path)
+
+    @staticmethod
+    def get_player_signature(team_entry: dict) -> list:
+        # Anything that changes when a player or merc plays a turn
+        return [team_entry.get("turnsPlayed"), team_entry.get("mvps"), team_entry.get("lastTurn"), team_entry.get("stars")]
+
+    def get_incremental_batch_player_info(self, team_entries: list[dict]) -> list[PlayerRecord]:
+        # Keyed by the roster's spelling of each name, and players who left the roster are dropped
+        roster = {team_entry["player"] for team_entry in team_entries}
+        self.player_snapshot = {name: entry for name, entry in self.player_snapshot.items() if name in roster}
+        changed_names = []
+        for team_entry in team_entries:
+            snapshot = self.player_snapshot.get(team_entry["player"])
+            if snapshot is not None and snapshot["signature"] == self.get_player_signature(team_entry):
+                self.cache.player_info[team_entry["player"]] = PlayerRecord.from_dict(snapshot["info"])
+            else:
+                changed_names.append(team_entry["player"])
+        self.logger.log(f"{len(changed_names)} of {len(team_entries)} players changed since the last run.")
+        self.get_batch_player_info(changed_names)
+        for team_entry in team_entries:
+            record = self.cache.player_info.get(team_entry["player"])
+            if record is not None:
+                self.player_snapshot[team_entry["player"]] = {"signature": self.get_player_signature(team_entry),
+                                                              "info": record.to_dict()}
+        records = []
+        for team_entry in team_entries:
+            if team_entry["player"] in self.player_snapshot:
+                info = self.player_snapshot[team_entry["player"]]["info"]
+                records.append(self.cache.player_info.get(team_entry["player"]) or PlayerRecord.from_dict(info))
+        return records
+
+    def use_turn_index(self, path: str):
+        with self.cache.turns_lock:
+            self.cache.turn_index = TurnIndex.load(path)
+            self.cache.turns_synced = False
 
-    def _get_turns_api_data(self) -> list[dict]:
-        return self._call_api(f"turns")
+    def _get_turns_api_data(self):
+        # The API only serves the whole list. Its validators are kept from the first fetch so later ones can be
+        # conditional, and None means nothing changed.
+        index = self.cache.turn_index
+        api_url = f"{self.api_base_url}/turns"
+        headers = {"Content-Type": "application/json"}
+        if index.etag:
+            headers["If-None-Match"] = index.etag
+        if index.last_modified:
+            headers["If-Modified-Since"] = index.last_modified
+        self.logger.debug(f"Calling conditional GET {api_url}")
+        r = self.transport.get(api_url, headers=headers)
+        if r.status_code == 304:
+            return None
+        # The validators are only replaced once a full list has arrived, so an error leaves the index as it was
+        r.raise_for_status()
+        turns = r.json()
+        index.etag = r.headers.get("ETag")
+        index.last_modified = r.headers.get("Last-Modified")
+        return turns
+
+    def sync_turns(self):
+        index = self.cache.turn_index
+        turns = self._get_turns_api_data()
+        if turns is not None and index.merge(turns):
+            index.save()
+        self.cache.turns_synced = True
+        if self.disk_cache is not None:
+            latest_complete = index.latest_complete
+            if self.disk_cache.set_turn_id(latest_complete["id"] if latest_complete else None):
+                self.logger.log("New turn completed. Cleared the Risk API disk cache.")
 
     def get_turns(self) -> list[dict]:
-        if self.cache.turns is None:
-            self.cache.turns = self._get_turns_api_data()
-            self.cache.turns.sort(key=lambda turn: turn["id"])
-        return self.cache.turns
+        with self.cache.turns_lock:
+            if not self.cache.turns_synced:
+                self.sync_turns()
+        return self.cache.turn_index.turns
+
+    def refresh_turns(self) -> list[dict]:
+        with self.cache.turns_lock:
+            self.sync_turns()
+        return self.cache.turn_index.turns
+
+    def get_latest_complete_turn(self):
+        self.get_turns()
+        return self.cache.turn_index.latest_complete
+
+    def get_turn(self, turn_id: int):
+        self.get_turns()
+        return self.cache.turn_index.get(turn_id)
+
+    def get_turn_by_season_day(self, season: int, day: int):
+        self.get_turns()
+        return self.cache.turn_index.get_by_season_day(season, day)
+
+    def reset_cache(self):
+        self.cache.reset()
 
     def get_previous_turn(self) -> dict:
         return self.get_turns()[-2]
@@ -93,13 +343,18 @@ class RiskApi:
         return self._call_api("territory/turn", {"season": season, "day": day, "territory": territory})
 
     def get_territory_turn(self, season: int, day: int, territory: str) -> dict:
-        if season not in self.cache.territory_turn:
-            self.cache.territory_turn[season] = {}
-        if day not in self.cache.territory_turn[season]:
-            self.cache.territory_turn[season][day] = {}
-        if territory not in self.cache.territory_turn[season][day]:
-            self.cache.territory_turn[season][day][territory] = self._get_territory_turn_api_data(season, day, territory)
-        return self.cache.territory_turn[season][day][territory]
+        key = (season, day, territory)
+        if key not in self.cache.territory_turn:
+            self.cache.territory_turn[key] = self._get_territory_turn_api_data(season, day, territory)
+        return self.cache.territory_turn[key]
+
+    def prefetch_territory_turns(self, season: int, day: int, territories: list[str]) -> dict[str, dict]:
+        missing = [territory for territory in territories if (season, day, territory) not in self.cache.territory_turn]
+        fetched = self.map_concurrently(lambda territory: self._get_territory_turn_api_data(season, day, territory),
+                                        missing)
+        for territory, territory_turn in zip(missing, fetched):
+            self.cache.territory_turn[(season, day, territory)] = territory_turn
+        return {territory: self.cache.territory_turn[(season, day, territory)] for territory in territories}
 
 
 class MockRiskApi(RiskApi):
@@ -107,6 +362,8 @@ class MockRiskApi(RiskApi):
         super().__init__()
         self._get_team_api_data_access_count = {"players": 0, "mercs": 0}
         self._get_player_api_data_access_count = 0
+        self._get_batch_player_api_data_names = []
+        self._get_territory_turn_api_data_territories = []
 
     def _get_team_api_data(self, endpoint):
         self._get_team_api_data_access_count[endpoint] += 1
@@ -119,6 +376,10 @@ class MockRiskApi(RiskApi):
 
     def _get_player_api_data(self, player_name):
         self._get_player_api_data_access_count += 1
+        return self._get_mock_player(player_name)
+
+    @staticmethod
+    def _get_mock_player(player_name):
         if player_name == "EpicWolverine":
             return json.loads('{"active_team": {"name": "Aldi"},"name": "EpicWolverine","platform": "reddit","ratings": {"awards": 5,"gameTurns": 3,"mvps": 4,"overall": 4,"streak": 4,"totalTurns": 5},"stats": {"awards": 5,"gameTurns": 18,"mvps": 10,"streak": 18,"totalTurns": 113},"team": {"name": "Aldi"},"turns": [{"day": 18,"mvp": true,"season": 1,"stars": 4,"team": "Aldi","territory": "Alaska"},{"day": 17,"mvp": false,"season": 1,"stars": 4,"team": "Aldi","territory": "Minnesota"}]}')
         elif player_name == "user1":
@@ -131,7 +392,18 @@ class MockRiskApi(RiskApi):
             return json.loads('{"name": "Mautamu","ratings": {"awards": 5,"gameTurns": 3,"mvps": 3,"overall": 3,"streak": 3,"totalTurns": 5},"stats": {"awards": 5,"gameTurns": 18,"mvps": 10,"streak": 18,"totalTurns": 113},"turns": [{"day": 16,"mvp": true,"season": 1,"stars": 3,"team": "Aldi","territory": "Alaska"}]}')
 
     def _get_batch_player_api_data(self, player_names):
-        return json.loads('[{"name": "EpicWolverine", "platform": "reddit", "ratings": {"awards": 5, "gameTurns": 3, "mvps": 4, "overall": 4, "streak": 4, "totalTurns": 5}, "stats": {"awards": 5, "gameTurns": 18, "mvps": 10, "streak": 18, "totalTurns": 113}, "team": {"name": "Aldi"}, "turns": [{"day": 18, "mvp": true, "season": 1, "stars": 4, "team": "Aldi", "territory": "Alaska"}, {"day": 17, "mvp": false, "season": 1, "stars": 4, "team": "Aldi", "territory": "Minnesota"}]}, {"name": "Mautamu", "team": {"name": "Texas A&M"}, "platform": "reddit", "ratings": {"overall": 1, "totalTurns": 3, "gameTurns": 1, "mvps": 1, "streak": 1}, "stats": {"totalTurns": 42, "gameTurns": 0, "mvps": 0, "streak": 0}, "turns": [{"season": 2, "day": 50, "stars": 3, "mvp": false, "territory": "Stillwater", "team": "Texas A&M"}]} ]')
+        self._get_batch_player_api_data_names.append(list(player_names))
+        batch = {player["name"].lower(): player for player in json.loads('[{"name": "EpicWolverine", "platform": "reddit", "ratings": {"awards": 5, "gameTurns": 3, "mvps": 4, "overall": 4, "streak": 4, "totalTurns": 5}, "stats": {"awards": 5, "gameTurns": 18, "mvps": 10, "streak": 18, "totalTurns": 113}, "team": {"name": "Aldi"}, "turns": [{"day": 18, "mvp": true, "season": 1, "stars": 4, "team": "Aldi", "territory": "Alaska"}, {"day": 17, "mvp": false, "season": 1, "stars": 4, "team": "Aldi", "territory": "Minnesota"}]}, {"name": "Mautamu", "team": {"name": "Texas A&M"}, "platform": "reddit", "ratings": {"overall": 1, "totalTurns": 3, "gameTurns": 1, "mvps": 1, "streak": 1}, "stats": {"totalTurns": 42, "gameTurns": 0, "mvps": 0, "streak": 0}, "turns": [{"season": 2, "day": 50, "stars": 3, "mvp": false, "territory": "Stillwater", "team": "Texas A&M"}]} ]')}
+        players = [batch.get(player_name.lower()) or self._get_mock_player(player_name) for player_name in player_names]
+        return [PlayerRecord.from_json(player) for player in players if player is not None]
+
+    def _get_territory_turn_api_data(self, season: int, day: int, territory: str) -> dict:
+        self._get_territory_turn_api_data_territories.append(territory)
+        if territory == "Alaska":
+            return json.loads('{"occupier": "Aldi", "winner": "Aldi", "players": [{"team": "Aldi", "player": "EpicWolverine", "stars": 4, "weight": 1, "power": 4, "multiplier": 1, "mvp": true}, {"team": "Texas A&M", "player": "Mautamu", "stars": 3, "weight": 1, "power": 3, "multiplier": 1, "mvp": false}, {"team": "Ohio State", "player": "Buckeye", "stars": 5, "weight": 1.5, "power": 7.5, "multiplier": 1, "mvp": false}]}')
+        elif territory == "Minnesota":
+            return json.loads('{"occupier": "Ohio State", "winner": "Ohio State", "players": [{"team": "Aldi", "player": "user1", "stars": 3, "weight": 1, "power": 3, "multiplier": 1, "mvp": false}, {"team": "Ohio State", "player": "Buckeye2", "stars": 2, "weight": 1, "power": 2, "multiplier": 1, "mvp": true}, {"team": "Texas A&M", "player": "Aggie", "stars": 4, "weight": 1, "power": 4, "multiplier": 1, "mvp": false}]}')
+        return {"occupier": None, "winner": None, "players": []}
 
     def _get_turns_api_data(self):
         return [
@@ -155,30 +427,16 @@ class TestSuite(unittest.TestCase):
         self.assertEqual({"merc1": 4, "Mautamu": 3}, self.cut.get_merc_stars(self.cut.get_mercs()))
 
     def test_get_player_info(self):
-        expected = {
-            'active_team': {'name': 'Aldi'}, 'name': 'EpicWolverine', 'platform': 'reddit',
-            'ratings': {'awards': 5, 'gameTurns': 3, 'mvps': 4, 'overall': 4, 'streak': 4, 'totalTurns': 5},
-            'stats': {'awards': 5, 'gameTurns': 18, 'mvps': 10, 'streak': 18, 'totalTurns': 113},
-            'team': {'name': 'Aldi'},
-            'turns': [{'day': 18, 'mvp': True, 'season': 1, 'stars': 4, 'team': 'Aldi', 'territory': 'Alaska'},
-                      {'day': 17, 'mvp': False, 'season': 1, 'stars': 4, 'team': 'Aldi', 'territory': 'Minnesota'}]}
+        expected = PlayerRecord("EpicWolverine", "Aldi", 4, 1, 18, "Alaska", "Aldi", 113, 5, 18, 3, 10, 4, 18, 4)
         self.assertEqual(expected, self.cut.get_player_info("EpicWolverine"))
 
     def test_get_batch_player_info(self):
         self.maxDiff = None
         expected = [
-            {'name': 'EpicWolverine', 'platform': 'reddit',
-            'ratings': {'awards': 5, 'gameTurns': 3, 'mvps': 4, 'overall': 4, 'streak': 4, 'totalTurns': 5},
-            'stats': {'awards': 5, 'gameTurns': 18, 'mvps': 10, 'streak': 18, 'totalTurns': 113},
-            'team': {'name': 'Aldi'},
-            'turns': [{'day': 18, 'mvp': True, 'season': 1, 'stars': 4, 'team': 'Aldi', 'territory': 'Alaska'},
-                      {'day': 17, 'mvp': False, 'season': 1, 'stars': 4, 'team': 'Aldi', 'territory': 'Minnesota'}]},
-            {"name": "Mautamu", "team": {"name": "Texas A&M"}, "platform": "reddit",
-             "ratings": {"overall": 1, "totalTurns": 3, "gameTurns": 1, "mvps": 1, "streak": 1},
-             "stats": {"totalTurns": 42, "gameTurns": 0, "mvps": 0, "streak": 0},
-             "turns": [{"season": 2, "day": 50, "stars": 3, "mvp": False, "territory": "Stillwater", "team": "Texas A&M"}]}
+            PlayerRecord("EpicWolverine", "Aldi", 4, 1, 18, "Alaska", "Aldi", 113, 5, 18, 3, 10, 4, 18, 4),
+            PlayerRecord("Mautamu", "Texas A&M", 1, 2, 50, "Stillwater", "Texas A&M", 42, 3, 0, 1, 0, 1, 0, 1)
         ]
-        self.assertEqual(expected, self.cut.get_batch_player_info([{"player": "EpicWolverine"}, {"player": "Mautamu"}]))
+        self.assertEqual(expected, self.cut.get_batch_player_info(["EpicWolverine", "Mautamu"]))
         self.assertEqual(0, self.cut._get_player_api_data_access_count)
         self.assertEqual({"EpicWolverine": expected[0], "Mautamu": expected[1]}, self.cut.cache.player_info)
 
@@ -197,6 +455,237 @@ class TestSuite(unittest.TestCase):
         self.cut.get_player_info("EpicWolverine")
         self.assertEqual(1, self.cut._get_player_api_data_access_count)
 
+    def test_prefetch_territory_turns(self):
+        self.cut.get_territory_turn(1, 18, "Alaska")
+        territory_turns = self.cut.prefetch_territory_turns(1, 18, ["Alaska", "Minnesota", "Ohio"])
+        self.assertEqual(["Alaska", "Minnesota", "Ohio"], list(territory_turns))
+        self.assertEqual("Ohio State", territory_turns["Minnesota"]["winner"])
+        self.assertIs(territory_turns["Minnesota"], self.cut.get_territory_turn(1, 18, "Minnesota"))
+        self.assertEqual(["Alaska", "Minnesota", "Ohio"], sorted(self.cut._get_territory_turn_api_data_territories))
+
+    def test_disk_cache(self):
+        class CountingRiskApi(RiskApi):
+            def __init__(self):
+                super().__init__()
+                self.requests = []
+
+            def _get_turns_api_data(self):
+                self.requests.append("turns")
+                return self.turns
+
+            def _request_api(self, endpoint, params=None):
+                self.requests.append(endpoint)
+                return [{"player": "EpicWolverine", "endpoint": endpoint}]
+
+        disk_cache = DiskCache(":memory:")
+        first_run = CountingRiskApi()
+        first_run.turns = self.cut._get_turns_api_data()
+        first_run.use_disk_cache(disk_cache)
+        first_run._call_api("players", {"team": "Aldi"})
+        self.assertEqual(["turns", "players"], first_run.requests)
+        second_run = CountingRiskApi()
+        second_run.turns = first_run.turns
+        second_run.use_disk_cache(disk_cache)
+        self.assertEqual([{"player": "EpicWolverine", "endpoint": "players"}], second_run._call_api("players", {"team": "Aldi"}))
+        self.assertEqual(["turns"], second_run.requests)
+        next_day = CountingRiskApi()
+        next_day.turns = first_run.turns + [{"id": 21, "season": 1, "day": 21, "complete": True}]
+        next_day.use_disk_cache(disk_cache)
+        next_day._call_api("players", {"team": "Aldi"})
+        self.assertEqual(["turns", "players"], next_day.requests)
+
+    def test_error_responses_are_not_cached(self):
+        from stub_servers import RiskStubServer
+
+        class FailingRiskStubServer(RiskStubServer):
+            def handle(self, handler, method):
+                if self.request_count == 2:
+                    self.send_json(handler, 400, {"message": "Bad Request"})
+                else:
+                    super().handle(handler, method)
+
+        stub = FailingRiskStubServer(players=[self.cut._get_mock_player("user1")])
+        api_base_url = stub.api_base_url(stub.start())
+        try:
+            disk_cache = DiskCache(":memory:")
+            runs = []
+            for _ in range(2):
+                runs.append(RiskApi())
+                runs[-1].api_base_url = api_base_url
+                runs[-1].use_disk_cache(disk_cache)
+            self.assertRaises(HTTPError, runs[0]._call_api, "players", {"team": "Aldi"})
+            self.assertEqual(stub.player_list, runs[1]._call_api("players", {"team": "Aldi"}))
+        finally:
+            stub.stop()
+
+    def test_incremental_batch_player_info(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "player_snapshot.json")
+            players = [{"player": "EpicWolverine", "turnsPlayed": 112, "mvps": 9, "lastTurn": {"season": 1, "day": 17, "stars": 4}},
+                       {"player": "mautamu", "turnsPlayed": 57, "mvps": 6, "stars": 3}]
+            self.cut.use_player_snapshot(path)
+            self.cut.get_incremental_batch_player_info(players)
+            self.cut.save_player_snapshot()
+            next_run = MockRiskApi()
+            next_run.use_player_snapshot(path)
+            players[0] = players[0] | {"turnsPlayed": 113, "lastTurn": {"season": 1, "day": 18, "stars": 4}}
+            infos = next_run.get_incremental_batch_player_info(players)
+            self.assertEqual([["EpicWolverine", "mautamu"]], self.cut._get_batch_player_api_data_names)
+            self.assertEqual([["EpicWolverine"]], next_run._get_batch_player_api_data_names)
+            self.assertEqual(["EpicWolverine", "Mautamu"], [info.name for info in infos])
+            self.assertEqual(1, next_run.get_player_info("mautamu").overall)
+            self.assertEqual(0, next_run._get_player_api_data_access_count)
+            infos = next_run.get_incremental_batch_player_info(players[1:])
+            self.assertEqual(["Mautamu"], [info.name for info in infos])
+            self.assertEqual(["mautamu"], list(next_run.player_snapshot))
+
+    def test_batch_chunks_in_order_and_retried(self):
+        class ChunkedRiskApi(RiskApi):
+            def __init__(self):
+                super().__init__()
+                self.max_batch_size = 3
+                self.max_concurrent_requests = 4
+                self.chunks = []
+                self.failed_once = False
+
+            def _call_api(self, endpoint, params=None):
+                names = params["players"].split(",")
+                self.chunks.append(names)
+                if names[0] == "p3" and not self.failed_once:
+                    self.failed_once = True
+                    raise ValueError("Truncated response")
+                time.sleep(0.01 * (10 - int(names[0][1:])))
+                return [{"name": name} for name in names]
+
+        cut = ChunkedRiskApi()
+        names = [f"p{i}" for i in range(10)]
+        self.assertEqual(names, [player.name for player in cut._get_batch_player_api_data(names)])
+        self.assertEqual(5, len(cut.chunks))
+        self.assertEqual(2, cut.chunks.count(["p3", "p4", "p5"]))
+
+    def test_turn_index_sync(self):
+        from stub_servers import RiskStubServer
+        with tempfile.TemporaryDirectory() as directory:
+            stub = RiskStubServer()
+            api_base_url = stub.api_base_url(stub.start())
+            try:
+                path = os.path.join(directory, "turn_index.json")
+                first_run = RiskApi()
+                first_run.api_base_url = api_base_url
+                first_run.use_turn_index(path)
+                self.assertEqual(19, first_run.get_latest_complete_turn()["id"])
+                second_run = RiskApi()
+                second_run.api_base_url = api_base_url
+                second_run.use_turn_index(path)
+                self.assertEqual(19, second_run.get_previous_turn()["id"])
+                self.assertEqual(19, second_run.get_turn_by_season_day(1, 19)["id"])
+                self.assertIsNotNone(second_run.cache.turn_index.etag)
+                # The first run stored the validators, so the second one is not sent the unchanged list again
+                self.assertEqual([200, 304], stub.turns_statuses)
+                second_run.refresh_turns()
+                stub.turns = stub.turns + [{"id": 21, "season": 1, "day": 21, "complete": False, "rollTime": None}]
+                stub.turns[-2] = stub.turns[-2] | {"complete": True}
+                second_run.refresh_turns()
+                self.assertEqual([200, 304, 304, 200], stub.turns_statuses)
+                self.assertEqual(20, second_run.get_latest_complete_turn()["id"])
+                self.assertEqual(21, TurnIndex.load(path).get_current()["id"])
+            finally:
+                stub.stop()
+
+    def test_turns_error_keeps_index(self):
+        from http_transport import HttpTransport
+        from stub_servers import RiskStubServer
+
+        class FailingRiskStubServer(RiskStubServer):
+            def handle(self, handler, method):
+                if self.request_count == 3:
+                    self.send_json(handler, 500, {"message": "Internal Server Error"}, {"ETag": 'W/"error"'})
+                else:
+                    super().handle(handler, method)
+
+        with tempfile.TemporaryDirectory() as directory:
+            stub = FailingRiskStubServer()
+            api_base_url = stub.api_base_url(stub.start())
+            try:
+                cut = RiskApi()
+                cut.api_base_url = api_base_url
+                cut.transport = HttpTransport(timeout=5, retries=0)
+                cut.use_turn_index(os.path.join(directory, "turn_index.json"))
+                cut.get_turns()
+                cut.refresh_turns()
+                etag = cut.cache.turn_index.etag
+                self.assertRaises(HTTPError, cut.refresh_turns)
+                self.assertEqual(etag, cut.cache.turn_index.etag)
+                self.assertEqual([19, 20], [turn["id"] for turn in cut.refresh_turns()])
+                self.assertEqual([200, 304, 304], stub.turns_statuses)
+            finally:
+                stub.stop()
+
+    def test_batch_matches_case_and_backfills_misses(self):
+        class CasingRiskApi(RiskApi):
+            def __init__(self):
+                super().__init__()
+                self.batches = []
+                self.single_requests = []
+
+            def _get_batch_player_api_data(self, player_names):
+                self.batches.append(list(player_names))
+                # The first batch leaves out "late" and answers "epicwolverine" with the canonical casing
+                known = {"epicwolverine": "EpicWolverine", "late": "late"} if len(self.batches) > 1 else \
+                    {"epicwolverine": "EpicWolverine"}
+                return [PlayerRecord(known[name.lower()]) for name in player_names if name.lower() in known]
+
+            def _get_player_api_data(self, player_name):
+                # Only the single player endpoint knows "solo"
+                self.single_requests.append(player_name)
+                if player_name == "solo":
+                    return {"name": "solo", "ratings": {"overall": 2}}
+
+        metrics.reset()
+        cut = CasingRiskApi()
+        records = cut.get_batch_player_info(["epicwolverine", "late", "solo", "ghost"])
+        self.assertEqual(["EpicWolverine", "late", "solo"], [record.name for record in records])
+        self.assertEqual([["epicwolverine", "late", "solo", "ghost"], ["late", "solo", "ghost"]], cut.batches)
+        self.assertEqual(["solo", "ghost"], cut.single_requests)
+        self.assertIs(cut.get_player_info("epicwolverine"), cut.get_player_info("EpicWolverine"))
+        self.assertEqual({"solo": 2}, cut.get_player_stars(["solo", "ghost"]))
+        self.assertIsNone(cut.get_player_info("Ghost"))
+        cut.reset_cache()
+        cut.get_batch_player_info(["ghost"])
+        self.assertEqual(2, len(cut.batches))
+        self.assertEqual(["solo", "ghost"], cut.single_requests)
+        cut.cache.missing_players["ghost"] = 0
+        cut.get_player_info("ghost")
+        self.assertEqual(["solo", "ghost", "ghost"], cut.single_requests)
+        counters = metrics.to_dict()["counters"]
+        self.assertEqual({"risk_batch_backfills": 1, "risk_missing_players": 2, "risk_single_player_fallbacks": 3},
+                         counters)
+        metrics.reset()
+
     def test_get_previous_turn(self):
         expected = {"id": 19, "season": 1, "day": 19, "complete": True, "active": False, "finale": False, "rollTime": "2022-02-06T03:30:01.685073"}
         self.assertEqual(expected, self.cut.get_previous_turn())
+
+    def test_stream_batch(self):
+        from stub_servers import RiskStubServer
+        history = [{"season": 1, "day": day, "stars": 3, "mvp": False, "territory": "Ann Arbor", "team": "Aldi"}
+                   for day in range(200, 0, -1)]
+        stub = RiskStubServer(players=[{"name": f"Player_{i}", "team": {"name": "Aldi"},
+                                        "ratings": {"overall": 3, "totalTurns": 5, "gameTurns": 3, "mvps": 1, "streak": 2},
+                                        "stats": {"totalTurns": 200, "gameTurns": 10, "mvps": 1, "streak": 4},
+                                        "turns": history} for i in range(40)])
+        api_base_url = stub.api_base_url(stub.start())
+        try:
+            records = {}
+            for stream_batch in (False, True):
+                cut = RiskApi()
+                cut.api_base_url = api_base_url
+                cut.stream_batch = stream_batch
+                cut.max_batch_size = 15
+                records[stream_batch] = cut.get_batch_player_info([f"Player_{i}" for i in range(40)])
+        finally:
+            stub.stop()
+        self.assertEqual(40, len(records[True]))
+        self.assertEqual(records[False], records[True])
+        self.assertEqual((1, 200, "Ann Arbor"), (records[True][39].last_season, records[True][39].last_day,
+                                                 records[True][39].last_territory))
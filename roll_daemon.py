@@ -0,0 +1,160 @@
+import time
+import traceback
+import unittest
+from datetime import datetime, timedelta
+
+from logger import Logger
+
+ROLL_INTERVAL = timedelta(days=1)
+
+
+class RollDaemon:
+    def __init__(self, main, run_args=None, min_poll_seconds=15, max_poll_seconds=900, roll_window_seconds=600):
+        self.main = main
+        self.run_args = run_args or {}
+        self.min_poll_seconds = min_poll_seconds
+        self.max_poll_seconds = max_poll_seconds
+        self.roll_window_seconds = roll_window_seconds
+        self.poll_seconds = min_poll_seconds
+        self.last_turn_id = None
+        self.sleep = time.sleep
+        self.now = datetime.utcnow
+        self.logger = Logger()
+
+    def get_expected_roll_time(self, turn):
+        if turn is None or not turn.get("rollTime"):
+            return None
+        return datetime.fromisoformat(turn["rollTime"]) + ROLL_INTERVAL
+
+    def get_poll_delay(self, turn) -> float:
+        expected_roll_time = self.get_expected_roll_time(turn)
+        if expected_roll_time is not None:
+            seconds_to_roll = (expected_roll_time - self.now()).total_seconds()
+            if abs(seconds_to_roll) <= self.roll_window_seconds:
+                return self.min_poll_seconds
+        self.poll_seconds = min(self.poll_seconds * 2, self.max_poll_seconds)
+        if expected_roll_time is not None and seconds_to_roll > 0:
+            # Never back off past the start of the next roll window
+            return max(min(self.poll_seconds, seconds_to_roll - self.roll_window_seconds), self.min_poll_seconds)
+        return self.poll_seconds
+
+    def warm_up(self):
+        self.main.risk_api.refresh_turns()
+        turn = self.main.risk_api.get_latest_complete_turn()
+        self.last_turn_id = turn["id"] if turn else None
+        self.main.discord_api.get_guild_members()
+        self.main.discord_api.get_guild_roles()
+        self.main.discord_api.get_bot_id()
+        self.logger.log(f"Daemon started. Latest completed turn is {self.last_turn_id}.")
+
+    def invalidate_members(self):
+        # The run's prefetch pages the roster again alongside the Risk API, so an idle daemon sends Discord nothing
+        # and the roll does not wait on the roster first. With the gateway the member events have already been
+        # applied and the cached members are kept.
+        if self.main.discord_api.invalidate_guild_members():
+            self.logger.debug("Guild members will be paged again for this run.")
+        self.main.discord_api.cache.guild_roles = None
+
+    def poll_once(self):
+        self.main.risk_api.refresh_turns()
+        turn = self.main.risk_api.get_latest_complete_turn()
+        if turn is not None and turn["id"] != self.last_turn_id:
+            self.logger.log(f"Turn {turn['id']} (season {turn['season']} day {turn['day']}) completed.")
+            self.main.reset_risk_data()
+            self.invalidate_members()
+            self.main.run(**self.run_args)
+            # Only a finished run marks the turn as handled, so a failed one is retried on the next poll
+            self.last_turn_id = turn["id"]
+            self.poll_seconds = self.min_poll_seconds
+            return turn, True
+        return turn, False
+
+    def run(self, max_polls=None):
+        self.warm_up()
+        polls = 0
+        while max_polls is None or polls < max_polls:
+            polls += 1
+            try:
+                turn, _ = self.poll_once()
+            except Exception as e:
+                # One failed poll or run must not end the daemon
+                self.logger.error(f"Daemon poll failed: {e!r}\n{traceback.format_exc()}")
+                turn = None
+            delay = self.get_poll_delay(turn)
+            self.logger.debug(f"Next poll in {delay:.0f} seconds.")
+            self.sleep(delay)
+
+
+class FakeMain:
+    def __init__(self):
+        from discord_api import MockDiscordApi
+        from risk_api import MockRiskApi
+        self.risk_api = MockRiskApi()
+        self.discord_api = MockDiscordApi()
+        self.turns = self.risk_api._get_turns_api_data()
+        self.risk_api._get_turns_api_data = lambda: [dict(turn) for turn in self.turns]
+        self.runs = []
+
+    def reset_risk_data(self):
+        self.risk_api.reset_cache()
+
+    def run(self, **kwargs):
+        self.discord_api.get_guild_members()
+        self.discord_api.get_guild_roles()
+        self.runs.append((self.risk_api.get_latest_complete_turn()["id"], kwargs))
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.main = FakeMain()
+        self.cut = RollDaemon(self.main, {"write_csv": True}, min_poll_seconds=10, max_poll_seconds=600,
+                              roll_window_seconds=300)
+        self.sleeps = []
+        self.cut.sleep = self.sleeps.append
+        self.cut.now = lambda: datetime.fromisoformat("2022-02-06T12:00:00")
+
+    def test_fires_once_per_roll(self):
+        self.cut.warm_up()
+        self.assertEqual((19, False), (self.cut.poll_once()[0]["id"], self.cut.poll_once()[1]))
+        self.main.turns[0] = self.main.turns[0] | {"complete": True, "rollTime": "2022-02-07T03:30:01"}
+        self.main.turns.append({"id": 21, "season": 1, "day": 21, "complete": False, "rollTime": None})
+        self.assertTrue(self.cut.poll_once()[1])
+        self.assertFalse(self.cut.poll_once()[1])
+        self.assertEqual([(20, {"write_csv": True})], self.main.runs)
+
+    def test_backs_off_until_roll_window(self):
+        turn = self.main.risk_api.get_latest_complete_turn()
+        delays = [self.cut.get_poll_delay(turn) for _ in range(8)]
+        self.assertEqual([20, 40, 80, 160, 320, 600, 600, 600], delays)
+        self.cut.now = lambda: datetime.fromisoformat("2022-02-07T03:27:00")
+        self.assertEqual(10, self.cut.get_poll_delay(turn))
+        self.cut.now = lambda: datetime.fromisoformat("2022-02-07T03:20:00")
+        self.assertEqual(302, round(self.cut.get_poll_delay(turn)))
+
+    def test_refreshes_members_only_for_runs(self):
+        self.cut.run(max_polls=2)
+        self.assertEqual(2, len(self.sleeps))
+        self.assertEqual([], self.main.runs)
+        # Members, roles and bot id at startup and nothing while no roll completes
+        self.assertEqual(3, self.main.discord_api.call_api_get_access_count)
+        self.main.turns[0] = self.main.turns[0] | {"complete": True, "rollTime": "2022-02-07T03:30:01"}
+        self.main.discord_api.members.append({"user": {"id": "555"}, "nick": None, "roles": []})
+        self.assertTrue(self.cut.poll_once()[1])
+        self.assertEqual([20], [turn_id for turn_id, _ in self.main.runs])
+        self.assertIn("555", self.main.discord_api.cache.guild_members_by_id)
+        self.assertEqual(5, self.main.discord_api.call_api_get_access_count)
+
+    def test_survives_failed_runs(self):
+        run = self.main.run
+        def fail(**kwargs):
+            self.main.run = run
+            raise KeyError("rollTime")
+        self.main.run = fail
+        def roll(delay):
+            self.sleeps.append(delay)
+            self.main.turns[0] = self.main.turns[0] | {"complete": True, "rollTime": "2022-02-07T03:30:01"}
+        self.cut.sleep = roll
+        self.cut.run(max_polls=4)
+        self.assertEqual(4, len(self.sleeps))
+        # The failed run is retried on the next poll and not repeated after it succeeds
+        self.assertEqual([(20, {"write_csv": True})], self.main.runs)
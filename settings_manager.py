@@ -1,12 +1,16 @@
 import json
+import os
 
 SETTINGS_FILE_NAME = "settings.json"
+INSTANCE_SECRETS = ("guild_id", "test_guild_id")
 
 
 class SettingsManager:
-    def __init__(self):
-        with open(SETTINGS_FILE_NAME) as f:
-            self.settings = json.load(f)
+    def __init__(self, settings=None):
+        if settings is None:
+            with open(SETTINGS_FILE_NAME) as f:
+                settings = json.load(f)
+        self.settings = settings
 
     def get_secrets(self):
         secrets = self.settings.get("secrets")
@@ -14,6 +18,11 @@ class SettingsManager:
             raise KeyError(f'"secrets" and its child keys must be defined in {SETTINGS_FILE_NAME}')
         return secrets
 
+    def use_test_guild(self):
+        # Clients created afterwards copy the secrets, so they all point at the test guild
+        secrets = self.get_secrets()
+        self.settings = self.settings | {"secrets": secrets | {"guild_id": secrets["test_guild_id"]}}
+
     def get_team_name(self):
         team = self.settings.get("settings").get("team")
         if team is None:
@@ -22,3 +31,82 @@ class SettingsManager:
 
     def get_verified_discord_role_name(self):
         return self.settings.get("settings").get("verified_discord_role_name")
+
+    def get_discord_max_concurrent_requests(self):
+        return self.settings.get("settings").get("discord_max_concurrent_requests", 8)
+
+    def get_discord_member_source(self):
+        return self.settings.get("settings").get("discord_member_source", "rest")
+
+    def get_discord_gateway_url(self):
+        return self.settings.get("settings").get("discord_gateway_url")
+
+    def get_risk_cache_path(self):
+        return self.settings.get("settings").get("risk_cache_path", "risk_cache.sqlite3")
+
+    def get_risk_cache_max_megabytes(self):
+        return self.settings.get("settings").get("risk_cache_max_megabytes", 64)
+
+    def get_player_snapshot_path(self):
+        return self.settings.get("settings").get("player_snapshot_path", "player_snapshot.json")
+
+    def get_http_timeout_seconds(self):
+        return self.settings.get("settings").get("http_timeout_seconds", 30)
+
+    def get_http_retries(self):
+        return self.settings.get("settings").get("http_retries", 3)
+
+    def get_risk_max_concurrent_requests(self):
+        return self.settings.get("settings").get("risk_max_concurrent_requests", 4)
+
+    def get_risk_missing_player_ttl_hours(self):
+        return self.settings.get("settings").get("risk_missing_player_ttl_hours", 24)
+
+    def get_risk_stream_batch(self):
+        return self.settings.get("settings").get("risk_stream_batch", False)
+
+    def get_turn_index_path(self):
+        return self.settings.get("settings").get("turn_index_path", "turn_index.json")
+
+    def get_star_history_path(self):
+        return self.settings.get("settings").get("star_history_path", "star_history.sqlite3")
+
+    def get_nickname_journal_path(self):
+        return self.settings.get("settings").get("nickname_journal_path", "nickname_journal.jsonl")
+
+    def get_nickname_time_budget_minutes(self):
+        return self.settings.get("settings").get("nickname_time_budget_minutes")
+
+    def get_log_level(self):
+        return self.settings.get("settings").get("log_level", "INFO")
+
+    def get_log_format(self):
+        return self.settings.get("settings").get("log_format", "text")
+
+    def get_report_directory(self):
+        return self.settings.get("settings").get("report_directory", "")
+
+    def get_username_map_file(self):
+        return self.settings.get("settings").get("username_map_file", "username_map.json")
+
+    def get_test_username_map_file(self):
+        return self.settings.get("settings").get("test_username_map_file", "test_username_map.json")
+
+    def get_instances(self):
+        return self.settings.get("instances", [])
+
+    def for_instance(self, instance: dict):
+        # Instance keys override the shared settings, and each team keeps its files in a folder named after it
+        team = instance.get("team")
+        if team is None:
+            raise KeyError(f'Every entry in "instances" must define "team" in {SETTINGS_FILE_NAME}')
+        defaults = {"report_directory": team,
+                    "username_map_file": os.path.join(team, "username_map.json"),
+                    "test_username_map_file": os.path.join(team, "test_username_map.json"),
+                    "star_history_path": os.path.join(team, "star_history.sqlite3"),
+                    "player_snapshot_path": os.path.join(team, "player_snapshot.json"),
+                    "nickname_journal_path": os.path.join(team, "nickname_journal.jsonl")}
+        secrets = self.get_secrets() | {key: instance[key] for key in INSTANCE_SECRETS if key in instance}
+        settings = {key: value for key, value in instance.items() if key not in INSTANCE_SECRETS}
+        return SettingsManager(self.settings | {"settings": self.settings.get("settings") | defaults | settings,
+                                                "secrets": secrets})
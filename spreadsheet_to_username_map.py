@@ -1,13 +1,21 @@
 import csv
 import json
+import os
+import shutil
+import tempfile
 import unittest
 
+from logger import Logger
+from username_map import compile_username_map, get_content_hash, read_compiled_username_map, \
+    write_compiled_username_map
+
 
 class Main:
     def __init__(self):
         self.players_csv = "Risk Tracking Sheet - Wolverines.csv"
         self.diplomats_csv = "Risk Tracking Sheet - Diplomats.csv"
         self.json_path = "username_map.json"
+        self.logger = Logger()
 
     @staticmethod
     def read_csv(path: str) -> list[dict]:
@@ -49,15 +57,56 @@ class Main:
         return {"diplomats": diplomats}
 
     @staticmethod
-    def write_json(path: str, obj: dict[str, dict[str, dict]]):
-        with open(path, 'w', encoding='utf-8') as file:
-            file.writelines(json.dumps(obj, indent=4))
+    def write_json(path: str, obj: dict[str, dict[str, dict]]) -> bytes:
+        content = json.dumps(obj, indent=4).encode('utf-8')
+        with open(path, 'wb') as file:
+            file.write(content)
+        return content
+
+    def get_json_hash(self):
+        try:
+            with open(self.json_path, 'rb') as file:
+                return get_content_hash(file.read())
+        except FileNotFoundError:
+            return None
+
+    def get_sheet_hashes(self) -> dict[str, str]:
+        hashes = {}
+        for sheet, path in (("players", self.players_csv), ("diplomats", self.diplomats_csv)):
+            with open(path, 'rb') as file:
+                hashes[sheet] = get_content_hash(file.read())
+        return hashes
 
-    def main(self):
-        players = self.extract_players(self.read_csv(self.players_csv))
-        diplomats = self.extract_diplomats(self.read_csv(self.diplomats_csv))
+    def main(self) -> bool:
+        sheet_hashes = self.get_sheet_hashes()
+        compiled = read_compiled_username_map(self.json_path)
+        # A map edited by hand since the last conversion is rebuilt from the sheets rather than reused
+        if compiled is not None and compiled["source_hash"] != self.get_json_hash():
+            compiled = None
+        previous_hashes = compiled["sheet_hashes"] if compiled is not None else {}
+        if previous_hashes == sheet_hashes:
+            self.logger.log(f"\"{self.json_path}\" is up to date with the tracking sheets.")
+            return False
+        # Only the sheets that changed are parsed again, and the reverse index is kept unless the players did
+        if previous_hashes.get("players") == sheet_hashes["players"]:
+            players = {"players": compiled["players"], "exclude": compiled["exclude"]}
+            reddit_to_discord = compiled["reddit_to_discord"]
+        else:
+            players = self.extract_players(self.read_csv(self.players_csv))
+            reddit_to_discord = None
+        if previous_hashes.get("diplomats") == sheet_hashes["diplomats"]:
+            diplomats = {"diplomats": compiled["diplomats"]}
+        else:
+            diplomats = self.extract_diplomats(self.read_csv(self.diplomats_csv))
         username_map = players | diplomats
-        self.write_json(self.json_path, username_map)
+        content = self.write_json(self.json_path, username_map)
+        write_compiled_username_map(self.json_path, compile_username_map(
+            username_map, get_content_hash(content), sheet_hashes, reddit_to_discord))
+        changed = [sheet for sheet in sheet_hashes if previous_hashes.get(sheet) != sheet_hashes[sheet]]
+        self.logger.log(f"Wrote \"{self.json_path}\" with {len(username_map['players'])} players, "
+                        f"{len(username_map['exclude'])} excluded and {len(username_map['diplomats'])} diplomats "
+                        f"(converted {' and '.join(changed)}).")
+        return True
 
 
 class TestSuite(unittest.TestCase):
@@ -103,6 +152,42 @@ class TestSuite(unittest.TestCase):
         }
         self.assertEqual(expected, self.cut.extract_diplomats(self.cut.read_csv(self.cut.diplomats_csv)))
 
+    def test_main_skips_unchanged_sheets(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.cut.json_path = os.path.join(directory, "username_map.json")
+            self.assertTrue(self.cut.main())
+            self.assertFalse(self.cut.main())
+            with open(self.cut.json_path, 'a', encoding='utf-8') as file:
+                file.write("\n")
+            self.assertTrue(self.cut.main())
+            self.assertFalse(self.cut.main())
+            compiled = read_compiled_username_map(self.cut.json_path)
+            with open(self.cut.json_path, 'rb') as file:
+                self.assertEqual(get_content_hash(file.read()), compiled["source_hash"])
+            self.assertEqual({"pm_me_your_moves": "1234567890", "pm_me_your_orders": "098765321",
+                              "epicwolverine": "140174746485653504"}, compiled["reddit_to_discord"])
+
+    def test_main_converts_only_changed_sheets(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.cut.json_path = os.path.join(directory, "username_map.json")
+            diplomats_csv = os.path.join(directory, "Diplomats.csv")
+            shutil.copyfile(self.cut.diplomats_csv, diplomats_csv)
+            self.cut.diplomats_csv = diplomats_csv
+            self.assertTrue(self.cut.main())
+            extracted = []
+            extract_players, extract_diplomats = self.cut.extract_players, self.cut.extract_diplomats
+            self.cut.extract_players = lambda rows: extracted.append("players") or extract_players(rows)
+            self.cut.extract_diplomats = lambda rows: extracted.append("diplomats") or extract_diplomats(rows)
+            with open(diplomats_csv, 'a', encoding='utf-8') as file:
+                file.write("\nBevo#0001,Bevo,Texas,555\n")
+            self.assertTrue(self.cut.main())
+            self.assertEqual(["diplomats"], extracted)
+            compiled = read_compiled_username_map(self.cut.json_path)
+            self.assertEqual({"nickname": "Bevo", "team": "Texas"}, compiled["diplomats"]["555"])
+            self.assertEqual("1234567890", compiled["reddit_to_discord"]["pm_me_your_moves"])
+            with open(self.cut.json_path, 'r', encoding='utf-8') as file:
+                self.assertEqual(compiled["players"], json.load(file)["players"])
+
 
 if __name__ == "__main__":
     main = Main()
@@ -0,0 +1,163 @@
+import argparse
+import csv
+import re
+import sqlite3
+import threading
+import time
+import unittest
+
+DEFAULT_HISTORY_PATH = "star_history.sqlite3"
+INSERT_BATCH_SIZE = 500
+REPORT_NAME_PATTERN = re.compile(r"Season (-?\d+) Day (\d+) ")
+COLUMNS = ["season", "day", "player", "team", "stars", "last_turn_season", "last_turn_day", "territory",
+           "total_turns", "total_turns_stars", "game_turns", "game_turns_stars", "mvps", "mvp_stars",
+           "streak", "streak_stars", "discord_id"]
+
+
+class StarHistory:
+    def __init__(self, path=DEFAULT_HISTORY_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS stars ("
+                                    "season INTEGER NOT NULL, day INTEGER NOT NULL, player TEXT NOT NULL COLLATE NOCASE, "
+                                    "team TEXT, stars INTEGER, last_turn_season INTEGER, last_turn_day INTEGER, "
+                                    "territory TEXT, total_turns INTEGER, total_turns_stars INTEGER, game_turns INTEGER, "
+                                    "game_turns_stars INTEGER, mvps INTEGER, mvp_stars INTEGER, streak INTEGER, "
+                                    "streak_stars INTEGER, discord_id TEXT, "
+                                    "PRIMARY KEY (season, day, player)) WITHOUT ROWID")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS stars_player ON stars (player, season, day)")
+
+    @staticmethod
+    def to_record(season: int, day: int, row: list) -> tuple:
+        # row follows main.REPORT_HEADER
+        last_turn_season, _, last_turn_day = str(row[3]).partition("/")
+        return (season, day, row[0], row[1], to_int(row[2]), to_int(last_turn_season), to_int(last_turn_day),
+                row[4], *[to_int(value) for value in row[5:13]], row[13] or None)
+
+    def record_rows(self, season: int, day: int, rows):
+        batch = []
+        with self.lock, self.connection:
+            # Re-running the same turn replaces its rows instead of duplicating them
+            self.connection.execute("DELETE FROM stars WHERE season = ? AND day = ?", (season, day))
+            for row in rows:
+                batch.append(self.to_record(season, day, row))
+                if len(batch) >= INSERT_BATCH_SIZE:
+                    self._insert(batch)
+                    batch = []
+                yield row
+            self._insert(batch)
+
+    def append_rows(self, season: int, day: int, rows) -> int:
+        return sum(1 for _ in self.record_rows(season, day, rows))
+
+    def _insert(self, records: list[tuple]):
+        self.connection.executemany(f"INSERT OR REPLACE INTO stars ({', '.join(COLUMNS)}) "
+                                    f"VALUES ({', '.join('?' * len(COLUMNS))})", records)
+
+    def import_csv(self, path: str) -> int:
+        match = REPORT_NAME_PATTERN.search(path)
+        if match is None:
+            raise ValueError(f"Cannot read the season and day from \"{path}\"")
+        with open(path, 'r', encoding='utf-8', newline='') as file:
+            reader = csv.reader(file)
+            next(reader)
+            return self.append_rows(int(match.group(1)), int(match.group(2)), reader)
+
+    def query(self, sql: str, params=()) -> list[tuple]:
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def get_trend(self, player: str, season=None) -> list[tuple]:
+        if season is None:
+            return self.query("SELECT season, day, stars FROM stars WHERE player = ? ORDER BY season, day", (player,))
+        return self.query("SELECT season, day, stars FROM stars WHERE player = ? AND season = ? ORDER BY day",
+                          (player, season))
+
+    def get_first_last_seen(self, player: str) -> tuple:
+        return self.query("SELECT MIN(season * 1000 + day), MAX(season * 1000 + day), "
+                          "MAX(last_turn_season * 1000 + last_turn_day) FROM stars WHERE player = ?", (player,))[0]
+
+    def get_streak_breaks(self, season: int) -> list[tuple]:
+        return self.query("SELECT player, day, previous_streak, streak FROM ("
+                          "SELECT player, day, streak, LAG(streak) OVER (PARTITION BY player ORDER BY day) AS previous_streak "
+                          "FROM stars WHERE season = ?) WHERE streak < previous_streak ORDER BY day, player", (season,))
+
+    def close(self):
+        self.connection.close()
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def format_turn(packed):
+    if packed is None:
+        return ""
+    season, day = divmod(packed, 1000)
+    return f"{season}/{day}"
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cut = StarHistory(":memory:")
+        for day, stars, streak in [(1, 2, 3), (2, 3, 4), (3, 3, 0), (4, 4, 1)]:
+            self.cut.append_rows(5, day, [["EpicWolverine", "Aldi", stars, f"5/{day}", "Ann Arbor", 10, 3, 10, 3,
+                                           1, 2, streak, 2, "140174746485653504", "EpicWolverine#3742", True],
+                                          ["merc1", "Aldi", 1, "/", "", 1, 1, 0, 1, 0, 1, 0, 1, "", "", False]])
+
+    def tearDown(self) -> None:
+        self.cut.close()
+
+    def test_trend(self):
+        self.assertEqual([(5, 1, 2), (5, 2, 3), (5, 3, 3), (5, 4, 4)], self.cut.get_trend("epicwolverine", 5))
+        self.assertEqual([], self.cut.get_trend("EpicWolverine", 4))
+
+    def test_first_last_seen(self):
+        self.assertEqual((5001, 5004, 5004), self.cut.get_first_last_seen("EpicWolverine"))
+        self.assertEqual((5001, 5004, None), self.cut.get_first_last_seen("merc1"))
+
+    def test_streak_breaks(self):
+        self.assertEqual([("EpicWolverine", 3, 4, 0)], self.cut.get_streak_breaks(5))
+
+    def test_rerun_replaces_turn(self):
+        self.cut.append_rows(5, 4, [["EpicWolverine", "Aldi", 5, "5/4", "Ann Arbor", 10, 3, 10, 3, 1, 2, 1, 2, "", "", True]])
+        self.assertEqual((5, 4, 5), self.cut.get_trend("EpicWolverine")[-1])
+        self.assertEqual([(5, 1, 1), (5, 2, 1), (5, 3, 1)], self.cut.get_trend("merc1"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the star history recorded by main.py.")
+    parser.add_argument("-db", "--database", default=DEFAULT_HISTORY_PATH, help="Star history database path.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    trend_parser = subparsers.add_parser("trend", help="Print a player's stars for every recorded day.")
+    trend_parser.add_argument("player")
+    trend_parser.add_argument("-season", "--season", type=int)
+    seen_parser = subparsers.add_parser("seen", help="Print when a player was first and last on the roster and last played.")
+    seen_parser.add_argument("player")
+    streaks_parser = subparsers.add_parser("streaks", help="Print every streak break in a season.")
+    streaks_parser.add_argument("season", type=int)
+    import_parser = subparsers.add_parser("import", help="Backfill the history from existing stars CSV files.")
+    import_parser.add_argument("paths", nargs="+")
+    args = parser.parse_args()
+
+    history = StarHistory(args.database)
+    start = time.perf_counter()
+    if args.command == "trend":
+        for season, day, stars in history.get_trend(args.player, args.season):
+            print(f"{season}/{day}\t{stars}")
+    elif args.command == "seen":
+        first_seen, last_seen, last_played = history.get_first_last_seen(args.player)
+        print(f"First seen: {format_turn(first_seen)}\nLast seen: {format_turn(last_seen)}\n"
+              f"Last played: {format_turn(last_played)}")
+    elif args.command == "streaks":
+        for player, day, previous_streak, streak in history.get_streak_breaks(args.season):
+            print(f"{args.season}/{day}\t{player}\t{previous_streak} -> {streak}")
+    elif args.command == "import":
+        for path in args.paths:
+            print(f"Imported {history.import_csv(path)} rows from \"{path}\"")
+    print(f"Finished in {(time.perf_counter() - start) * 1000:.1f} ms")
@@ -0,0 +1,337 @@
+import bisect
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from websockets.exceptions import ConnectionClosed
+from websockets.sync.server import serve
+
+from gateway_members import DISPATCH, HEARTBEAT, HEARTBEAT_ACK, HELLO, IDENTIFY, REQUEST_GUILD_MEMBERS
+
+
+class StubServer:
+    def __init__(self):
+        self.server = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+    def handle(self, handler: BaseHTTPRequestHandler, method: str):
+        raise NotImplementedError
+
+    def start(self) -> str:
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub.count_request()
+                stub.handle(self, "GET")
+
+            def do_PATCH(self):
+                stub.count_request()
+                stub.handle(self, "PATCH")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def count_request(self):
+        with self.lock:
+            self.request_count += 1
+
+    @staticmethod
+    def read_json_body(handler: BaseHTTPRequestHandler):
+        length = int(handler.headers.get("Content-Length", 0))
+        return json.loads(handler.rfile.read(length)) if length else None
+
+    @staticmethod
+    def send_json(handler: BaseHTTPRequestHandler, status: int, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+
+class StubBucket:
+    def __init__(self):
+        self.window_end = 0.0
+        self.count = 0
+
+
+class DiscordStubServer(StubServer):
+    route_pattern = re.compile(r"^/api/v9/(users/@me|guilds/(\d+)/roles|guilds/(\d+)/members(?:/(\d+))?)$")
+
+    def __init__(self, bucket_limit=5, bucket_window=1.0, global_limit=50, global_window=1.0, latency=0.0,
+                 send_rate_limit_headers=True):
+        super().__init__()
+        self.bucket_limit = bucket_limit
+        self.bucket_window = bucket_window
+        self.global_limit = global_limit
+        self.global_window = global_window
+        self.latency = latency
+        self.send_rate_limit_headers = send_rate_limit_headers
+        self.buckets = {}
+        self.global_bucket = StubBucket()
+        self.members = {}
+        self.member_ids = []
+        self.roles = [{"id": "1", "name": "Wolverine"}]
+        self.bot_id = "999"
+        self.rate_limited_count = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def api_base_url(self, base_url: str) -> str:
+        return f"{base_url}/api/v9"
+
+    def set_members(self, members: list[dict]):
+        with self.lock:
+            self.members = {member["user"]["id"]: member for member in members}
+            self.member_ids = sorted(self.members, key=int)
+
+    def take(self, bucket: StubBucket, limit: int, window: float, now: float) -> bool:
+        if now >= bucket.window_end:
+            bucket.window_end = now + window
+            bucket.count = 0
+        if bucket.count >= limit:
+            return False
+        bucket.count += 1
+        return True
+
+    def handle(self, handler: BaseHTTPRequestHandler, method: str):
+        body = self.read_json_body(handler)
+        url = urlsplit(handler.path)
+        match = self.route_pattern.match(url.path)
+        if match is None:
+            self.send_json(handler, 404, {"message": "404: Not Found", "code": 0})
+            return
+        route, roles_guild_id, members_guild_id, discord_id = match.groups()
+        guild_id = roles_guild_id or members_guild_id
+        bucket_id = f"nick-{guild_id}" if method == "PATCH" else f"{method}-{route.split('/')[0]}-{guild_id}"
+        with self.lock:
+            now = time.monotonic()
+            bucket = self.buckets.setdefault(bucket_id, StubBucket())
+            if not self.take(self.global_bucket, self.global_limit, self.global_window, now):
+                self.rate_limited_count += 1
+                retry_after = round(self.global_bucket.window_end - now, 3)
+                self.send_json(handler, 429, {"message": "You are being rate limited.", "retry_after": retry_after,
+                                              "global": True}, {"X-RateLimit-Global": "true"})
+                return
+            if not self.take(bucket, self.bucket_limit, self.bucket_window, now):
+                self.rate_limited_count += 1
+                retry_after = round(bucket.window_end - now, 3)
+                self.send_json(handler, 429, {"message": "You are being rate limited.", "retry_after": retry_after,
+                                              "global": False},
+                               self.rate_limit_headers(bucket_id, bucket, now))
+                return
+            headers = self.rate_limit_headers(bucket_id, bucket, now) if self.send_rate_limit_headers else {}
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+            status, response = self.respond(method, route, discord_id, parse_qs(url.query), body)
+        self.send_json(handler, status, response, headers)
+
+    def respond(self, method: str, route: str, discord_id, query: dict, body):
+        if route == "users/@me":
+            return 200, {"id": self.bot_id, "username": "CFBRiskMoveTracker", "bot": True}
+        if route.endswith("/roles"):
+            return 200, self.roles
+        if discord_id is None:
+            limit = int(query.get("limit", ["1"])[0])
+            start = bisect.bisect_right(self.member_ids, int(query.get("after", ["0"])[0]),
+                                        key=int) if self.member_ids else 0
+            return 200, [self.members[member_id] for member_id in self.member_ids[start:start + limit]]
+        if method == "PATCH":
+            if discord_id not in self.members:
+                self.members[discord_id] = {"user": {"id": discord_id}, "nick": None, "roles": []}
+                self.member_ids = sorted(self.members, key=int)
+            self.members[discord_id].update(body)
+        if discord_id not in self.members:
+            return 404, {"message": "Unknown Member", "code": 10007}
+        return 200, self.members[discord_id]
+
+    def rate_limit_headers(self, bucket_id: str, bucket: StubBucket, now: float) -> dict:
+        return {"X-RateLimit-Limit": str(self.bucket_limit),
+                "X-RateLimit-Remaining": str(self.bucket_limit - bucket.count),
+                "X-RateLimit-Reset-After": f"{max(bucket.window_end - now, 0):.3f}",
+                "X-RateLimit-Bucket": bucket_id}
+
+
+class GatewayStubServer:
+    def __init__(self, guild_id, members, chunk_size=1000, heartbeat_interval=45000):
+        self.guild_id = guild_id
+        self.members = members
+        self.chunk_size = chunk_size
+        self.heartbeat_interval = heartbeat_interval
+        self.lock = threading.Lock()
+        self.connections = []
+        self.connection_count = 0
+        self.heartbeat_count = 0
+        self.identify = None
+        self.sequence = 0
+        self.server = None
+
+    def start(self) -> str:
+        self.server = serve(self.handle, "127.0.0.1", 0, max_size=None)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"ws://127.0.0.1:{self.server.socket.getsockname()[1]}"
+
+    def stop(self):
+        for connection in list(self.connections):
+            connection.close()
+        self.server.shutdown()
+
+    def handle(self, connection):
+        with self.lock:
+            self.connections.append(connection)
+            self.connection_count += 1
+        try:
+            connection.send(json.dumps({"op": HELLO, "d": {"heartbeat_interval": self.heartbeat_interval},
+                                        "s": None, "t": None}))
+            for message in connection:
+                payload = json.loads(message)
+                if payload["op"] == HEARTBEAT:
+                    with self.lock:
+                        self.heartbeat_count += 1
+                    connection.send(json.dumps({"op": HEARTBEAT_ACK, "d": None, "s": None, "t": None}))
+                elif payload["op"] == IDENTIFY:
+                    self.identify = payload["d"]
+                    self.dispatch(connection, "READY", {"session_id": "stub", "user": {"id": "999"},
+                                                        "guilds": [{"id": self.guild_id, "unavailable": True}]})
+                elif payload["op"] == REQUEST_GUILD_MEMBERS:
+                    chunks = [self.members[i:i + self.chunk_size] for i in range(0, len(self.members), self.chunk_size)]
+                    for chunk_index, chunk in enumerate(chunks or [[]]):
+                        self.dispatch(connection, "GUILD_MEMBERS_CHUNK", {
+                            "guild_id": payload["d"]["guild_id"], "members": chunk, "chunk_index": chunk_index,
+                            "chunk_count": len(chunks or [[]]), "nonce": payload["d"].get("nonce")})
+        except ConnectionClosed:
+            pass
+        finally:
+            with self.lock:
+                self.connections.remove(connection)
+
+    def dispatch(self, connection, event: str, data: dict):
+        with self.lock:
+            self.sequence += 1
+            connection.send(json.dumps({"op": DISPATCH, "t": event, "s": self.sequence, "d": data}))
+
+    def broadcast(self, event: str, data: dict):
+        for connection in list(self.connections):
+            try:
+                self.dispatch(connection, event, data | {"guild_id": self.guild_id})
+            except ConnectionClosed:
+                pass
+
+
+class RiskStubServer(StubServer):
+    def __init__(self, team="Aldi", players=None, mercs=None, turns=None, latency=0.0):
+        super().__init__()
+        self.team = team
+        self.latency = latency
+        self.players = {}
+        self.mercs = []
+        self.set_players(players or [], mercs or [])
+        self.turns = turns if turns is not None else [
+            {"id": 19, "season": 1, "day": 19, "complete": True, "active": False, "finale": False,
+             "rollTime": "2022-02-06T03:30:01.685073"},
+            {"id": 20, "season": 1, "day": 20, "complete": False, "active": True, "finale": False, "rollTime": None}]
+        self.territory_turns = {}
+        self.endpoint_counts = {}
+        self.turns_statuses = []
+
+    def api_base_url(self, base_url: str) -> str:
+        return f"{base_url}/api"
+
+    def set_players(self, players: list[dict], mercs: list[dict]):
+        # players and mercs are full players/batch records
+        self.players = {player["name"].lower(): player for player in players + mercs}
+        self.player_list = [self.to_team_entry(player) | {"lastTurn": self.get_last_turn(player)} for player in players]
+        self.mercs = [self.to_team_entry(merc) | {"stars": merc["ratings"]["overall"]} for merc in mercs]
+
+    def to_team_entry(self, player: dict) -> dict:
+        return {"team": self.team, "player": player["name"], "turnsPlayed": player["stats"]["totalTurns"],
+                "mvps": player["stats"]["mvps"]}
+
+    @staticmethod
+    def get_last_turn(player: dict) -> dict:
+        last_turn = player["turns"][0] if player["turns"] else {}
+        return {"season": last_turn.get("season"), "day": last_turn.get("day"), "stars": last_turn.get("stars")}
+
+    def handle(self, handler: BaseHTTPRequestHandler, method: str):
+        url = urlsplit(handler.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        endpoint = url.path.removeprefix("/api/")
+        with self.lock:
+            self.endpoint_counts[endpoint] = self.endpoint_counts.get(endpoint, 0) + 1
+        time.sleep(self.latency)
+        if endpoint == "players":
+            self.send_json(handler, 200, self.player_list if query.get("team") == self.team else [])
+        elif endpoint == "mercs":
+            self.send_json(handler, 200, self.mercs if query.get("team") == self.team else [])
+        elif endpoint == "players/batch":
+            names = query.get("players", "").split(",")
+            self.send_json(handler, 200, [self.players[name.lower()] for name in names if name.lower() in self.players])
+        elif endpoint == "player":
+            self.send_json(handler, 200, self.players.get(query.get("player", "").lower()))
+        elif endpoint == "turns":
+            etag = f'W/"{hashlib.sha256(json.dumps(self.turns).encode("utf-8")).hexdigest()[:16]}"'
+            unchanged = handler.headers.get("If-None-Match") == etag
+            with self.lock:
+                self.turns_statuses.append(304 if unchanged else 200)
+            if unchanged:
+                handler.send_response(304)
+                handler.send_header("ETag", etag)
+                handler.end_headers()
+            else:
+                self.send_json(handler, 200, self.turns, {"ETag": etag})
+        elif endpoint == "territory/turn":
+            key = (query.get("season"), query.get("day"), query.get("territory"))
+            self.send_json(handler, 200, self.territory_turns.get(key, {"players": [], "teams": []}))
+        else:
+            self.send_json(handler, 404, {"error": "Not Found"})
+
+
+class FlakyStubServer(StubServer):
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+        self.client_ports = set()
+
+    def handle(self, handler, method):
+        with self.lock:
+            self.client_ports.add(handler.client_address[1])
+            fail = self.failures > 0
+            self.failures -= 1
+        if fail:
+            self.send_json(handler, 503, {"message": "Service Unavailable"})
+            return
+        payload = gzip.compress(b'{"ok": true}')
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Encoding", "gzip")
+        handler.send_header("Content-Length", str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
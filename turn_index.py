@@ -0,0 +1,120 @@
+import json
+import os
+import tempfile
+import unittest
+
+
+class TurnIndex:
+    # Turns sorted by id with lookups by id and by (season, day). Completed turns never change, so only new turns
+    # and the ones still in progress are ever merged.
+    def __init__(self, path=None):
+        self.path = path
+        self.turns = []
+        self.by_id = {}
+        self.by_season_day = {}
+        self.latest_complete = None
+        self.etag = None
+        self.last_modified = None
+
+    @classmethod
+    def load(cls, path: str):
+        index = cls(path)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                saved = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return index
+        index.merge(saved["turns"])
+        index.etag = saved.get("etag")
+        index.last_modified = saved.get("last_modified")
+        return index
+
+    def save(self):
+        if self.path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile("w", encoding='utf-8', dir=directory, delete=False) as file:
+            json.dump({"etag": self.etag, "last_modified": self.last_modified, "turns": self.turns}, file)
+        os.replace(file.name, self.path)
+
+    def merge(self, turns: list[dict]) -> int:
+        new_turns = []
+        changed = 0
+        for turn in turns:
+            existing = self.by_id.get(turn["id"])
+            if existing == turn:
+                continue
+            changed += 1
+            if existing is None:
+                new_turns.append(turn)
+            else:
+                # Updated in place so every reference to the turn sees the change
+                existing.clear()
+                existing.update(turn)
+                turn = existing
+            self.by_season_day[(turn["season"], turn["day"])] = turn
+            if turn["complete"] and (self.latest_complete is None or turn["id"] > self.latest_complete["id"]):
+                self.latest_complete = turn
+        if new_turns:
+            new_turns.sort(key=lambda turn: turn["id"])
+            in_order = not self.turns or new_turns[0]["id"] > self.turns[-1]["id"]
+            self.turns += new_turns
+            if not in_order:
+                self.turns.sort(key=lambda turn: turn["id"])
+            for turn in new_turns:
+                self.by_id[turn["id"]] = turn
+        return changed
+
+    def get(self, turn_id: int):
+        return self.by_id.get(turn_id)
+
+    def get_by_season_day(self, season: int, day: int):
+        return self.by_season_day.get((season, day))
+
+    def get_current(self):
+        return self.turns[-1] if self.turns else None
+
+    def get_previous(self):
+        return self.turns[-2] if len(self.turns) > 1 else None
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.turns = [{"id": 20, "season": 1, "day": 20, "complete": False},
+                      {"id": 19, "season": 1, "day": 19, "complete": True},
+                      {"id": 18, "season": 1, "day": 18, "complete": True}]
+        self.cut = TurnIndex()
+        self.cut.merge([dict(turn) for turn in self.turns])
+
+    def test_lookups(self):
+        self.assertEqual([18, 19, 20], [turn["id"] for turn in self.cut.turns])
+        self.assertEqual(19, self.cut.latest_complete["id"])
+        self.assertEqual(19, self.cut.get_previous()["id"])
+        self.assertEqual(20, self.cut.get_current()["id"])
+        self.assertEqual(18, self.cut.get_by_season_day(1, 18)["id"])
+        self.assertIsNone(self.cut.get(17))
+
+    def test_merge_only_changes(self):
+        previous = self.cut.get(20)
+        turns = [dict(turn) for turn in self.turns]
+        turns[0]["complete"] = True
+        self.assertEqual(0, self.cut.merge([dict(turn) for turn in self.turns]))
+        self.assertEqual(2, self.cut.merge(turns + [{"id": 21, "season": 1, "day": 21, "complete": False}]))
+        self.assertIs(previous, self.cut.get(20))
+        self.assertTrue(previous["complete"])
+        self.assertEqual(20, self.cut.latest_complete["id"])
+        self.assertEqual([18, 19, 20, 21], [turn["id"] for turn in self.cut.turns])
+        self.cut.merge([{"id": 5, "season": 0, "day": 5, "complete": True}])
+        self.assertEqual([5, 18, 19, 20, 21], [turn["id"] for turn in self.cut.turns])
+        self.assertEqual(20, self.cut.latest_complete["id"])
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.cut.path = os.path.join(directory, "turn_index.json")
+            self.cut.etag = 'W/"abc"'
+            self.cut.save()
+            loaded = TurnIndex.load(self.cut.path)
+            self.assertEqual(self.cut.turns, loaded.turns)
+            self.assertEqual('W/"abc"', loaded.etag)
+            self.assertEqual(19, loaded.latest_complete["id"])
+            self.assertEqual([], TurnIndex.load(os.path.join(directory, "missing.json")).turns)
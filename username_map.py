@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from atomic_file import replace_atomically
+
+COMPILED_EXTENSION = ".compiled"
+COMPILED_KEYS = ("source_hash", "sheet_hashes", "players", "exclude", "diplomats", "reddit_to_discord")
+# Coarsest modification time resolution of the filesystems the map may live on (FAT keeps two seconds)
+TIMESTAMP_GRANULARITY_NS = 2_000_000_000
+loaded_maps = {}
+
+
+def get_content_hash(*contents: bytes) -> str:
+    digest = hashlib.sha256()
+    for content in contents:
+        # Length prefixes keep ("ab", "c") and ("a", "bc") from hashing the same
+        digest.update(len(content).to_bytes(8, "big"))
+        digest.update(content)
+    return digest.hexdigest()
+
+
+def build_reddit_to_discord(mapping: dict) -> dict[str, str]:
+    combined_users = mapping["players"] | mapping["exclude"]
+    reddit_to_discord = {}
+    for discord_id in combined_users:
+        if "reddit" in combined_users[discord_id]:
+            reddit_to_discord.setdefault(combined_users[discord_id]["reddit"].lower(), discord_id)
+    return reddit_to_discord
+
+
+def get_file_signature(path: str) -> list[int]:
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def compile_username_map(mapping: dict, source_hash: str, sheet_hashes=None, reddit_to_discord=None) -> dict:
+    return {"source_hash": source_hash, "sheet_hashes": sheet_hashes or {},
+            "players": mapping.get("players", {}), "exclude": mapping.get("exclude", {}),
+            "diplomats": mapping.get("diplomats", {}),
+            "reddit_to_discord": reddit_to_discord if reddit_to_discord is not None else build_reddit_to_discord(mapping)}
+
+
+def read_compiled_username_map(path: str):
+    # Plain JSON, so a stale or tampered artifact can only fail to load and be rebuilt
+    try:
+        with open(path + COMPILED_EXTENSION, 'r', encoding='utf-8') as file:
+            compiled = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(compiled, dict) or any(key not in compiled for key in COMPILED_KEYS):
+        return None
+    return compiled
+
+
+def write_compiled_username_map(path: str, compiled: dict):
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", encoding='utf-8', dir=directory, delete=False) as file:
+        json.dump(compiled, file)
+    replace_atomically(file.name, path + COMPILED_EXTENSION)
+
+
+def load_username_map(path: str) -> dict:
+    # Loaded once per process and again only if the file changes, so callers can ask for it as often as they like.
+    # The compiled artifact is keyed by the map's content hash. Within a process an unchanged modification time and
+    # size are trusted, except when the map was modified so close to the last check that a later write could have
+    # kept the same timestamp.
+    signature = get_file_signature(path)
+    checked_ns = time.time_ns()
+    loaded = loaded_maps.get(path)
+    if loaded is not None:
+        compiled, loaded_signature, loaded_ns = loaded
+        if loaded_signature == signature and signature[0] < loaded_ns - TIMESTAMP_GRANULARITY_NS:
+            return compiled
+    with open(path, 'rb') as file:
+        content = file.read()
+    source_hash = get_content_hash(content)
+    if loaded is not None and loaded[0]["source_hash"] == source_hash:
+        compiled = loaded[0]
+    else:
+        compiled = read_compiled_username_map(path)
+        if compiled is None or compiled["source_hash"] != source_hash:
+            compiled = compile_username_map(json.loads(content), source_hash)
+            write_compiled_username_map(path, compiled)
+    loaded_maps[path] = (compiled, signature, checked_ns)
+    return compiled
+
+
+class TestSuite(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "username_map.json")
+        self.write_map({"players": {"1": {"reddit": "EpicWolverine"}, "2": {"reddit": "epicwolverine"}},
+                        "exclude": {"3": {"reddit": "Mautamu"}, "4": {"nick": "Music Bot"}}, "diplomats": {}})
+
+    def tearDown(self) -> None:
+        loaded_maps.pop(self.path, None)
+        self.directory.cleanup()
+
+    def write_map(self, mapping: dict):
+        with open(self.path, 'w', encoding='utf-8') as file:
+            json.dump(mapping, file)
+
+    def test_reverse_index(self):
+        self.assertEqual({"epicwolverine": "1", "mautamu": "3"}, load_username_map(self.path)["reddit_to_discord"])
+
+    def test_loads_once_per_process(self):
+        first = load_username_map(self.path)
+        self.assertIs(first, load_username_map(self.path))
+        self.assertTrue(os.path.exists(self.path + COMPILED_EXTENSION))
+
+    def test_uses_compiled_artifact(self):
+        load_username_map(self.path)
+        loaded_maps.clear()
+        compiled = read_compiled_username_map(self.path)
+        compiled["players"]["1"]["prefix"] = "from artifact"
+        write_compiled_username_map(self.path, compiled)
+        self.assertEqual("from artifact", load_username_map(self.path)["players"]["1"]["prefix"])
+
+    def test_detects_edits_within_timestamp_granularity(self):
+        load_username_map(self.path)
+        stat = os.stat(self.path)
+        with open(self.path, 'r', encoding='utf-8') as file:
+            content = file.read()
+        # Same size and modification time as the map that was just loaded
+        with open(self.path, 'w', encoding='utf-8') as file:
+            file.write(content.replace("EpicWolverine", "EpicWolverinf"))
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertIn("epicwolverinf", load_username_map(self.path)["reddit_to_discord"])
+        loaded_maps.clear()
+        self.assertIn("epicwolverinf", load_username_map(self.path)["reddit_to_discord"])
+
+    def test_rejects_invalid_artifact(self):
+        load_username_map(self.path)
+        loaded_maps.clear()
+        for artifact in (b"\x80\x04\x95 not json", b'{"players": {}}', b"[]"):
+            with open(self.path + COMPILED_EXTENSION, 'wb') as file:
+                file.write(artifact)
+            self.assertIsNone(read_compiled_username_map(self.path))
+            self.assertEqual("1", load_username_map(self.path)["reddit_to_discord"]["epicwolverine"])
+            loaded_maps.clear()
+
+    def test_recompiles_on_change(self):
+        load_username_map(self.path)
+        self.write_map({"players": {"5": {"reddit": "user1"}}, "exclude": {}, "diplomats": {}})
+        os.utime(self.path, ns=(0, 0))
+        self.assertEqual({"user1": "5"}, load_username_map(self.path)["reddit_to_discord"])
+        self.assertEqual(["5"], list(read_compiled_username_map(self.path)["players"]))